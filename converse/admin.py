@@ -1,6 +1,6 @@
 from django.contrib import admin
 
-from converse.models import SlackUser, SlackChannel, SlackAuth, Auth, TalkUser, Group
+from converse.models import SlackUser, SlackChannel, SlackAuth, Auth, TalkUser, Group, Broadcast, BroadcastFailure
 
 admin.site.register(Auth)
 admin.site.register(SlackAuth)
@@ -8,3 +8,5 @@ admin.site.register(TalkUser)
 admin.site.register(SlackUser)
 admin.site.register(Group)
 admin.site.register(SlackChannel)
+admin.site.register(Broadcast)
+admin.site.register(BroadcastFailure)
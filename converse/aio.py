@@ -0,0 +1,185 @@
+"""
+Asyncio counterparts of the messengers and parsers, backed by aiohttp, so that a single worker can have many Slack
+and API.ai requests in flight at once. Requires Python 3.5+ and the `async` extra (pip install django-bot[async]).
+"""
+import asyncio
+import json
+import logging
+import threading
+import weakref
+
+import aiohttp
+
+from converse.clients import get_setting, slack_api_url, slack_rate_limiter
+from converse.messengers import MessengerBase, SlackMessenger
+from converse.parsers import ParserBase, APIAIParser, API_AI_URL
+
+logger = logging.getLogger(__name__)
+
+_local = threading.local()
+_sessions = weakref.WeakKeyDictionary()
+
+
+def get_event_loop():
+    """
+    :return: the event loop of the current thread, created once per thread and reused by `run_sync`
+    """
+    loop = getattr(_local, "loop", None)
+    if loop is None or loop.is_closed():
+        loop = _local.loop = asyncio.new_event_loop()
+    return loop
+
+
+def run_sync(coroutine):
+    """
+    Runs the coroutine to completion on the event loop of the current thread, for the sync methods that wrap a coroutine
+    :raises RuntimeError: when called from a coroutine, which should await it instead
+    """
+    return get_event_loop().run_until_complete(coroutine)
+
+
+def client_session():
+    """
+    :return: the aiohttp session of the running event loop, shared by all the messengers and parsers using that loop,
+    so that their connections are kept alive between requests
+    """
+    loop = asyncio.get_event_loop()
+    session = _sessions.get(loop)
+    if session is None or session.closed:
+        connector = aiohttp.TCPConnector(limit=get_setting("ASYNC_HTTP_CONNECTIONS", 100))
+        session = _sessions[loop] = aiohttp.ClientSession(connector=connector)
+    return session
+
+
+async def slack_api_call(token, method, session=None, **params):
+    """
+    The async version of SlackClient.api_call, waiting for the shared rate limiter without blocking the event loop. The
+    buckets of the rate limiter are kept in a Django cache, whose blocking calls run in the default executor.
+    :return: dict, the decoded response
+    """
+    session = session or client_session()
+    loop = asyncio.get_event_loop()
+    data = dict((key, value if isinstance(value, str) else json.dumps(value)) for key, value in params.items())
+    data["token"] = token
+    attempt = 0
+    while True:
+        delay = await loop.run_in_executor(None, slack_rate_limiter.reserve, token, method, data)
+        while delay:
+            await asyncio.sleep(delay)
+            delay = await loop.run_in_executor(None, slack_rate_limiter.reserve, token, method, data)
+        async with session.post(slack_api_url(method), data=data) as response:
+            if response.status == 429 and attempt < slack_rate_limiter.max_retries:
+                attempt += 1
+                await loop.run_in_executor(None, slack_rate_limiter.retry_after, token, method, data,
+                                           int(response.headers.get("Retry-After", 1)))
+                continue
+            return await response.json(content_type=None)
+
+
+class AsyncMessengerBase(MessengerBase):
+    """
+    A messenger implementing the coroutines `send_async`, `send_text_async` and `send_image_async`. The sync methods of
+    MessengerBase run them on the event loop of the calling thread.
+    """
+
+    async def send_async(self, text):
+        raise NotImplementedError
+
+    async def send_text_async(self, text, quick_replies=None):
+        raise NotImplementedError
+
+    async def send_image_async(self, image_url, quick_replies=None):
+        raise NotImplementedError
+
+    def send(self, text):
+        return run_sync(self.send_async(text))
+
+    def send_text(self, text, quick_replies=None):
+        return run_sync(self.send_text_async(text, quick_replies))
+
+    def send_image(self, image_url, quick_replies=None):
+        return run_sync(self.send_image_async(image_url, quick_replies))
+
+
+class AsyncSlackMessenger(AsyncMessengerBase, SlackMessenger):
+    def __init__(self, token, channel, session=None):
+        super(AsyncSlackMessenger, self).__init__(token, channel)
+        self.token = token
+        self.session = session
+
+    async def send_async(self, text):
+        return await self.send_to_slack_async(text=text)
+
+    async def send_text_async(self, text, quick_replies=None):
+        return await self.send_to_slack_async(attachment=self.text_attachment(text, quick_replies))
+
+    async def send_image_async(self, image_url, quick_replies=None):
+        return await self.send_to_slack_async(attachment=self.image_attachment(image_url, quick_replies))
+
+    async def send_to_slack_async(self, text=None, attachment=None):
+        if self.buffer((self.token, self.channel), (text, attachment)):
+            return True
+        return await self.post_message_async(text=text, attachments=[attachment] if attachment else None)
+
+    async def post_message_async(self, text=None, attachments=None):
+        response = await slack_api_call(self.token, "chat.postMessage", session=self.session,
+                                        **self.message_params(text, attachments))
+        if not response["ok"]:
+            logger.error("Unable to send message to {}: {}".format(self.channel, response.get("error")))
+        return response["ok"]
+
+    def post_message(self, text=None, attachments=None):
+        return run_sync(self.post_message_async(text, attachments))
+
+
+class AsyncParserBase(ParserBase):
+    """
+    A parser implementing the coroutine `parse_async`, which the sync `parse` runs on the event loop of the calling
+    thread
+    """
+
+    async def parse_async(self, query, session_id):
+        """
+        :return: ParserResponse
+        """
+        raise NotImplementedError
+
+    def parse(self, query, session_id):
+        return run_sync(self.parse_async(query, session_id))
+
+
+class AsyncAPIAIParser(AsyncParserBase):
+    def __init__(self, client_token=None, session=None):
+        if client_token is None:
+            from django.conf import settings
+            client_token = settings.API_AI_CLIENT_TOKEN
+        self.client_token = client_token
+        self.session = session
+
+    async def parse_async(self, query, session_id):
+        session = self.session or client_session()
+        headers = {"Authorization": "Bearer " + self.client_token, "Accept": "application/json"}
+        data = {"query": query, "lang": "en", "sessionId": session_id}
+        async with session.post(get_setting("API_AI_URL", API_AI_URL), json=data, headers=headers) as response:
+            return APIAIParser.parse_response(await response.json(content_type=None))
+
+
+async def message_event_async(identity, message, parser):
+    """
+    The async version of tasks.message_event for the ConverseIdentity of a Slack user. Parsing and replying do not block
+    the event loop; the action is executed in the default executor of the loop, as the actions are synchronous.
+    :param parser: AsyncParserBase
+    """
+    from converse.caches import get_slack_auth
+    from converse.executors import Executor
+
+    loop = asyncio.get_event_loop()
+    response = await parser.parse_async(message, identity.session_id)
+    logger.debug(response)
+    if response.text:
+        slack_auth = await loop.run_in_executor(None, get_slack_auth, identity.team_id)
+        await AsyncSlackMessenger(slack_auth.bot_access_token, identity.channel).send_async(response.text)
+    if response.slot_filling_complete and response.action:
+        app_user = await loop.run_in_executor(None, identity.get_app_user)
+        await loop.run_in_executor(None, lambda: Executor.execute(action=response.action, user=app_user,
+                                                                  params=response.params, contexts=response.contexts))
@@ -0,0 +1,114 @@
+import atexit
+import logging
+import os
+import threading
+from collections import OrderedDict
+
+from django.conf import settings
+
+from converse.caches import event_deduplicator
+from converse.routing import session_of_task, session_router
+
+logger = logging.getLogger(__name__)
+
+
+class EventBatcher(object):
+    """
+    Buffers the events received by the webhook views of a process, and queues them as a single `slack_event_batch` task
+    once `max_size` events are buffered, or `max_wait` seconds after the first one, whichever comes first. This saves a
+    broker round trip per event, and lets the batch task resolve the teams and users of all its events in bulk.
+    Events whose batch cannot be queued are forgotten by the event deduplicator, so that Slack's retries are handled.
+    With session queues, the events are queued as one batch per session queue, so that the events of a session keep
+    their order.
+    Slack is answered before the events are queued: the events buffered by a process that crashes are lost, and Slack
+    does not retry them. The timer thread needs threads to be enabled, eg. uWSGI's enable-threads.
+    """
+
+    def __init__(self, max_size=0, max_wait=0.05, router=None):
+        """
+        :param max_size: maximum number of events per batch, batching is disabled if it is 0
+        :param router: the celery router of the session queues, see `converse.routing.SessionRouter`
+        """
+        self.max_size = max_size
+        self.max_wait = max_wait
+        self.router = router
+        self._events = []
+        self._event_ids = []
+        self._timer = None
+        self._lock = threading.Lock()
+        self._pid = os.getpid()
+
+    @property
+    def enabled(self):
+        return self.max_size > 0
+
+    def add(self, event_id, task, *args):
+        """
+        :param event_id: the id under which the event deduplicator recorded the event, or None
+        :param task: `slack_message_event` or `slack_action_event`
+        """
+        with self._lock:
+            if self._pid != os.getpid():
+                # forked: the buffer and the timer belong to the parent
+                self._events, self._event_ids, self._timer = [], [], None
+                self._pid = os.getpid()
+            self._events.append((task.name, args))
+            self._event_ids.append(event_id)
+            full = len(self._events) >= self.max_size
+            if not full and self._timer is None:
+                self._timer = threading.Timer(self.max_wait, self.flush)
+                self._timer.daemon = True
+                self._timer.start()
+        if full:
+            self.flush()
+
+    def flush(self):
+        """
+        Queues the buffered events
+        :return: the number of events queued
+        """
+        from converse.tasks import slack_event_batch
+
+        with self._lock:
+            events, event_ids = self._events, self._event_ids
+            self._events, self._event_ids = [], []
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+        if not events:
+            return 0
+        queued = 0
+        for queue, (batch, batch_ids) in self.split(events, event_ids).items():
+            try:
+                if queue is None:
+                    slack_event_batch.delay(batch)
+                else:
+                    slack_event_batch.apply_async(args=(batch,), queue=queue)
+            except Exception:
+                logger.error("Unable to queue a batch of {} events".format(len(batch)), exc_info=True)
+                for event_id in batch_ids:
+                    if event_id is not None:
+                        event_deduplicator.forget(event_id)
+                continue
+            queued += len(batch)
+        return queued
+
+    def split(self, events, event_ids):
+        """
+        :return: OrderedDict of the session queue, or None, to the (events, event ids) of the queue, in order
+        """
+        batches = OrderedDict()
+        for (name, args), event_id in zip(events, event_ids):
+            session = session_of_task(name, args, None)
+            queue = self.router.queue_for(*session) if self.router is not None and session is not None else None
+            batch, batch_ids = batches.setdefault(queue, ([], []))
+            batch.append((name, args))
+            batch_ids.append(event_id)
+        return batches
+
+
+event_batcher = EventBatcher(max_size=getattr(settings, "EVENT_BATCH_SIZE", 0),
+                             max_wait=getattr(settings, "EVENT_BATCH_WAIT", 0.05),
+                             router=session_router)
+# queues the events buffered when the process exits gracefully, eg. on a redeploy
+atexit.register(event_batcher.flush)
@@ -0,0 +1,579 @@
+"""
+A throughput and latency benchmark of the handling of a Slack message: SlackRequestURL, slack_message_event,
+message_event, the parser, Executor.execute and the reply, against the stand-in servers of `converse.testing`. The
+celery tasks are run eagerly, and the rows created are rolled back at the end.
+`TraceReplay` replays recorded Slack traffic into the webhook views instead, to reproduce its shape.
+"""
+import io
+import json
+import logging
+import platform
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from pydoc import locate
+from timeit import default_timer
+
+import django
+from celery import current_app
+from django.conf import settings
+from django.db import transaction, connections
+from django.test import RequestFactory, override_settings
+from django.urls import reverse
+from six.moves import queue
+
+from converse import tasks, tracing
+from converse.caches import slack_auth_cache
+from converse.clients import slack_clients
+from converse.executors import Executor
+from converse.models import SlackAuth, SlackUser, AbstractUser, AbstractOrganization
+from converse.parsers import parser_pool
+from converse.testing import FakeSlackServer, FakeAPIAIServer
+from converse.tracing import MetricsRegistry, STAGE_SECONDS, QUEUE_LAG_SECONDS
+from converse.views import SlackRequestURL, SlackActionURL
+
+logger = logging.getLogger(__name__)
+
+BENCHMARK_ACTION = "converse.benchmark"
+
+
+def benchmark_action(user, params, contexts):
+    user.messenger.send("Done: {}".format(params.get("item", "")))
+
+
+def percentile(values, percent):
+    """
+    :return: the nearest rank percentile of the values, or None if there are none
+    """
+    if not values:
+        return None
+    values = sorted(values)
+    rank = max(int(round(percent / 100.0 * len(values) + 0.5)) - 1, 0)
+    return values[min(rank, len(values) - 1)]
+
+
+@contextmanager
+def eager_tasks():
+    conf = current_app.conf
+    previous = conf.task_always_eager, conf.task_eager_propagates
+    conf.task_always_eager, conf.task_eager_propagates = True, True
+    try:
+        yield
+    finally:
+        conf.task_always_eager, conf.task_eager_propagates = previous
+
+
+@contextmanager
+def parser(parser_class):
+    previous = tasks.parser_class
+    tasks.parser_class = parser_class
+    parser_pool.clear()
+    try:
+        yield
+    finally:
+        tasks.parser_class = previous
+        parser_pool.clear()
+
+
+@contextmanager
+def rate_limits(enabled):
+    """
+    Disables the Slack rate limiter, which the stand-in server does not need, unless `enabled`
+    """
+    previous = slack_clients.rate_limiter
+    if not enabled:
+        slack_clients.rate_limiter = None
+    try:
+        yield
+    finally:
+        slack_clients.rate_limiter = previous
+
+
+@contextmanager
+def registered_action(action, obj):
+    """
+    Registers the action for the block only, so the actions of the project are left as they were
+    """
+    previous = Executor.action_map.get(action)
+    Executor(action=action)(obj)
+    try:
+        yield
+    finally:
+        if previous is None:
+            Executor.action_map.pop(action, None)
+        else:
+            Executor.action_map[action] = previous
+
+
+@contextmanager
+def recorded_spans():
+    """
+    Records the spans of the block in a registry of its own, kept in the process
+    """
+    previous = tracing.metrics
+    tracing.metrics = MetricsRegistry(flush_interval=float("inf"))
+    try:
+        yield tracing.metrics
+    finally:
+        tracing.metrics = previous
+
+
+def stage_summary(registry):
+    """
+    :return: dict of each stage timed to its count and mean duration in milliseconds
+    """
+    stages = {}
+    for metric, labels, histogram in registry.pending():
+        if metric == STAGE_SECONDS and histogram.count:
+            stage = stages.setdefault(labels["stage"], {"count": 0, "seconds": 0.0})
+            stage["count"] += histogram.count
+            stage["seconds"] += histogram.sum
+    return dict((name, {"count": stage["count"], "mean_ms": round(1000 * stage["seconds"] / stage["count"], 3)})
+                for name, stage in stages.items())
+
+
+class MessageBenchmark(object):
+    """
+    Posts `messages` message events from `users` users of a new team to SlackRequestURL, after `warmup` messages which
+    are not measured, and measures the time until each is handled. The messages are posted by `concurrency` threads.
+    """
+
+    def __init__(self, messages=500, users=10, warmup=20, slack_latency=0.0, parser_latency=0.0, parser_path=None,
+                 rate_limited=False, concurrency=1):
+        """
+        :param parser_path: the parser class, defaults to APIAIParser querying the stand-in api.ai server
+        :param rate_limited: whether the Slack calls wait for the rate limiter
+        :param concurrency: number of threads posting the messages. The rows of the team are rolled back with a single
+        thread, otherwise they are committed for the threads to see them, and deleted at the end
+        """
+        self.messages = messages
+        self.users = users
+        self.warmup = warmup
+        self.slack_latency = slack_latency
+        self.parser_latency = parser_latency
+        self.parser_path = parser_path or "converse.parsers.APIAIParser"
+        self.rate_limited = rate_limited
+        self.concurrency = max(concurrency, 1)
+        self.team_id = "TBENCH{}".format(uuid.uuid4().hex[:8].upper())
+        self.token = "benchmark"
+        self.view = SlackRequestURL.as_view()
+        self.factory = RequestFactory()
+
+    def request(self, index, slack_id, text):
+        now = time.time()
+        body = {"token": self.token, "type": "event_callback", "team_id": self.team_id,
+                "event_id": "{}-{}".format(self.team_id, index), "event_time": int(now),
+                "event": {"type": "message", "user": slack_id, "text": text, "ts": "{:.6f}".format(now),
+                          "channel": "D" + slack_id}}
+        return self.factory.post(reverse("converse:slack:webhook"), json.dumps(body), content_type="application/json")
+
+    def post(self, index, slack_id):
+        request = self.request(index, slack_id, "add item {}".format(index))
+        start = default_timer()
+        try:
+            response = self.view(request)
+            ok = response.status_code == 200
+        except Exception:
+            logger.warning("Message {} failed".format(index), exc_info=True)
+            ok = False
+        return default_timer() - start, ok
+
+    def work(self, pending, slack_ids, results):
+        try:
+            while True:
+                try:
+                    index = pending.get_nowait()
+                except queue.Empty:
+                    return
+                results[index] = self.post(index, slack_ids[index % len(slack_ids)])
+        finally:
+            connections.close_all()
+
+    def post_all(self, slack_ids):
+        """
+        :return: list of (latency, ok) of each message
+        """
+        if self.concurrency == 1:
+            return [self.post(index, slack_ids[index % len(slack_ids)]) for index in range(self.messages)]
+        pending = queue.Queue()
+        for index in range(self.messages):
+            pending.put(index)
+        results = [None] * self.messages
+        threads = [threading.Thread(target=self.work, args=(pending, slack_ids, results))
+                   for _ in range(self.concurrency)]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return results
+
+    def create_team(self, slack_ids):
+        slack_auth = SlackAuth.objects.create(team_id=self.team_id, team_name="Benchmark",
+                                              bot_access_token="xoxb-benchmark")
+        for slack_id in slack_ids:
+            SlackUser.objects.create(slack_auth=slack_auth, slack_id=slack_id, slack_channel="D" + slack_id,
+                                     name=slack_id, email="{}@example.com".format(slack_id.lower()))
+        return slack_auth
+
+    @contextmanager
+    def team(self, slack_ids):
+        """
+        Creates the team and its users, which are rolled back or deleted at the end of the block
+        """
+        if self.concurrency == 1:
+            with transaction.atomic():
+                try:
+                    yield self.create_team(slack_ids)
+                finally:
+                    transaction.set_rollback(True)
+                    slack_auth_cache.clear()
+            return
+        slack_auth = self.create_team(slack_ids)
+        try:
+            yield slack_auth
+        finally:
+            slack_users = SlackUser.objects.filter(slack_auth=slack_auth)
+            AbstractUser.implementation().objects.filter(converse_user__in=slack_users).delete()
+            AbstractOrganization.implementation().objects.filter(converse_org=slack_auth).delete()
+            slack_auth.delete()
+            slack_auth_cache.clear()
+
+    def run(self):
+        """
+        :return: dict of the results
+        """
+        slack_ids = ["U{:05d}".format(i) for i in range(self.users)]
+        slack = FakeSlackServer(users=[FakeSlackServer.user(slack_id) for slack_id in slack_ids],
+                                latency=self.slack_latency)
+        apiai = FakeAPIAIServer(action=BENCHMARK_ACTION, speech="On it", parameters={"item": "milk"},
+                                latency=self.parser_latency)
+        with slack, apiai, override_settings(SLACK_API_URL=slack.url, API_AI_URL=apiai.url,
+                                             API_AI_CLIENT_TOKEN="benchmark", SLACK_VERIFICATION_TOKEN=self.token), \
+                eager_tasks(), parser(locate(self.parser_path)), rate_limits(self.rate_limited), \
+                registered_action(BENCHMARK_ACTION, benchmark_action), self.team(slack_ids):
+            for index in range(self.warmup):
+                self.post(-index - 1, slack_ids[index % len(slack_ids)])
+            posted = len(slack.messages)
+            with recorded_spans() as registry:
+                start = default_timer()
+                results = self.post_all(slack_ids)
+                seconds = default_timer() - start
+            replies = len(slack.messages) - posted
+        latencies = [latency for latency, ok in results]
+        return {
+            "benchmark": "slack_message_event",
+            "messages": self.messages,
+            "errors": len([ok for latency, ok in results if not ok]),
+            "replies": replies,
+            "seconds": round(seconds, 6),
+            "messages_per_second": round(self.messages / seconds, 3) if seconds else None,
+            "latency_ms": dict((name, round(1000 * value, 3) if value is not None else None) for name, value in [
+                ("p50", percentile(latencies, 50)), ("p90", percentile(latencies, 90)),
+                ("p99", percentile(latencies, 99)), ("max", max(latencies) if latencies else None),
+                ("mean", sum(latencies) / len(latencies) if latencies else None)]),
+            "stages": stage_summary(registry),
+            "config": {"users": self.users, "warmup": self.warmup, "slack_latency": self.slack_latency,
+                       "parser_latency": self.parser_latency, "parser": self.parser_path,
+                       "rate_limited": self.rate_limited, "concurrency": self.concurrency},
+            "environment": {"python": platform.python_version(), "django": django.get_version()},
+        }
+
+
+def compare(results, baseline, tolerance=0.2):
+    """
+    :param baseline: the results of an earlier run
+    :param tolerance: the fraction by which the throughput may drop, and the p99 latency may rise
+    :return: list of the regressions found, as strings
+    """
+    regressions = []
+    rate, base_rate = results.get("messages_per_second"), baseline.get("messages_per_second")
+    if rate is not None and base_rate and rate < base_rate * (1 - tolerance):
+        regressions.append("messages_per_second dropped from {} to {}".format(base_rate, rate))
+    p99, base_p99 = results["latency_ms"].get("p99"), baseline.get("latency_ms", {}).get("p99")
+    if p99 is not None and base_p99 and p99 > base_p99 * (1 + tolerance):
+        regressions.append("p99 latency rose from {} ms to {} ms".format(base_p99, p99))
+    if results.get("errors"):
+        regressions.append("{} messages failed".format(results["errors"]))
+    return regressions
+
+
+def latency_summary(values):
+    """
+    :param values: list of seconds
+    :return: dict of the percentiles, in milliseconds
+    """
+    result = {"p50": percentile(values, 50), "p90": percentile(values, 90), "p99": percentile(values, 99),
+              "max": max(values) if values else None}
+    return dict((name, round(1000 * value, 3) if value is not None else None) for name, value in result.items())
+
+
+class ReplayRecord(object):
+    """
+    A recorded Slack request: the body of an event callback, or the payload of an interactive message
+    """
+
+    def __init__(self, body, action=False, timestamp=None):
+        self.body = body
+        self.action = action
+        self.timestamp = timestamp
+
+    @classmethod
+    def from_line(cls, line):
+        """
+        :param line: the JSON of an event callback, of an interactive message payload, or {"payload": <payload>}, any
+        of which may have a "received_at" timestamp
+        """
+        data = json.loads(line)
+        received_at = data.pop("received_at", None)
+        if "payload" in data:
+            payload = data["payload"]
+            data = json.loads(payload) if not isinstance(payload, dict) else payload
+        action = "actions" in data
+        timestamp = received_at or (data.get("action_ts") if action else data.get("event_time"))
+        return cls(data, action=action, timestamp=float(timestamp) if timestamp is not None else None)
+
+    @property
+    def team_id(self):
+        return self.body["team"]["id"] if self.action else self.body.get("team_id")
+
+    @property
+    def user_id(self):
+        return self.body["user"]["id"] if self.action else self.body.get("event", {}).get("user")
+
+    def rewrite(self, run_id, token, now):
+        """
+        :return: a copy of the body, sent at `now` by a new event, so that neither the event deduplicator nor the lag
+        measurements see the recorded one
+        """
+        body = json.loads(json.dumps(self.body))
+        body["token"] = token
+        if self.action:
+            body["action_ts"] = "{:.6f}".format(now)
+        else:
+            body["event_id"] = "{}-{}".format(body.get("event_id") or uuid.uuid4().hex, run_id)
+            body["event_time"] = int(now)
+            if "event" in body:
+                body["event"]["ts"] = "{:.6f}".format(now)
+        return body
+
+
+def load_trace(path):
+    """
+    :return: list of ReplayRecord, ordered by timestamp
+    """
+    with io.open(path, encoding="utf-8") as f:
+        records = [ReplayRecord.from_line(line) for line in f if line.strip()]
+    untimed = [record for record in records if record.timestamp is None]
+    if untimed:
+        raise RuntimeError("{} records of {} have no timestamp".format(len(untimed), path))
+    return sorted(records, key=lambda record: record.timestamp)
+
+
+class TraceReplay(object):
+    """
+    Replays recorded Slack requests into SlackRequestURL and SlackActionURL, at `speedup` times their recorded pace, or
+    at a constant `rate` per second. The requests are handled by `concurrency` threads, each taking the next due
+    request; with `eager`, the celery tasks also run in these threads, which then stand for the celery workers. With a
+    `concurrency` of 0, the replaying thread handles each request itself once it is due.
+    Otherwise the tasks are queued to the broker, for the workers to consume.
+    The ingestion lag of a request is the delay between its due time and the moment a thread posts it. Its end to end
+    lag runs until it is handled: until the view returns with `eager`, otherwise until a worker starts its task, as
+    measured by `converse.tracing` (which needs a cache shared with the workers). The settings of the replay only
+    apply to its own process, so the workers must be configured with the `slack_url` and `apiai_url` given.
+    """
+
+    def __init__(self, records, speedup=1.0, rate=None, concurrency=8, eager=True, slack_url=None, apiai_url=None,
+                 parser_path=None, rate_limited=False, drain=5.0):
+        """
+        :param slack_url: the Slack API URL of the tasks, defaults to a stand-in started for the replay
+        :param apiai_url: the api.ai URL of the tasks, defaults to a stand-in started for the replay
+        :param drain: seconds waited for the workers after the last request, when not `eager`
+        :raises RuntimeError: when not `eager` without both `slack_url` and `apiai_url`, as the workers would call the
+            real services with the fake tokens of the replay
+        """
+        if not eager and not (slack_url and apiai_url):
+            raise RuntimeError("Queueing the tasks requires the Slack and api.ai URLs of the workers")
+        self.records = records
+        self.speedup = speedup
+        self.rate = rate
+        self.concurrency = concurrency
+        self.eager = eager
+        self.slack_url = slack_url
+        self.apiai_url = apiai_url
+        self.parser_path = parser_path or "converse.parsers.APIAIParser"
+        self.rate_limited = rate_limited
+        self.drain = drain
+        self.run_id = uuid.uuid4().hex[:8]
+        self.views = {False: SlackRequestURL.as_view(), True: SlackActionURL.as_view()}
+        self.factory = RequestFactory()
+        self.results = []
+        self._lock = threading.Lock()
+
+    def offsets(self):
+        """
+        :return: the second at which each record is due, relative to the start of the replay
+        """
+        if self.rate:
+            return [index / float(self.rate) for index in range(len(self.records))]
+        if not self.records:
+            return []
+        first = self.records[0].timestamp
+        return [(record.timestamp - first) / self.speedup for record in self.records]
+
+    def teams(self):
+        """
+        :return: dict of each team id to the set of its user ids
+        """
+        teams = {}
+        for record in self.records:
+            if record.team_id:
+                users = teams.setdefault(record.team_id, set())
+                if record.user_id:
+                    users.add(record.user_id)
+        return teams
+
+    def create_teams(self):
+        """
+        Creates the SlackAuths of the teams of the trace which are missing
+        :return: list of the SlackAuths created
+        """
+        existing = set(SlackAuth.objects.filter(team_id__in=list(self.teams())).values_list("team_id", flat=True))
+        return [SlackAuth.objects.create(team_id=team_id, team_name="Replay {}".format(team_id),
+                                         bot_access_token="xoxb-replay-{}".format(team_id.lower()))
+                for team_id in sorted(self.teams()) if team_id not in existing]
+
+    def request(self, record, now):
+        body = record.rewrite(self.run_id, settings.SLACK_VERIFICATION_TOKEN, now)
+        if record.action:
+            return self.factory.post(reverse("converse:slack:action"), {"payload": json.dumps(body)})
+        return self.factory.post(reverse("converse:slack:webhook"), json.dumps(body), content_type="application/json")
+
+    def handle(self, record, due):
+        start = time.time()
+        try:
+            ok = self.views[record.action](self.request(record, start)).status_code == 200
+        except Exception:
+            logger.warning("Unable to replay a request of {}".format(record.team_id), exc_info=True)
+            ok = False
+        with self._lock:
+            self.results.append((record, start - due, time.time() - due, ok))
+
+    def work(self, pending):
+        try:
+            while True:
+                item = pending.get()
+                if item is None:
+                    return
+                self.handle(*item)
+        finally:
+            connections.close_all()
+
+    def send(self):
+        """
+        Posts the records when they are due
+        :return: the seconds the replay took
+        """
+        start = time.time()
+        if not self.concurrency:
+            for record, offset in zip(self.records, self.offsets()):
+                delay = start + offset - time.time()
+                if delay > 0:
+                    time.sleep(delay)
+                self.handle(record, start + offset)
+            return time.time() - start
+        pending = queue.Queue()
+        threads = [threading.Thread(target=self.work, args=(pending,)) for _ in range(self.concurrency)]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        for record, offset in zip(self.records, self.offsets()):
+            delay = start + offset - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            pending.put((record, start + offset))
+        for _ in threads:
+            pending.put(None)
+        for thread in threads:
+            thread.join()
+        return time.time() - start
+
+    def worker_lags(self, before):
+        """
+        :return: dict of each team to its Histogram of the lags of the tasks started since the `before` snapshot
+        """
+        tracing.metrics.flush()
+        lags = {}
+        for metric, labels, histogram in tracing.metrics.collect():
+            team_id = labels.get("team_id")
+            if metric != QUEUE_LAG_SECONDS or labels.get("stage") != "worker" or team_id not in self.teams():
+                continue
+            previous = before.get(team_id)
+            if previous is not None:
+                histogram.counts = [count - old for count, old in zip(histogram.counts, previous.counts)]
+            lags[team_id] = histogram
+        return lags
+
+    def run(self):
+        """
+        :return: dict of the results
+        """
+        with FakeSlackServer(users=[FakeSlackServer.user(user_id) for users in self.teams().values()
+                                    for user_id in sorted(users)]) as slack, \
+                FakeAPIAIServer(speech="ok") as apiai, \
+                override_settings(SLACK_API_URL=self.slack_url or slack.url, API_AI_URL=self.apiai_url or apiai.url), \
+                parser(locate(self.parser_path)), rate_limits(self.rate_limited):
+            created = self.create_teams()
+            before = {} if self.eager else self.worker_lags({})
+            if self.eager:
+                with eager_tasks(), recorded_spans() as registry:
+                    seconds = self.send()
+                stages = stage_summary(registry)
+            else:
+                seconds = self.send()
+                time.sleep(self.drain)
+                stages = None
+            worker_lags = None if self.eager else self.worker_lags(before)
+            # the replies posted to the Slack API URL given are not seen by the stand-in
+            replies = None if self.slack_url else len(slack.messages)
+        return self.report(seconds, stages, worker_lags, replies, created)
+
+    def report(self, seconds, stages, worker_lags, replies, created):
+        offsets = self.offsets()
+        scheduled = offsets[-1] if offsets else 0.0
+        teams = {}
+        for record, ingestion, end_to_end, ok in self.results:
+            team = teams.setdefault(record.team_id, {"requests": 0, "errors": 0, "end_to_end": []})
+            team["requests"] += 1
+            team["errors"] += 0 if ok else 1
+            team["end_to_end"].append(end_to_end)
+        team_results = {}
+        for team_id, team in teams.items():
+            team_results[team_id] = {"requests": team["requests"], "errors": team["errors"]}
+            if self.eager:
+                team_results[team_id]["end_to_end_lag_ms"] = latency_summary(team["end_to_end"])
+            elif team_id in worker_lags:
+                histogram = worker_lags[team_id]
+                team_results[team_id]["worker_lag_ms"] = dict(
+                    (name, 1000 * histogram.percentile(percent) if histogram.percentile(percent) is not None else None)
+                    for name, percent in [("p50", 50), ("p90", 90), ("p99", 99)])
+                team_results[team_id]["worker_tasks"] = histogram.count
+        return {
+            "requests": len(self.results),
+            "events": len([record for record in self.records if not record.action]),
+            "actions": len([record for record in self.records if record.action]),
+            "errors": len([result for result in self.results if not result[3]]),
+            "replies": replies,
+            "seconds": round(seconds, 6),
+            "scheduled_seconds": round(scheduled, 6),
+            "offered_rate": round(len(self.records) / scheduled, 3) if scheduled else None,
+            "throughput": round(len(self.results) / seconds, 3) if seconds else None,
+            "ingestion_lag_ms": latency_summary([result[1] for result in self.results]),
+            "end_to_end_lag_ms": latency_summary([result[2] for result in self.results]) if self.eager else None,
+            "teams": team_results,
+            "teams_created": [slack_auth.team_id for slack_auth in created],
+            "stages": stages,
+            "config": {"speedup": self.speedup, "rate": self.rate, "concurrency": self.concurrency,
+                       "eager": self.eager, "parser": self.parser_path, "rate_limited": self.rate_limited},
+        }
@@ -0,0 +1,96 @@
+import logging
+from multiprocessing.pool import ThreadPool
+
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+from converse.models import Broadcast, BroadcastFailure
+
+logger = logging.getLogger(__name__)
+
+
+class BroadcastSender(object):
+    """
+    Delivers a Broadcast to the users of its organization. The recipients are streamed from the database in chunks of
+    `batch_size`, ordered by primary key, and the messages of a chunk are sent by up to `concurrency` threads. The Slack
+    calls wait for the shared rate limiter (see `converse.ratelimits`), so the threads never exceed the rate limits.
+    After each chunk, the counters, the failures and the cursor are saved in one transaction, so an interrupted
+    broadcast resumes with the first chunk that was not saved. A broadcast is sent by a single sender at a time: the
+    others, eg. of a task delivered twice, find it running and return.
+    """
+
+    def __init__(self, broadcast, batch_size=None, concurrency=None):
+        self.broadcast = broadcast
+        self.batch_size = batch_size or getattr(settings, "BROADCAST_BATCH_SIZE", 200)
+        self.concurrency = concurrency or getattr(settings, "BROADCAST_CONCURRENCY", 8)
+
+    def recipients(self):
+        """
+        :return: generator of the lists of TalkUsers that have not been sent the broadcast yet
+        """
+        users = self.broadcast.auth._users
+        if isinstance(users, list):
+            return
+        queryset = users.all()
+        if hasattr(queryset.model, "slack_auth"):
+            queryset = queryset.select_related("slack_auth")
+        cursor = self.broadcast.cursor
+        while True:
+            chunk = list(queryset.filter(pk__gt=cursor).order_by("pk")[:self.batch_size])
+            if not chunk:
+                return
+            yield chunk
+            cursor = chunk[-1].pk
+
+    def send(self, converse_user):
+        """
+        :return: None if the message was sent, otherwise the error
+        """
+        try:
+            if converse_user.messenger.send(self.broadcast.text):
+                return None
+            return "Unable to send the message"
+        except Exception as e:
+            logger.warning("Unable to send broadcast {} to {}".format(self.broadcast.pk, converse_user.pk),
+                           exc_info=True)
+            return repr(e)
+
+    def run(self):
+        """
+        :return: Broadcast, with the updated counters, unchanged if it is running or completed
+        """
+        broadcast = self.broadcast
+        # claimed atomically, so that a second sender finds it running
+        claimable = [Broadcast.PENDING, Broadcast.INTERRUPTED]
+        claimed = Broadcast.objects.filter(pk=broadcast.pk, status__in=claimable).update(status=Broadcast.RUNNING,
+                                                                                         updated=timezone.now())
+        if not claimed:
+            logger.info("Broadcast {} is already running or completed".format(broadcast.pk))
+            return broadcast
+        broadcast.status = Broadcast.RUNNING
+        pool = ThreadPool(self.concurrency)
+        try:
+            for chunk in self.recipients():
+                errors = pool.map(self.send, chunk)
+                failures = [BroadcastFailure(broadcast=broadcast, converse_user=converse_user, error=error)
+                            for converse_user, error in zip(chunk, errors) if error is not None]
+                broadcast.cursor = chunk[-1].pk
+                broadcast.failed += len(failures)
+                broadcast.sent += len(chunk) - len(failures)
+                with transaction.atomic():
+                    BroadcastFailure.objects.bulk_create(failures)
+                    broadcast.save(update_fields=["cursor", "sent", "failed", "updated"])
+                logger.info("Broadcast {}: {:.0%} done, {} sent, {} failed".format(
+                    broadcast.pk, broadcast.progress, broadcast.sent, broadcast.failed))
+        except Exception:
+            # resumable from the last chunk saved
+            broadcast.status = Broadcast.INTERRUPTED
+            broadcast.save(update_fields=["status", "updated"])
+            raise
+        finally:
+            pool.close()
+            pool.join()
+        broadcast.status = Broadcast.COMPLETED
+        broadcast.save(update_fields=["status", "updated"])
+        return broadcast
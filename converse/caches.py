@@ -0,0 +1,342 @@
+import logging
+import threading
+import time
+from collections import OrderedDict
+from pydoc import locate
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db.models.signals import post_save, post_delete
+from django.dispatch.dispatcher import receiver
+
+from converse.messengers import SlackMessenger
+from converse.models import SlackAuth, SlackUser, AbstractUser
+
+logger = logging.getLogger(__name__)
+
+
+class TTLCache(object):
+    """
+    A thread safe mapping bounded to `maxsize` entries, each of which expires `ttl` seconds after it was set. When the
+    cache is full, the least recently used entry is evicted. Hits and misses are counted, see `stats`.
+    """
+
+    def __init__(self, maxsize=256, ttl=300, timer=time.time):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.timer = timer
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                expires, value = self._data.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            if expires <= self.timer():
+                self.misses += 1
+                return default
+            self._data[key] = (expires, value)
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._data.pop(key, None)
+            while len(self._data) >= self.maxsize:
+                self._data.popitem(last=False)
+            self._data[key] = (self.timer() + self.ttl, value)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "size": len(self._data), "maxsize": self.maxsize}
+
+    def __len__(self):
+        return len(self._data)
+
+
+slack_auth_cache = TTLCache(maxsize=getattr(settings, "SLACK_AUTH_CACHE_SIZE", 256),
+                            ttl=getattr(settings, "SLACK_AUTH_CACHE_TTL", 300))
+
+
+def get_slack_auth(team_id):
+    """
+    Returns the SlackAuth of the team, from the process local cache if possible.
+    :raises SlackAuth.DoesNotExist: if the team has not authenticated the bot
+    """
+    slack_auth = slack_auth_cache.get(team_id)
+    if slack_auth is None:
+        slack_auth = SlackAuth.objects.get(team_id=team_id)
+        slack_auth_cache.set(team_id, slack_auth)
+    return slack_auth
+
+
+def get_slack_auths(team_ids):
+    """
+    Bulk version of `get_slack_auth`, loading the teams missing from the cache with one query
+    :return: dict of team id to SlackAuth, without the teams that have not authenticated the bot
+    """
+    slack_auths = {}
+    missing = []
+    for team_id in team_ids:
+        slack_auth = slack_auth_cache.get(team_id)
+        if slack_auth is None:
+            missing.append(team_id)
+        else:
+            slack_auths[team_id] = slack_auth
+    if missing:
+        for slack_auth in SlackAuth.objects.filter(team_id__in=missing):
+            slack_auth_cache.set(slack_auth.team_id, slack_auth)
+            slack_auths[slack_auth.team_id] = slack_auth
+    return slack_auths
+
+
+def invalidate_slack_auth(team_id):
+    """
+    Drops the cached SlackAuth of the team from this process. Other processes pick up the change once their entry
+    expires, after at most SLACK_AUTH_CACHE_TTL seconds.
+    """
+    slack_auth_cache.delete(team_id)
+
+
+@receiver([post_save, post_delete], sender=SlackAuth, dispatch_uid="invalidate slack auth cache")
+def slack_auth_changed(sender, instance, **kwargs):
+    invalidate_slack_auth(instance.team_id)
+
+
+class ConverseIdentity(object):
+    """
+    Everything needed to handle an event from a Slack user, so that a known user can be served without any queries
+    """
+
+    def __init__(self, team_id, slack_id, talk_user_id, channel, app_user_id):
+        self.team_id = team_id
+        self.slack_id = slack_id
+        self.talk_user_id = talk_user_id
+        self.channel = channel
+        self.app_user_id = app_user_id
+
+    @classmethod
+    def for_slack_user(cls, slack_user, slack_auth, app_user_id=None):
+        """
+        :param app_user_id: the primary key of the app user of the Slack user, looked up if not given
+        """
+        if app_user_id is None:
+            queryset = AbstractUser.implementation().objects.filter(converse_user=slack_user)
+            app_user_id = queryset.values_list("pk", flat=True).first()
+        return cls(team_id=slack_auth.team_id, slack_id=slack_user.slack_id, talk_user_id=slack_user.pk,
+                   channel=slack_user.slack_channel or slack_user.slack_id, app_user_id=app_user_id)
+
+    @property
+    def session_id(self):
+        return self.team_id + "-" + self.slack_id
+
+    @property
+    def messenger(self):
+        return SlackMessenger(get_slack_auth(self.team_id).bot_access_token, self.channel)
+
+    def get_app_user(self):
+        return AbstractUser.implementation().objects.select_converse().get(pk=self.app_user_id)
+
+    def __unicode__(self):
+        return self.session_id
+
+
+class LocalIdentityBackend(object):
+    """Keeps the identities in a process local LRU cache"""
+
+    def __init__(self, maxsize, ttl):
+        self.cache = TTLCache(maxsize=maxsize, ttl=ttl)
+
+    def get(self, key):
+        return self.cache.get(key)
+
+    def set(self, key, identity):
+        self.cache.set(key, identity)
+
+    def get_many(self, keys):
+        identities = {}
+        for key in keys:
+            identity = self.cache.get(key)
+            if identity is not None:
+                identities[key] = identity
+        return identities
+
+    def delete_many(self, keys):
+        for key in keys:
+            self.cache.delete(key)
+
+
+class DjangoCacheIdentityBackend(object):
+    """Keeps the identities in a Django cache (`IDENTITY_CACHE_ALIAS`), shared between the workers"""
+
+    def __init__(self, maxsize, ttl):
+        self.ttl = ttl
+        self.alias = getattr(settings, "IDENTITY_CACHE_ALIAS", "default")
+
+    def get(self, key):
+        return caches[self.alias].get(key)
+
+    def set(self, key, identity):
+        caches[self.alias].set(key, identity, self.ttl)
+
+    def get_many(self, keys):
+        return caches[self.alias].get_many(keys)
+
+    def delete_many(self, keys):
+        caches[self.alias].delete_many(keys)
+
+
+class IdentityResolver(object):
+    """
+    Resolves (team_id, slack user id) to a ConverseIdentity, through a cache backend such as `LocalIdentityBackend` or
+    `DjangoCacheIdentityBackend`.
+    """
+
+    def __init__(self, backend):
+        self.backend = backend
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(team_id, slack_id):
+        return "converse:identity:{}:{}".format(team_id, slack_id)
+
+    def resolve(self, slack_auth, slack_id):
+        """
+        :return: ConverseIdentity, or None if the Slack user is not known yet
+        """
+        key = self.key(slack_auth.team_id, slack_id)
+        identity = self.backend.get(key)
+        if identity is not None:
+            self.hits += 1
+            return identity
+        self.misses += 1
+        try:
+            slack_user = SlackUser.objects.get(slack_auth=slack_auth, slack_id=slack_id)
+        except SlackUser.DoesNotExist:
+            return None
+        return self.add(slack_user, slack_auth)
+
+    def resolve_many(self, sessions):
+        """
+        Bulk version of `resolve`, loading the users missing from the cache with two queries
+        :param sessions: list of (SlackAuth, slack user id)
+        :return: dict of (team id, slack user id) to ConverseIdentity, without the Slack users that are not known yet
+        """
+        slack_auths = dict((slack_auth.pk, slack_auth) for slack_auth, _ in sessions)
+        keys = dict((self.key(slack_auth.team_id, slack_id), (slack_auth.team_id, slack_id))
+                    for slack_auth, slack_id in sessions)
+        cached = self.backend.get_many(list(keys))
+        identities = dict((keys[key], identity) for key, identity in cached.items())
+        self.hits += len(identities)
+        missing = set(session for session in keys.values() if session not in identities)
+        if not missing:
+            return identities
+        self.misses += len(missing)
+        slack_users = [slack_user for slack_user in SlackUser.objects.filter(
+            slack_auth__in=list(slack_auths), slack_id__in=set(slack_id for _, slack_id in missing))
+            if (slack_auths[slack_user.slack_auth_id].team_id, slack_user.slack_id) in missing]
+        app_user_ids = AbstractUser.implementation().objects.filter(converse_user__in=slack_users).converse_ids()
+        for slack_user in slack_users:
+            slack_auth = slack_auths[slack_user.slack_auth_id]
+            identity = ConverseIdentity.for_slack_user(slack_user, slack_auth, app_user_ids.get(slack_user.pk))
+            self.cache(identity)
+            identities[(slack_auth.team_id, slack_user.slack_id)] = identity
+        return identities
+
+    def add(self, slack_user, slack_auth):
+        identity = ConverseIdentity.for_slack_user(slack_user, slack_auth)
+        self.cache(identity)
+        return identity
+
+    def cache(self, identity):
+        """
+        Caches the identity, unless its app user is not created yet, so it is looked up again once it is
+        """
+        if identity.app_user_id is not None:
+            self.backend.set(self.key(identity.team_id, identity.slack_id), identity)
+
+    def invalidate(self, team_id, slack_ids):
+        self.backend.delete_many([self.key(team_id, slack_id) for slack_id in slack_ids])
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses}
+
+
+def _identity_backend():
+    backend_path = getattr(settings, "IDENTITY_CACHE_BACKEND", None)
+    backend_class = locate(backend_path) if backend_path else LocalIdentityBackend
+    return backend_class(maxsize=getattr(settings, "IDENTITY_CACHE_SIZE", 10000),
+                         ttl=getattr(settings, "IDENTITY_CACHE_TTL", 3600))
+
+
+identity_resolver = IdentityResolver(_identity_backend())
+
+
+@receiver([post_save, post_delete], sender=SlackUser, dispatch_uid="invalidate identity cache")
+def slack_user_changed(sender, instance, **kwargs):
+    identity_resolver.invalidate(instance.slack_auth.team_id, [instance.slack_id])
+
+
+class EventDeduplicator(object):
+    """
+    Remembers the ids of the events received in the last `ttl` seconds, so that the events retried by Slack are only
+    handled once. A process local TTLCache answers for the retries reaching the same process, and the Django cache
+    `cache_alias` (eg. memcached, redis or the database cache) is shared by all the processes, its atomic `add` deciding
+    which one handles an event. The shared cache is skipped, and the event handled, if it is unavailable.
+    """
+
+    def __init__(self, maxsize=10000, ttl=3600, cache_alias="default"):
+        self.local = TTLCache(maxsize=maxsize, ttl=ttl)
+        self.ttl = ttl
+        self.cache_alias = cache_alias
+
+    @staticmethod
+    def key(event_id):
+        return "converse:event:{}".format(event_id)
+
+    def is_duplicate(self, event_id):
+        """
+        Records the event as seen
+        :return: True if the event was seen before
+        """
+        key = self.key(event_id)
+        if self.local.get(key):
+            return True
+        self.local.set(key, True)
+        try:
+            return not caches[self.cache_alias].add(key, 1, self.ttl)
+        except Exception:
+            logger.warning("Unable to check event {} in the shared cache".format(event_id), exc_info=True)
+            return False
+
+    def forget(self, event_id):
+        """
+        Drops the event, so that a retry of it is handled, eg. when it could not be queued
+        """
+        key = self.key(event_id)
+        self.local.delete(key)
+        try:
+            caches[self.cache_alias].delete(key)
+        except Exception:
+            logger.warning("Unable to forget event {} in the shared cache".format(event_id), exc_info=True)
+
+
+event_deduplicator = EventDeduplicator(maxsize=getattr(settings, "EVENT_DEDUP_CACHE_SIZE", 10000),
+                                       ttl=getattr(settings, "EVENT_DEDUP_TTL", 3600),
+                                       cache_alias=getattr(settings, "EVENT_DEDUP_CACHE", "default"))
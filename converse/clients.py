@@ -0,0 +1,170 @@
+import json
+import os
+import threading
+import time
+
+import requests
+import six
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from requests.adapters import HTTPAdapter
+from slackclient import SlackClient
+
+from converse.compat import SlackRequest, set_api_requester
+from converse.ratelimits import SlackRateLimiter
+
+SLACK_API_URL = "https://slack.com/api/"
+
+
+def get_setting(name, default):
+    """
+    Reads an optional setting, falling back to `default` when Django settings are not configured, so that the
+    messengers can also be used outside of a Django project.
+    """
+    try:
+        return getattr(settings, name, default)
+    except ImproperlyConfigured:
+        return default
+
+
+def slack_api_url(method):
+    return get_setting("SLACK_API_URL", SLACK_API_URL) + method
+
+
+class SlackAPIRequest(SlackRequest):
+    """
+    A SlackRequest that posts to `settings.SLACK_API_URL` instead of the hard coded slack.com, so that the Web API can
+    be pointed at a local stand-in server, through the keep-alive session of a `SlackClientRegistry`. Calls wait for
+    the rate limiter of the registry, and calls answered with 429 are retried once the Retry-After delay has passed.
+    """
+
+    def __init__(self, registry):
+        super(SlackAPIRequest, self).__init__()
+        self.registry = registry
+
+    def do(self, token, request="?", post_data=None, domain=None, timeout=None):
+        post_data = post_data or {}
+        files = None
+        if request == "files.upload" and "file" in post_data:
+            files = {"file": post_data.pop("file")}
+        for key, value in list(post_data.items()):
+            if not isinstance(value, six.string_types):
+                post_data[key] = json.dumps(value)
+        post_data["token"] = token
+        headers = {"user-agent": self.get_user_agent()}
+        rate_limiter = self.registry.rate_limiter
+        attempt = 0
+        while True:
+            if rate_limiter is not None:
+                rate_limiter.acquire(token, request, post_data)
+            response = self.registry.session().post(slack_api_url(request), headers=headers, data=post_data,
+                                                    files=files, timeout=timeout)
+            if response.status_code != 429 or rate_limiter is None or attempt >= rate_limiter.max_retries:
+                return response
+            attempt += 1
+            rate_limiter.retry_after(token, request, post_data, int(response.headers.get("Retry-After", 1)))
+
+
+class SlackClientRegistry(object):
+    """
+    Shares one SlackClient per token between all the messengers, tasks and views of a process. All the clients post
+    through a single requests.Session, whose connection pool keeps the connections to the Slack API alive between
+    calls, so only the first call pays for the TCP and TLS handshakes.
+    Clients that are not used for `idle_timeout` seconds are dropped, and so are the pooled connections once the
+    registry has been idle for as long. The session is recreated in a forked child (eg. a celery worker), rather than
+    sharing the sockets of the parent process.
+    """
+
+    def __init__(self, pool_connections=10, pool_maxsize=10, idle_timeout=300, rate_limiter=None, timer=time.time):
+        self.pool_connections = pool_connections
+        self.pool_maxsize = pool_maxsize
+        self.idle_timeout = idle_timeout
+        self.rate_limiter = rate_limiter
+        self.timer = timer
+        self._clients = {}
+        self._lock = threading.Lock()
+        self._session = None
+        self._pid = None
+        self._last_request = 0
+        self._retired_requests = 0
+        self._retired_connections = 0
+
+    def get(self, token):
+        with self._lock:
+            now = self.timer()
+            for idle_token in [key for key, (_, last_used) in self._clients.items()
+                               if now - last_used > self.idle_timeout]:
+                del self._clients[idle_token]
+            if token in self._clients:
+                client = self._clients[token][0]
+            else:
+                client = SlackClient(token)
+                set_api_requester(client, SlackAPIRequest(self))
+            self._clients[token] = (client, now)
+            return client
+
+    def session(self):
+        with self._lock:
+            now = self.timer()
+            if self._session is not None and self._pid != os.getpid():
+                self._session = None
+            if self._session is not None and now - self._last_request > self.idle_timeout:
+                self._retire_session()
+            if self._session is None:
+                self._session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=self.pool_connections, pool_maxsize=self.pool_maxsize)
+                self._session.mount("https://", adapter)
+                self._session.mount("http://", adapter)
+                self._pid = os.getpid()
+            self._last_request = now
+            return self._session
+
+    def _retire_session(self):
+        requests_made, connections = self._pool_counts()
+        self._retired_requests += requests_made
+        self._retired_connections += connections
+        self._session.close()
+        self._session = None
+
+    def _pool_counts(self):
+        requests_made = 0
+        connections = 0
+        if self._session is not None:
+            adapters = set(self._session.adapters.values())
+            for adapter in adapters:
+                pools = adapter.poolmanager.pools
+                for key in pools.keys():
+                    pool = pools.get(key)
+                    if pool is not None:
+                        requests_made += pool.num_requests
+                        connections += pool.num_connections
+        return requests_made, connections
+
+    def stats(self):
+        """
+        :return: dict with the number of cached clients, the requests made, the connections opened for them, and the
+        requests that reused an open connection
+        """
+        with self._lock:
+            requests_made, connections = self._pool_counts()
+            requests_made += self._retired_requests
+            connections += self._retired_connections
+            return {"clients": len(self._clients), "requests": requests_made, "connections": connections,
+                    "reused": requests_made - connections}
+
+
+slack_rate_limiter = SlackRateLimiter(limits=get_setting("SLACK_RATE_LIMITS", None),
+                                      cache_alias=get_setting("SLACK_RATE_LIMIT_CACHE", "default"),
+                                      max_retries=get_setting("SLACK_RATE_LIMIT_RETRIES", 5))
+
+slack_clients = SlackClientRegistry(pool_connections=get_setting("SLACK_POOL_CONNECTIONS", 10),
+                                    pool_maxsize=get_setting("SLACK_POOL_MAXSIZE", 10),
+                                    idle_timeout=get_setting("SLACK_CLIENT_IDLE_TIMEOUT", 300),
+                                    rate_limiter=slack_rate_limiter)
+
+
+def slack_client(token):
+    """
+    :return: the shared SlackClient of the token
+    """
+    return slack_clients.get(token)
@@ -0,0 +1,34 @@
+"""
+The private APIs of the libraries converse hooks into, kept in one place so that an upgrade which changes them fails
+here, and in tests/test_compat.py, rather than deep in a request or a sync.
+"""
+try:
+    # slackclient 1.x posts the Web API calls through this class, there is no public way to replace it
+    from slackclient._slackrequest import SlackRequest
+except ImportError:
+    raise RuntimeError("This slackclient version has no slackclient._slackrequest.SlackRequest, install the version "
+                       "required by django-bot")
+
+
+def set_api_requester(client, api_requester):
+    """
+    Makes the client post its Web API calls through `api_requester`, a `SlackRequest`
+    :param client: SlackClient
+    :raises RuntimeError: if the client does not post through an api_requester
+    """
+    server = getattr(client, "server", None)
+    if not isinstance(getattr(server, "api_requester", None), SlackRequest):
+        raise RuntimeError("This slackclient version does not post through an api_requester, install the version "
+                           "required by django-bot")
+    server.api_requester = api_requester
+
+
+def insert_rows(model, objs, fields, using, return_id=False):
+    """
+    Inserts the objects into the table of `model` only, without the tables of its parents, through the private
+    `QuerySet._insert` of Django 1.8 to 1.11, which bulk_create and Model.save are implemented with
+    :param fields: the local concrete fields inserted
+    :param return_id: whether to return the primary key of the row, or the list of the primary keys where the database
+    can return the ids of a bulk insert
+    """
+    return model._base_manager._insert(objs, fields=fields, return_id=return_id, using=using)
@@ -1,10 +1,44 @@
 import abc
+import atexit
+import logging
+import os
+import threading
 from inspect import isclass
+from multiprocessing import TimeoutError
+from multiprocessing.pool import ThreadPool
+
+from celery.signals import worker_process_shutdown
+
+from converse.clients import get_setting
+from converse.tracing import span
+
+logger = logging.getLogger(__name__)
 
 
 class ExecutorInner:
-    def __init__(self, obj):
+    def __init__(self, obj, action=None, queue=None, timeout=None, concurrency=None, priority=None):
         self.obj = obj
+        self.action = action
+        self.queue = queue
+        self.timeout = timeout
+        self.concurrency = concurrency
+        self.priority = priority
+        self._pool = None
+        self._pid = None
+        self._lock = threading.Lock()
+        self.batcher = ActionBatcher(obj, action) if self.batchable else None
+
+    @property
+    def queued(self):
+        return self.queue is not None
+
+    @property
+    def batchable(self):
+        return isclass(self.obj) and issubclass(self.obj, BatchActionBase)
+
+    @property
+    def pooled(self):
+        return not self.queued and (self.timeout is not None or self.concurrency is not None)
 
     def __call__(self, user, params, contexts):
         if isclass(self.obj):
@@ -13,11 +47,134 @@ class ExecutorInner:
         else:
             return self.obj(user=user, params=params, contexts=contexts)
 
+    @property
+    def pool(self):
+        """
+        The threads running the action in this process, created on first use, and again in a forked process
+        """
+        with self._lock:
+            if self._pool is None or self._pid != os.getpid():
+                self._pool = ThreadPool(self.concurrency or get_setting("ACTION_POOL_SIZE", 4))
+                self._pid = os.getpid()
+            return self._pool
+
+    def _run_in_pool(self, user, params, contexts):
+        from django.db import connections
+
+        try:
+            return self(user, params, contexts)
+        except Exception:
+            logger.error("Action {} failed".format(self.action), exc_info=True)
+        finally:
+            # the connections of the pool threads are not closed by the request or task signals
+            connections.close_all()
+
+    def submit(self, user, params, contexts):
+        """
+        Runs the action in its own thread pool, and waits for up to `timeout` seconds for it to finish. An action that
+        takes longer keeps running in the pool, but the caller moves on.
+        :return: the result of the action, or None if it timed out
+        """
+        result = self.pool.apply_async(self._run_in_pool, (user, params, contexts))
+        try:
+            return result.get(self.timeout)
+        except TimeoutError:
+            logger.warning("Action {} did not finish within {} seconds".format(self.action, self.timeout))
+            return None
+
+    def enqueue(self, user, params, contexts):
+        """
+        Queues the action on `queue`, to be run by the `execute_action` task
+        :return: celery AsyncResult
+        """
+        from converse.tasks import execute_action
+
+        options = {"queue": self.queue}
+        if self.priority is not None:
+            options["priority"] = self.priority
+        if self.timeout is not None:
+            options["soft_time_limit"] = self.timeout
+            options["time_limit"] = self.timeout + get_setting("ACTION_TIME_LIMIT_GRACE", 5)
+        return execute_action.apply_async(args=(self.action, user.pk, params, contexts), **options)
+
+
+class ActionBatcher(object):
+    """
+    Collects the invocations of a `BatchActionBase` action in a process, and executes them with one call of
+    `execute_batch` once `batch_size` are pending, or `batch_wait` seconds after the first one, whichever comes first.
+    A full batch is executed by the caller adding its last invocation, otherwise by a timer thread, so a batch collects
+    the invocations of all the tasks run by the process in the meantime. The invocations still pending are also
+    executed when the process exits, see `flush_pending`.
+    """
+
+    def __init__(self, action_class, action=None):
+        """
+        :param action: the name of the action, which tags the action_batch spans
+        """
+        self.action_class = action_class
+        self.action = action
+        self._invocations = []
+        self._timer = None
+        self._lock = threading.Lock()
+        self._pid = os.getpid()
+
+    def add(self, invocation):
+        """
+        :param invocation: an instance of the action class
+        """
+        with self._lock:
+            if self._pid != os.getpid():
+                # forked: the pending invocations and the timer belong to the parent
+                self._invocations, self._timer = [], None
+                self._pid = os.getpid()
+            self._invocations.append(invocation)
+            full = len(self._invocations) >= self.action_class.batch_size
+            if not full and self._timer is None:
+                self._timer = threading.Timer(self.action_class.batch_wait, self._flush_in_timer)
+                self._timer.daemon = True
+                self._timer.start()
+        if full:
+            self.flush()
+
+    def flush(self):
+        """
+        Executes the pending invocations
+        :return: the number of invocations executed
+        :raises RuntimeError: when the batch failed, which is also logged
+        """
+        with self._lock:
+            invocations, self._invocations = self._invocations, []
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+        if not invocations:
+            return 0
+        try:
+            # a batch holds the invocations of any team
+            with span("action_batch", team_id=None, action=self.action):
+                self.action_class.execute_batch(invocations)
+        except Exception as e:
+            error = "Unable to execute a batch of {} {}".format(len(invocations), self.action_class.__name__)
+            logger.error(error, exc_info=True)
+            raise RuntimeError("{}: {!r}".format(error, e))
+        return len(invocations)
+
+    def _flush_in_timer(self):
+        from django.db import connections
+
+        try:
+            self.flush()
+        except RuntimeError:
+            # logged by flush, there is no caller to report to
+            pass
+        finally:
+            connections.close_all()
+
 
 class Executor:
     action_map = {}
 
-    def __init__(self, action):
+    def __init__(self, action, queue=None, timeout=None, concurrency=None, priority=None):
         """
         A decorator class that identifies the action on which this object should be called. If the object decorated is
         a class, it should extend `ActionBase` and override the execute method.
@@ -27,18 +184,69 @@ class Executor:
         3. contexts: a dict (str: dict), the outer dict has keys as the name of the contexts the inner dict has
                      key-value pairs for params in these contexts
         When the decorated object is a class, these arguments are passed to the constructor instead
+        By default, the action runs in the task that parsed the message. With a `queue`, it is sent to that celery queue
+        instead, so a slow action does not hold the worker parsing the messages of the other users; params and contexts
+        must then be serializable, and the user is fetched again by primary key. Otherwise, the invocations of a
+        `BatchActionBase` are collected and executed in batches, and an action with a `timeout` or a `concurrency` runs
+        in a thread pool of its own.
         :param action: The name of the action
+        :param queue: the celery queue of the `execute_action` tasks of the action
+        :param timeout: seconds the action may run for: the soft time limit of its task, or how long the caller waits
+        for the thread pool
+        :param concurrency: maximum number of runs of the action at once, across the workers when it is queued,
+        otherwise the number of threads of its pool
+        :param priority: the celery priority of the tasks of the action, 0-9 on RabbitMQ (higher first)
         """
         self.action = action
+        self.options = {"queue": queue, "timeout": timeout, "concurrency": concurrency, "priority": priority}
 
     def __call__(self, obj, *args, **kwargs):
-        self.action_map[self.action] = ExecutorInner(obj)
+        self.action_map[self.action] = ExecutorInner(obj, action=self.action, **self.options)
         return self.action_map[self.action]
 
     @classmethod
     def execute(cls, action, user, params, contexts):
-        if action in cls.action_map:
-            return cls.action_map[action](user, params, contexts)
+        """
+        Runs the action as configured by its decorator
+        :return: depends on how the action runs:
+            - inline: the return value of the action
+            - queued: the celery AsyncResult of its `execute_action` task, which may not have run yet
+            - batched: None, the invocation is executed with its batch later on
+            - pooled: the return value of the action, or None if it did not finish within `timeout`, in which case it
+              keeps running in its pool
+            - None if no action has this name
+        """
+        if action not in cls.action_map:
+            return None
+        executor = cls.action_map[action]
+        # the queued and batched actions are timed where they run, as the queued_action and action_batch stages
+        if executor.queued:
+            return executor.enqueue(user, params, contexts)
+        if executor.batchable:
+            return executor.batcher.add(executor.obj(user=user, params=params, contexts=contexts))
+        with span("action", action=action):
+            if executor.pooled:
+                return executor.submit(user, params, contexts)
+            return executor(user, params, contexts)
+
+    @classmethod
+    def flush(cls):
+        """
+        Executes the pending invocations of all the batchable actions
+        :return: the number of invocations executed
+        :raises RuntimeError: when any of the batches failed, once all of them were executed
+        """
+        executed = 0
+        errors = []
+        for executor in cls.action_map.values():
+            if executor.batchable:
+                try:
+                    executed += executor.batcher.flush()
+                except RuntimeError as e:
+                    errors.append(str(e))
+        if errors:
+            raise RuntimeError("; ".join(errors))
+        return executed
 
 
 class ActionBase:
@@ -51,3 +259,40 @@ class ActionBase:
 
     def execute(self):
         pass
+
+
+class BatchActionBase(ActionBase):
+    """
+    An action whose invocations are executed together, see `ActionBatcher`. The invocations made by the tasks a worker
+    process runs within `batch_wait` seconds share a batch. Subclasses override `execute_batch`, eg. to save the
+    objects of all the invocations with one `bulk_create`.
+    """
+    batch_size = 100
+    batch_wait = 0.1
+
+    @classmethod
+    def execute_batch(cls, invocations):
+        """
+        :param invocations: list of instances of the action, in the order they were invoked
+        """
+        for invocation in invocations:
+            invocation.execute()
+
+    def execute(self):
+        type(self).execute_batch([self])
+
+
+def flush_pending(**kwargs):
+    """
+    Executes the invocations still pending when the process exits. The children of the prefork pool exit with
+    os._exit, which skips the atexit handlers, hence worker_process_shutdown.
+    """
+    try:
+        Executor.flush()
+    except RuntimeError:
+        # logged by ActionBatcher.flush
+        pass
+
+
+atexit.register(flush_pending)
+worker_process_shutdown.connect(flush_pending, weak=False)
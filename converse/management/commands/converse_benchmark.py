@@ -0,0 +1,44 @@
+import io
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+
+from converse.benchmarks import MessageBenchmark, compare
+
+
+class Command(BaseCommand):
+    help = "Measures the messages per second and the latency of the handling of Slack messages, against local " \
+           "stand-ins for Slack and api.ai, and prints the results as JSON"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--messages", type=int, default=500, help="number of messages measured")
+        parser.add_argument("--users", type=int, default=10, help="number of users sending the messages")
+        parser.add_argument("--warmup", type=int, default=20, help="number of messages sent before measuring")
+        parser.add_argument("--slack-latency", type=float, default=0.0, help="seconds of each Slack API call")
+        parser.add_argument("--parser-latency", type=float, default=0.0, help="seconds of each api.ai query")
+        parser.add_argument("--concurrency", type=int, default=1,
+                            help="number of threads posting the messages, above 1 the rows of the team are committed "
+                                 "and deleted at the end")
+        parser.add_argument("--parser", default=None, help="the parser class, defaults to the api.ai parser")
+        parser.add_argument("--rate-limited", action="store_true",
+                            help="make the Slack calls wait for the rate limiter")
+        parser.add_argument("--output", default=None, help="file the JSON results are written to")
+        parser.add_argument("--baseline", default=None, help="JSON results of an earlier run to compare with")
+        parser.add_argument("--tolerance", type=float, default=0.2,
+                            help="fraction by which the results may be worse than the baseline")
+
+    def handle(self, *args, **options):
+        results = MessageBenchmark(messages=options["messages"], users=options["users"], warmup=options["warmup"],
+                                   slack_latency=options["slack_latency"], parser_latency=options["parser_latency"],
+                                   parser_path=options["parser"], rate_limited=options["rate_limited"],
+                                   concurrency=options["concurrency"]).run()
+        text = json.dumps(results, indent=2, sort_keys=True)
+        if options["output"]:
+            with io.open(options["output"], "w", encoding="utf-8") as f:
+                f.write(u"{}\n".format(text))
+        self.stdout.write(text)
+        if options["baseline"]:
+            with io.open(options["baseline"], encoding="utf-8") as f:
+                regressions = compare(results, json.load(f), options["tolerance"])
+            if regressions:
+                raise CommandError("Regressions against {}: {}".format(options["baseline"], "; ".join(regressions)))
@@ -0,0 +1,51 @@
+import io
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+
+from converse.benchmarks import TraceReplay, load_trace
+
+
+class Command(BaseCommand):
+    help = "Replays a JSONL trace of Slack event callbacks and interactive payloads into the webhook views, and " \
+           "prints the ingestion and end to end lags as JSON. The missing teams of the trace are created, so run it " \
+           "against a scratch database."
+
+    def add_arguments(self, parser):
+        parser.add_argument("trace", help="JSONL file, one event callback or interactive payload per line")
+        parser.add_argument("--speedup", type=float, default=1.0, help="factor applied to the recorded pace")
+        parser.add_argument("--rate", type=float, default=None,
+                            help="requests per second, ignoring the recorded timestamps")
+        parser.add_argument("--concurrency", type=int, default=8,
+                            help="number of threads posting the requests, 0 to post them from the replaying thread")
+        parser.add_argument("--queue", action="store_true",
+                            help="queue the tasks to the broker instead of running them in the posting threads, "
+                                 "requires --slack-url and --apiai-url, the URLs the workers are configured with")
+        parser.add_argument("--drain", type=float, default=5.0,
+                            help="seconds waited for the workers after the last request, with --queue")
+        parser.add_argument("--slack-url", default=None, help="the Slack API URL, defaults to a local stand-in")
+        parser.add_argument("--apiai-url", default=None, help="the api.ai URL, defaults to a local stand-in")
+        parser.add_argument("--parser", default=None, help="the parser class, defaults to the api.ai parser")
+        parser.add_argument("--rate-limited", action="store_true",
+                            help="make the Slack calls wait for the rate limiter")
+        parser.add_argument("--output", default=None, help="file the JSON results are written to")
+
+    def handle(self, *args, **options):
+        if options["speedup"] <= 0 or (options["rate"] is not None and options["rate"] <= 0):
+            raise CommandError("--speedup and --rate must be positive")
+        if options["queue"] and not (options["slack_url"] and options["apiai_url"]):
+            raise CommandError("--queue requires --slack-url and --apiai-url, as the workers do not use the stand-ins")
+        try:
+            records = load_trace(options["trace"])
+        except (IOError, ValueError, RuntimeError) as e:
+            raise CommandError("Unable to load {}: {}".format(options["trace"], e))
+        results = TraceReplay(records, speedup=options["speedup"], rate=options["rate"],
+                              concurrency=options["concurrency"], eager=not options["queue"],
+                              slack_url=options["slack_url"], apiai_url=options["apiai_url"],
+                              parser_path=options["parser"], rate_limited=options["rate_limited"],
+                              drain=options["drain"]).run()
+        text = json.dumps(results, indent=2, sort_keys=True)
+        if options["output"]:
+            with io.open(options["output"], "w", encoding="utf-8") as f:
+                f.write(u"{}\n".format(text))
+        self.stdout.write(text)
@@ -1,19 +1,89 @@
 import abc
 import json
 import logging
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
 
-from slackclient import SlackClient
+from converse.clients import slack_client
+from converse.tracing import span
 
 logger = logging.getLogger(__name__)
 
+_local = threading.local()
+
+
+@contextmanager
+def coalesce_messages(enabled=True):
+    """
+    Buffers the messages sent by the messengers of the current thread, and sends them once the block exits, combining
+    the messages to the same channel into as few API calls as possible. While buffered, the send methods return True;
+    failures are logged when the buffer is flushed, and do not keep the other messengers from flushing. Nested blocks
+    are flushed with the outermost one. When the block raises, the buffered messages are dropped, and the error is
+    raised as is.
+    :param enabled: when False, messages are sent immediately
+    """
+    if not enabled or getattr(_local, "buffer", None) is not None:
+        yield
+        return
+    _local.buffer = OrderedDict()
+    try:
+        yield
+    finally:
+        buffer, _local.buffer = _local.buffer, None
+    # only reached when the block succeeded
+    for messenger, messages in buffer.values():
+        try:
+            messenger.flush(messages)
+        except Exception:
+            logger.error("Unable to flush {} messages of {}".format(len(messages), messenger), exc_info=True)
+
 
 class QuickReply:
-    def __init__(self, text, value=None):
+    # prefix of the button names that carry the action of a quick reply
+    ACTION_PREFIX = "converse.action:"
+
+    def __init__(self, text, value=None, action=None, params=None):
+        """
+        :param text: the label of the button
+        :param value: the query sent to the parser when the button is clicked, defaults to the text
+        :param action: if given, a click executes this action with `params` directly, without parsing the value
+        :param params: dict (str: str) of parameters passed to the action
+        """
         self.text = text
         self.value = value or text
+        self.action = action
+        self.params = params or {}
+
+    @property
+    def name(self):
+        """
+        The name of the button, which encodes the action and params of the quick reply if it has any
+        """
+        if self.action is None:
+            return self.value
+        return self.ACTION_PREFIX + json.dumps({"action": self.action, "params": self.params}, sort_keys=True)
+
+    @classmethod
+    def from_button(cls, button):
+        """
+        :param button: dict, an action of a Slack attachment, or the action of an interactive message request
+        :return: QuickReply
+        """
+        quick_reply = cls(text=button.get("text"), value=button["value"])
+        name = button.get("name") or ""
+        if name.startswith(cls.ACTION_PREFIX):
+            try:
+                route = json.loads(name[len(cls.ACTION_PREFIX):])
+                quick_reply.action = route["action"]
+                quick_reply.params = route["params"]
+            except (ValueError, KeyError):
+                logger.warning("Invalid quick reply action: {}".format(name))
+        return quick_reply
 
     def __eq__(self, other):
-        return self.text == other.text and self.value == other.value
+        return self.text == other.text and self.value == other.value and self.action == other.action and \
+            self.params == other.params
 
     def __unicode__(self):
         return "{} - {}".format(self.text, self.value)
@@ -57,28 +127,58 @@ class MessengerBase:
         """
         pass
 
+    def flush(self, messages):
+        """
+        Send the messages buffered by `coalesce_messages` for the conversation of this messenger
+        :param messages: list of messages, in the order they were sent
+        """
+        pass
+
+    def buffer(self, key, message):
+        """
+        Buffers the message if `coalesce_messages` is active in this thread
+        :param key: identifies the conversation, messages with the same key are flushed together
+        :return: bool, true if the message was buffered
+        """
+        buffer = getattr(_local, "buffer", None)
+        if buffer is None:
+            return False
+        if key not in buffer:
+            buffer[key] = (self, [])
+        buffer[key][1].append(message)
+        return True
+
 
 class SlackMessenger(MessengerBase):
+    # maximum number of attachments combined into one message
+    MAX_ATTACHMENTS = 20
+
     def __init__(self, token, channel):
         super(SlackMessenger, self).__init__()
         self.channel = channel
-        self.sc = SlackClient(token)
+        self.sc = slack_client(token)
 
     def send(self, text):
         return self.send_to_slack(text=text)
 
     def send_image(self, image_url, quick_replies=None):
+        return self.send_to_slack(attachment=self.image_attachment(image_url, quick_replies))
+
+    def send_text(self, text, quick_replies=None):
+        return self.send_to_slack(attachment=self.text_attachment(text, quick_replies))
+
+    def image_attachment(self, image_url, quick_replies=None):
         attachment = {"fallback": "image", "image_url": image_url, "callback_id": self.channel}
         if quick_replies:
             attachment["actions"] = self.format_quick_replies(quick_replies)
-        return self.send_to_slack(attachment=attachment)
+        return attachment
 
-    def send_text(self, text, quick_replies=None):
+    def text_attachment(self, text, quick_replies=None):
         attachment = {"fallback": "New message", "color": "#3AA3E3", "text": text, "mrkdwn_in": ["text"],
                       "callback_id": self.channel}
         if quick_replies:
             attachment["actions"] = self.format_quick_replies(quick_replies)
-        return self.send_to_slack(attachment=attachment)
+        return attachment
 
     def get_latest(self):
         message = self.sc.api_call("im.history", count=1, channel=self.channel)["messages"][0]
@@ -100,8 +200,7 @@ class SlackMessenger(MessengerBase):
             return None
         quick_reply_list = []
         for action_item in attachment["actions"]:
-            quick_reply = QuickReply(text=action_item["text"], value=action_item["value"])
-            quick_reply_list.append(quick_reply)
+            quick_reply_list.append(QuickReply.from_button(action_item))
         return quick_reply_list
 
     @staticmethod
@@ -109,7 +208,7 @@ class SlackMessenger(MessengerBase):
         quick_reply_list = []
         for quick_reply in quick_replies:
             quick_reply_list.append({
-                "name": quick_reply.value,
+                "name": quick_reply.name,
                 "text": quick_reply.text,
                 "type": "button",
                 "value": quick_reply.value
@@ -117,13 +216,38 @@ class SlackMessenger(MessengerBase):
         return quick_reply_list
 
     def send_to_slack(self, text=None, attachment=None):
+        if self.buffer((self.sc.token, self.channel), (text, attachment)):
+            return True
+        return self.post_message(text=text, attachments=[attachment] if attachment else None)
+
+    def flush(self, messages):
+        # the text of a Slack message is shown above its attachments, so a text following an attachment starts a new
+        # message to preserve the order
+        text_lines = []
+        attachments = []
+        for text, attachment in messages:
+            if (text and attachments) or (attachment and len(attachments) == self.MAX_ATTACHMENTS):
+                self.post_message(text="\n".join(text_lines), attachments=attachments)
+                text_lines = []
+                attachments = []
+            if text:
+                text_lines.append(text)
+            if attachment:
+                attachments.append(attachment)
+        if text_lines or attachments:
+            self.post_message(text="\n".join(text_lines), attachments=attachments)
+
+    def post_message(self, text=None, attachments=None):
+        with span("send"):
+            response = self.sc.api_call("chat.postMessage", **self.message_params(text, attachments))
+        if not response["ok"]:
+            logger.error("Unable to send message to {}: {}".format(self.channel, response.get("error")))
+        return response["ok"]
+
+    def message_params(self, text=None, attachments=None):
         params = {"channel": self.channel, "as_user": True, "mrkdwn": True}
-        if attachment:
-            params["attachments"] = json.dumps([attachment])
+        if attachments:
+            params["attachments"] = json.dumps(attachments)
         if text:
             params["text"] = text
-        response = self.sc.api_call("chat.postMessage", **params)
-        # logger.info(params)
-        if not response["ok"]:
-            logger.debug(response)
-        return response["ok"]
+        return params
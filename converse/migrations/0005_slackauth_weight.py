@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.1 on 2026-10-18 19:36
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('converse', '0004_broadcast'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='slackauth',
+            name='weight',
+            field=models.PositiveSmallIntegerField(default=1),
+        ),
+    ]
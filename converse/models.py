@@ -1,8 +1,9 @@
 from __future__ import unicode_literals
 
+from django.conf import settings
 from django.contrib.contenttypes.fields import GenericForeignKey
 from django.contrib.contenttypes.models import ContentType
-from django.db import models
+from django.db import models, transaction
 from django.utils.functional import cached_property
 from converse.messengers import SlackMessenger
 from django.db.models.signals import post_save
@@ -10,8 +11,49 @@ from django.dispatch.dispatcher import receiver
 import logging
 logger = logging.getLogger(__name__)
 
+# how the app models subclassing AbstractUser and AbstractOrganization refer to their TalkUser and Auth: "generic"
+# through a GenericForeignKey, or "direct" through a OneToOneField, which can be joined with select_related. Switching
+# changes the schema of the app models, see README
+APP_MODEL_LINKAGE = getattr(settings, "APP_MODEL_LINKAGE", "generic")
+if APP_MODEL_LINKAGE not in ("generic", "direct"):
+    raise RuntimeError("APP_MODEL_LINKAGE should be 'generic' or 'direct', not {}".format(APP_MODEL_LINKAGE))
+DIRECT_LINKAGE = APP_MODEL_LINKAGE == "direct"
+
+
+class AppOrgDescriptor(object):
+    """
+    `Auth.app_org` with the generic linkage, the reverse of the OneToOneField of the direct one. The organization is
+    kept on the Auth only when it is prefetched along with a queryset, eg. by `with_converse`, never on access, so the
+    Auths shared by the process, eg. by `converse.caches.slack_auth_cache`, hold no app objects.
+    """
+    cache_name = "_app_org_cache"
+
+    def __get__(self, instance, owner):
+        if instance is None:
+            return self
+        return AbstractOrganization.implementation().for_converse_org(instance)
+
+    def is_cached(self, instance):
+        return hasattr(instance, self.cache_name)
+
+    def get_prefetch_queryset(self, instances, queryset=None):
+        """
+        Loads the organizations of the Auths with one query, see `prefetch_related`
+        :raises RuntimeError: if a custom queryset is given, like the generic foreign key
+        """
+        if queryset is not None:
+            raise RuntimeError("A custom queryset can't be used to prefetch app_org")
+        auths = dict((auth.pk, auth) for auth in instances)
+        app_orgs = list(AbstractOrganization.implementation().objects.filter(converse_org__in=instances))
+        for app_org in app_orgs:
+            app_org._converse_org = auths[app_org.object_id]
+        return app_orgs, lambda app_org: app_org.object_id, lambda auth: auth.pk, True, self.cache_name
+
 
 class Auth(models.Model):
+    if not DIRECT_LINKAGE:
+        app_org = AppOrgDescriptor()
+
     @cached_property
     def messenger(self):
         if hasattr(self, "slackauth"):
@@ -20,10 +62,9 @@ class Auth(models.Model):
 
     @property
     def users(self):
-        converse_users = self._users
-        AppUser = AbstractUser.implementation()
-        return AppUser.objects.filter(content_type_id=ContentType.objects.get_for_model(converse_users.first()).pk,
-                                      object_id__in=[converse_user.pk for converse_user in converse_users.all()])
+        users = self._users
+        return AbstractUser.implementation().objects.filter(
+            converse_user__in=users if isinstance(users, list) else users.all()).with_converse()
 
     @property
     def _users(self):
@@ -43,6 +84,21 @@ class Auth(models.Model):
             return self.slackauth.name
         return None
 
+    def broadcast(self, text):
+        """
+        Sends the text to every user of the organization in the background, once the current transaction is
+        committed, see `converse.broadcasts`
+        :return: Broadcast, which reports the progress and the failures of the delivery
+        """
+        from converse.tasks import send_broadcast
+        users = self._users
+        total = 0 if isinstance(users, list) else users.count()
+        broadcast = Broadcast.objects.create(auth=self, text=text, total=total)
+        pk = broadcast.pk
+        # the worker could otherwise look the broadcast up before it is committed
+        transaction.on_commit(lambda: send_broadcast.delay(pk))
+        return broadcast
+
 
 class SlackAuth(Auth):
     access_token = models.CharField(max_length=200)
@@ -50,6 +106,8 @@ class SlackAuth(Auth):
     team_name = models.CharField(max_length=200)
     bot_id = models.CharField(max_length=30)
     bot_access_token = models.CharField(max_length=200)
+    # share of the workers given to the team relative to the other teams, see `converse.scheduling`
+    weight = models.PositiveSmallIntegerField(default=1)
 
     @cached_property
     def messenger(self):
@@ -80,7 +138,7 @@ class Group(models.Model):
 
     @property
     def org(self):
-        return AbstractOrganization.implementation().objects.get(converse_org=self._org)
+        return AbstractOrganization.implementation().for_converse_org(self._org)
 
     @property
     def _org(self):
@@ -147,7 +205,7 @@ class TalkUser(models.Model):
 
     @property
     def org(self):
-        return AbstractOrganization.implementation().objects.get(converse_org=self._org)
+        return AbstractOrganization.implementation().for_converse_org(self._org)
 
     @property
     def _org(self):
@@ -196,21 +254,165 @@ class SlackUser(TalkUser):
         unique_together = ('slack_id', 'slack_auth')
 
 
-class AbstractUserQuerySet(models.QuerySet):
-    def get(self, *args, **kwargs):
-        converse_user = kwargs.pop("converse_user", None)
-        if converse_user is not None:
-            kwargs["content_type_id"] = ContentType.objects.get_for_model(converse_user).pk
-            kwargs["object_id"] = converse_user.pk
-        return super(AbstractUserQuerySet, self).get(*args, **kwargs)
+class Broadcast(models.Model):
+    PENDING = "pending"
+    RUNNING = "running"
+    COMPLETED = "completed"
+    INTERRUPTED = "interrupted"
+    STATUS_CHOICES = ((PENDING, "Pending"), (RUNNING, "Running"), (COMPLETED, "Completed"),
+                      (INTERRUPTED, "Interrupted"))
+
+    auth = models.ForeignKey(to=Auth, related_name='broadcasts')
+    text = models.TextField()
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default=PENDING)
+    # the recipients are sent to in the order of their primary key, every one up to this one has been handled
+    cursor = models.PositiveIntegerField(default=0)
+    total = models.PositiveIntegerField(default=0)
+    sent = models.PositiveIntegerField(default=0)
+    failed = models.PositiveIntegerField(default=0)
+    created = models.DateTimeField(auto_now_add=True)
+    updated = models.DateTimeField(auto_now=True)
+
+    @property
+    def progress(self):
+        """
+        :return: float between 0 and 1, the fraction of the recipients handled
+        """
+        if not self.total:
+            return 1.0 if self.status == self.COMPLETED else 0.0
+        return min(float(self.sent + self.failed) / self.total, 1.0)
+
+    def resume(self, force=False):
+        """
+        Continues an interrupted broadcast from the first recipient that has not been handled yet, once the current
+        transaction is committed
+        :param force: whether to resume a broadcast which is still running, which must only be used when the worker
+        sending it died without marking it as interrupted
+        :raises RuntimeError: if the broadcast is running, and `force` is not set
+        """
+        from converse.tasks import send_broadcast
+        self.refresh_from_db(fields=["status"])
+        if self.status == self.RUNNING:
+            if not force:
+                raise RuntimeError("Broadcast {} is being sent, it cannot be resumed".format(self.pk))
+            Broadcast.objects.filter(pk=self.pk, status=self.RUNNING).update(status=self.INTERRUPTED)
+            self.status = self.INTERRUPTED
+        pk = self.pk
+        transaction.on_commit(lambda: send_broadcast.delay(pk))
+
+    def __unicode__(self):
+        return "{}: {} sent, {} failed of {}".format(self.status, self.sent, self.failed, self.total)
+
+
+class BroadcastFailure(models.Model):
+    broadcast = models.ForeignKey(to=Broadcast, related_name='failures')
+    converse_user = models.ForeignKey(to=TalkUser, related_name='broadcast_failures')
+    error = models.TextField()
+    created = models.DateTimeField(auto_now_add=True)
+
+    def __unicode__(self):
+        return "{}: {}".format(self.converse_user, self.error)
+
+
+class ConverseLinkQuerySet(models.QuerySet):
+    """
+    Filters the app models by their converse object, with `<link>=` or `<link>__in=`, whatever the linkage. With the
+    generic linkage, the lookups are translated to the content type and the object id, and the objects of `__in`
+    should all be of the same model.
+    """
+    link = None
+
+    def filter(self, *args, **kwargs):
+        return super(ConverseLinkQuerySet, self).filter(*args, **self._link_lookups(kwargs))
+
+    def exclude(self, *args, **kwargs):
+        return super(ConverseLinkQuerySet, self).exclude(*args, **self._link_lookups(kwargs))
+
+    def _link_lookups(self, kwargs):
+        if DIRECT_LINKAGE:
+            return kwargs
+        converse_object = kwargs.pop(self.link, None)
+        if converse_object is not None:
+            kwargs["content_type_id"] = ContentType.objects.get_for_model(converse_object).pk
+            kwargs["object_id"] = converse_object.pk
+        converse_objects = kwargs.pop(self.link + "__in", None)
+        if isinstance(converse_objects, models.QuerySet):
+            # filtered with a subquery rather than loaded
+            kwargs["content_type_id"] = ContentType.objects.get_for_model(converse_objects.model).pk
+            kwargs["object_id__in"] = converse_objects.values("pk")
+        elif converse_objects is not None:
+            converse_objects = list(converse_objects)
+            if converse_objects:
+                kwargs["content_type_id"] = ContentType.objects.get_for_model(converse_objects[0]).pk
+            kwargs["object_id__in"] = [converse_object.pk for converse_object in converse_objects]
+        return kwargs
+
+    def converse_ids(self):
+        """
+        :return: dict of the primary key of the converse object of each app object to the primary key of the app object
+        """
+        return dict(self.values_list(self.link + "_id" if DIRECT_LINKAGE else "object_id", "pk"))
+
+
+def _concrete_link(app_object, link, concrete_model):
+    """
+    With the direct linkage, loads the converse object of an app object as an instance of its concrete model, like the
+    generic foreign key does, with a single query unless it was joined by `select_converse`
+    :param link: the name of the OneToOneField
+    :param concrete_model: the subclass of TalkUser or Auth
+    """
+    if not getattr(type(app_object), link).is_cached(app_object):
+        converse_object = concrete_model.objects.filter(pk=getattr(app_object, link + "_id")).first()
+        if converse_object is not None:
+            setattr(app_object, link, converse_object)
+    converse_object = getattr(app_object, link)
+    child = concrete_model._meta.model_name
+    if not isinstance(converse_object, concrete_model) and hasattr(converse_object, child):
+        return getattr(converse_object, child)
+    return converse_object
+
+
+class AbstractUserQuerySet(ConverseLinkQuerySet):
+    link = "converse_user"
+
+    def select_converse(self):
+        """
+        Joins the TalkUser, the SlackUser, its SlackAuth and the app organization, so that `messenger`, `org` and the
+        other attributes of the users need no further queries. Only the direct linkage can be joined.
+        """
+        if not DIRECT_LINKAGE:
+            return self
+        return self.select_related("converse_user__slackuser__slack_auth__app_org")
+
+    def with_converse(self):
+        """
+        Loads the converse users of a page of users along with them, in a constant number of queries, so that
+        `messenger`, `name`, `org` and the other attributes resolve from memory: one joined query with the direct
+        linkage, otherwise one query each for the users, their SlackUsers, their SlackAuths and the organizations of
+        these, shared by the users of a team.
+        """
+        if DIRECT_LINKAGE:
+            return self.select_converse()
+        return self.prefetch_related("_converse_user__slack_auth__app_org")
 
 
 class AbstractUser(models.Model):
     objects = AbstractUserQuerySet.as_manager()
 
-    content_type = models.ForeignKey(ContentType, on_delete=models.CASCADE)
-    object_id = models.PositiveIntegerField()
-    _converse_user = GenericForeignKey('content_type', 'object_id')
+    if DIRECT_LINKAGE:
+        converse_user = models.OneToOneField(TalkUser, on_delete=models.CASCADE, related_name="app_user")
+
+        @property
+        def _converse_user(self):
+            return _concrete_link(self, "converse_user", SlackUser)
+
+        @_converse_user.setter
+        def _converse_user(self, converse_user):
+            self.converse_user = converse_user
+    else:
+        content_type = models.ForeignKey(ContentType, on_delete=models.CASCADE)
+        object_id = models.PositiveIntegerField()
+        _converse_user = GenericForeignKey('content_type', 'object_id')
 
     def __getattr__(self, item):
         if not item.startswith('_'):
@@ -236,21 +438,27 @@ class AbstractUser(models.Model):
         abstract = True
 
 
-class AbstractOrganizationQuerySet(models.QuerySet):
-    def get(self, *args, **kwargs):
-        converse_org = kwargs.pop("converse_org", None)
-        if converse_org is not None:
-            kwargs["content_type_id"] = ContentType.objects.get_for_model(converse_org).pk
-            kwargs["object_id"] = converse_org.pk
-        return super(AbstractOrganizationQuerySet, self).get(*args, **kwargs)
+class AbstractOrganizationQuerySet(ConverseLinkQuerySet):
+    link = "converse_org"
 
 
 class AbstractOrganization(models.Model):
     objects = AbstractOrganizationQuerySet.as_manager()
 
-    content_type = models.ForeignKey(ContentType, on_delete=models.CASCADE)
-    object_id = models.PositiveIntegerField()
-    _converse_org = GenericForeignKey('content_type', 'object_id')
+    if DIRECT_LINKAGE:
+        converse_org = models.OneToOneField(Auth, on_delete=models.CASCADE, related_name="app_org")
+
+        @property
+        def _converse_org(self):
+            return _concrete_link(self, "converse_org", SlackAuth)
+
+        @_converse_org.setter
+        def _converse_org(self, converse_org):
+            self.converse_org = converse_org
+    else:
+        content_type = models.ForeignKey(ContentType, on_delete=models.CASCADE)
+        object_id = models.PositiveIntegerField()
+        _converse_org = GenericForeignKey('content_type', 'object_id')
 
     def __getattr__(self, item):
         if not item.startswith('_'):
@@ -269,6 +477,29 @@ class AbstractOrganization(models.Model):
             raise RuntimeError(error)
         return sub[0]
 
+    @classmethod
+    def for_converse_org(cls, converse_org):
+        """
+        :return: the organization of the Auth, from the Auth if it was loaded with it by `select_converse` or
+        `with_converse`, otherwise with a query. It is not kept on the Auth then, which may be shared by the process,
+        eg. by `converse.caches.slack_auth_cache`.
+        :raises DoesNotExist: if the Auth has no organization, whether it was loaded with it or not
+        """
+        descriptor = type(converse_org).app_org
+        if descriptor.is_cached(converse_org):
+            # None when the Auth was loaded without an organization
+            app_org = getattr(converse_org, descriptor.cache_name)
+            if app_org is None:
+                raise cls.DoesNotExist("Auth {} has no {}".format(converse_org.pk, cls.__name__))
+            return app_org
+        app_org = cls.objects.get(converse_org=converse_org)
+        if DIRECT_LINKAGE:
+            # the setter of the OneToOneField would also cache the organization on the Auth
+            setattr(app_org, cls._meta.get_field("converse_org").get_cache_name(), converse_org)
+        else:
+            app_org._converse_org = converse_org
+        return app_org
+
     def __unicode__(self):
         return self._converse_org.name
 
@@ -0,0 +1,336 @@
+"""
+An in-process natural language parser: a TF-IDF / nearest centroid intent classifier with dictionary based slot
+extraction, trained from a local training file or from an exported api.ai agent. NumPy is required, see the `nlu` extra
+(pip install django-bot[nlu]).
+"""
+import glob
+import io
+import json
+import os
+import re
+
+from django.conf import settings
+
+from converse.caches import TTLCache
+from converse.parsers import ParserBase, ParserResponse
+
+TOKEN_RE = re.compile(r"\$?\d+(?:\.\d+)?|[\w']+", re.UNICODE)
+NUMBER_RE = re.compile(r"-?\d+(?:\.\d+)?$")
+NUMBER_WORDS = {"one": 1, "two": 2, "three": 3, "four": 4, "five": 5, "six": 6, "seven": 7,
+                "eight": 8, "nine": 9, "ten": 10, "eleven": 11, "twelve": 12, "dozen": 12}
+NUMBER_ENTITY = "sys.number"
+
+
+def tokenize(text):
+    return TOKEN_RE.findall(text.lower())
+
+
+class Slot(object):
+    def __init__(self, name, entity, required=False, prompt=None):
+        """
+        :param name: the name of the parameter
+        :param entity: the name of the entity, or 'sys.number'
+        :param required: whether the action can only be executed once the slot is filled
+        :param prompt: the text asking the user for the value of the slot
+        """
+        self.name = name
+        self.entity = entity
+        self.required = required
+        self.prompt = prompt or "What is the {}?".format(name)
+
+
+class Intent(object):
+    def __init__(self, name, examples, action=None, slots=None, response=None, contexts=None):
+        """
+        :param examples: list of the texts of the intent
+        :param action: the action executed when all the required slots are filled
+        :param slots: list of Slot
+        :param response: the text sent to the user, in which '$name' is replaced by the value of the slot 'name'
+        :param contexts: list of the names of the contexts set by the intent
+        """
+        self.name = name
+        self.examples = examples
+        self.action = action
+        self.slots = slots or []
+        self.response = response
+        self.contexts = contexts or []
+
+    def missing_slots(self, params):
+        return [slot for slot in self.slots if slot.required and not params.get(slot.name)]
+
+    def format_response(self, params):
+        if not self.response:
+            return None
+        text = self.response
+        for name in sorted(params, key=len, reverse=True):
+            text = text.replace("$" + name, u"{}".format(params[name]))
+        return text
+
+
+class EntityExtractor(object):
+    """
+    Finds the entity values in a list of tokens, matching the longest synonym first
+    """
+
+    def __init__(self, entities):
+        """
+        :param entities: dict of entity name to a dict of canonical value to a list of synonyms
+        """
+        self.synonyms = {}
+        self.max_length = 1
+        for entity, values in entities.items():
+            for value, synonyms in values.items():
+                for synonym in set([value] + list(synonyms)):
+                    tokens = tuple(tokenize(synonym))
+                    if tokens:
+                        self.synonyms[tokens] = (entity, value)
+                        self.max_length = max(self.max_length, len(tokens))
+
+    def extract(self, tokens):
+        """
+        :return: (tokens with the entity mentions replaced by '@<entity>', list of (entity, value) in order)
+        """
+        replaced = []
+        found = []
+        i = 0
+        while i < len(tokens):
+            for length in range(min(self.max_length, len(tokens) - i), 0, -1):
+                match = self.synonyms.get(tuple(tokens[i:i + length]))
+                if match is not None:
+                    replaced.append("@" + match[0])
+                    found.append(match)
+                    i += length
+                    break
+            else:
+                number = parse_number(tokens[i])
+                if number is not None:
+                    replaced.append("@" + NUMBER_ENTITY)
+                    found.append((NUMBER_ENTITY, number))
+                else:
+                    replaced.append(tokens[i])
+                i += 1
+        return replaced, found
+
+
+def parse_number(token):
+    if NUMBER_RE.match(token.lstrip("$")):
+        number = float(token.lstrip("$"))
+        return int(number) if number.is_integer() else number
+    return NUMBER_WORDS.get(token)
+
+
+class IntentClassifier(object):
+    """
+    Scores a text against every intent with one matrix product: the texts are TF-IDF vectors of their unigrams and
+    bigrams, and each intent is the normalised centroid of the vectors of its examples.
+    """
+
+    def __init__(self, intents, entities=None):
+        import numpy
+        self.np = numpy
+        self.intents = intents
+        self.extractor = EntityExtractor(entities or {})
+        documents = []
+        labels = []
+        for index, intent in enumerate(intents):
+            for example in intent.examples:
+                documents.append(self.features(self.extractor.extract(tokenize(example))[0]))
+                labels.append(index)
+        self.vocabulary = {}
+        for features in documents:
+            for feature in features:
+                self.vocabulary.setdefault(feature, len(self.vocabulary))
+        counts = numpy.zeros((len(documents), len(self.vocabulary)))
+        for row, features in enumerate(documents):
+            for feature in features:
+                counts[row, self.vocabulary[feature]] += 1
+        document_frequency = (counts > 0).sum(axis=0)
+        self.idf = numpy.log((1.0 + len(documents)) / (1.0 + document_frequency)) + 1.0
+        vectors = self.normalize(counts * self.idf)
+        labels = numpy.array(labels, dtype=int)
+        self.weights = numpy.zeros((len(intents), len(self.vocabulary)))
+        for index in range(len(intents)):
+            rows = vectors[labels == index]
+            if len(rows):
+                self.weights[index] = rows.mean(axis=0)
+        self.weights = self.normalize(self.weights)
+
+    @staticmethod
+    def features(tokens):
+        return tokens + [a + " " + b for a, b in zip(tokens, tokens[1:])]
+
+    def normalize(self, matrix):
+        norms = self.np.linalg.norm(matrix, axis=-1, keepdims=True)
+        norms[norms == 0] = 1.0
+        return matrix / norms
+
+    def vectorize(self, tokens):
+        vector = self.np.zeros(len(self.vocabulary))
+        for feature in self.features(tokens):
+            index = self.vocabulary.get(feature)
+            if index is not None:
+                vector[index] += 1
+        return self.normalize(vector * self.idf)
+
+    def classify(self, text):
+        """
+        :return: (Intent, score between 0 and 1, list of the (entity, value) found in the text), the intent is None
+        if the classifier has no intents
+        """
+        tokens, entities = self.extractor.extract(tokenize(text))
+        if not self.intents:
+            return None, 0.0, entities
+        scores = self.weights.dot(self.vectorize(tokens))
+        best = int(scores.argmax())
+        return self.intents[best], float(scores[best]), entities
+
+
+def fill_slots(intent, params, entities):
+    """
+    Assigns the entity values found in a text to the unfilled slots of the intent, in order
+    """
+    entities = list(entities)
+    for slot in intent.slots:
+        if params.get(slot.name):
+            continue
+        for i, (entity, value) in enumerate(entities):
+            if entity == slot.entity:
+                params[slot.name] = value
+                del entities[i]
+                break
+    return params
+
+
+def load_training_file(path):
+    """
+    Reads a JSON training file:
+    {"intents": [{"name": "grocery.add", "action": "grocery.add", "examples": ["add 2 apples"],
+                  "parameters": [{"name": "item", "entity": "item", "required": true, "prompt": "What item?"}],
+                  "response": "Adding $quantity $item", "contexts": ["grocery"]}],
+     "entities": {"item": {"apple": ["apples"]}}}
+    :return: (list of Intent, dict of entities)
+    """
+    with io.open(path, encoding="utf-8") as f:
+        data = json.load(f)
+    intents = []
+    for intent in data.get("intents", []):
+        slots = [Slot(name=slot["name"], entity=slot["entity"].lstrip("@"), required=slot.get("required", False),
+                      prompt=slot.get("prompt")) for slot in intent.get("parameters", [])]
+        intents.append(Intent(name=intent["name"], examples=intent["examples"], action=intent.get("action"),
+                              slots=slots, response=intent.get("response"), contexts=intent.get("contexts")))
+    return intents, data.get("entities", {})
+
+
+def load_apiai_agent(path):
+    """
+    Reads the intents and entities of an agent exported from api.ai and extracted to the directory `path`
+    :return: (list of Intent, dict of entities)
+    """
+    entities = {}
+    for entity_path in glob.glob(os.path.join(path, "entities", "*.json")):
+        if entity_path.endswith("_entries_en.json"):
+            continue
+        with io.open(entity_path, encoding="utf-8") as f:
+            entity = json.load(f)
+        entries = entity.get("entries")
+        entries_path = entity_path[:-len(".json")] + "_entries_en.json"
+        if entries is None and os.path.exists(entries_path):
+            with io.open(entries_path, encoding="utf-8") as f:
+                entries = json.load(f)
+        entities[entity["name"]] = dict((entry["value"], entry.get("synonyms", [])) for entry in entries or [])
+    intents = []
+    for intent_path in sorted(glob.glob(os.path.join(path, "intents", "*.json"))):
+        if intent_path.endswith("_usersays_en.json"):
+            continue
+        with io.open(intent_path, encoding="utf-8") as f:
+            intent = json.load(f)
+        user_says = intent.get("userSays")
+        user_says_path = intent_path[:-len(".json")] + "_usersays_en.json"
+        if user_says is None and os.path.exists(user_says_path):
+            with io.open(user_says_path, encoding="utf-8") as f:
+                user_says = json.load(f)
+        examples = ["".join(part["text"] for part in example["data"]) for example in user_says or []]
+        response = (intent.get("responses") or [{}])[0]
+        slots = []
+        for parameter in response.get("parameters", []):
+            prompts = parameter.get("prompts") or []
+            prompt = prompts[0] if prompts else None
+            if isinstance(prompt, dict):
+                prompt = prompt.get("value")
+            slots.append(Slot(name=parameter["name"], entity=parameter.get("dataType", "@sys.any").lstrip("@"),
+                              required=parameter.get("required", False), prompt=prompt))
+        speech = None
+        for message in response.get("messages", []):
+            speech = message.get("speech")
+            if speech:
+                speech = speech[0] if isinstance(speech, list) else speech
+                break
+        contexts = [context["name"] if isinstance(context, dict) else context
+                    for context in response.get("affectedContexts", [])]
+        intents.append(Intent(name=intent["name"], examples=examples, action=response.get("action"), slots=slots,
+                              response=speech, contexts=contexts))
+    return intents, entities
+
+
+_classifiers = {}
+
+
+def get_classifier(path):
+    """
+    :param path: a training file, or the directory of an exported api.ai agent
+    :return: the IntentClassifier trained from `path`, which is only trained once per process
+    """
+    if path not in _classifiers:
+        if os.path.isdir(path):
+            intents, entities = load_apiai_agent(path)
+        else:
+            intents, entities = load_training_file(path)
+        _classifiers[path] = IntentClassifier(intents, entities)
+    return _classifiers[path]
+
+
+class LocalIntentParser(ParserBase):
+    """
+    Parses the text in process, without any network round trip. The intent is the best match of the IntentClassifier
+    trained from `LOCAL_PARSER_TRAINING`, unless its score is below `LOCAL_PARSER_THRESHOLD`. Slots which are still
+    required are asked for, and the parameters collected so far are kept per session id, in the process, for up to
+    `LOCAL_PARSER_SESSION_TTL` seconds.
+    """
+    sessions = TTLCache(maxsize=getattr(settings, "LOCAL_PARSER_SESSIONS", 10000),
+                        ttl=getattr(settings, "LOCAL_PARSER_SESSION_TTL", 600))
+
+    def __init__(self, training=None, threshold=None):
+        self.classifier = get_classifier(training or settings.LOCAL_PARSER_TRAINING)
+        self.threshold = threshold if threshold is not None else getattr(settings, "LOCAL_PARSER_THRESHOLD", 0.2)
+        self.fallback = getattr(settings, "LOCAL_PARSER_FALLBACK", "Sorry, I did not understand that.")
+
+    def parse(self, query, session_id):
+        intent, score, entities = self.classifier.classify(query)
+        pending = self.sessions.get(session_id)
+        if pending is not None:
+            pending_intent, params = pending
+            missing = [slot.name for slot in pending_intent.missing_slots(params)]
+            filled = fill_slots(pending_intent, dict(params), entities)
+            if intent is pending_intent or score < self.threshold or any(filled.get(name) for name in missing):
+                return self.respond(pending_intent, filled, session_id)
+        if intent is None or score < self.threshold:
+            self.sessions.delete(session_id)
+            response = ParserResponse()
+            response.text = self.fallback
+            return response
+        return self.respond(intent, fill_slots(intent, {}, entities), session_id)
+
+    def respond(self, intent, params, session_id):
+        response = ParserResponse()
+        response.action = intent.action
+        response.params = dict((slot.name, params.get(slot.name, "")) for slot in intent.slots)
+        response.contexts = dict((context, dict(response.params)) for context in intent.contexts)
+        missing = intent.missing_slots(params)
+        if missing:
+            self.sessions.set(session_id, (intent, params))
+            response.text = missing[0].prompt
+        else:
+            self.sessions.delete(session_id)
+            response.slot_filling_complete = True
+            response.text = intent.format_response(params)
+        return response
@@ -1,7 +1,25 @@
 import abc
-import json
-import apiai
+import logging
+import math
+import os
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from pydoc import locate
+
+import requests
 from django.conf import settings
+from django.db import connections
+from requests.adapters import HTTPAdapter
+from six.moves import queue
+
+from converse.clients import get_setting
+
+logger = logging.getLogger(__name__)
+
+API_AI_URL = "https://api.api.ai/v1/query?v=20150910"
+FALLBACK_TEXT = "Sorry, I am unable to respond right now. Please try again later."
 
 
 class ParserResponse:
@@ -31,6 +49,10 @@ class ParserResponse:
 class ParserBase:
     __metaclass__ = abc.ABCMeta
 
+    # whether the same query can be parsed twice concurrently for a session without altering the conversation, which
+    # allows ChainedParser to send hedged requests
+    idempotent = False
+
     def parse(self, query, session_id):
         """
         Parses the given text, and uses the session id to remember the conversation history (for context)
@@ -42,14 +64,32 @@ class ParserBase:
 
 
 class APIAIParser(ParserBase):
+    """
+    Queries api.ai through a keep-alive connection, which is reused by the following queries of the instance. Reuse the
+    instance, eg. through a `ParserPool`, to only set the connection up once.
+    """
+
     def __init__(self):
-        self.ai = apiai.ApiAI(settings.API_AI_CLIENT_TOKEN)
+        self.client_token = settings.API_AI_CLIENT_TOKEN
+        self.url = getattr(settings, "API_AI_URL", API_AI_URL)
+        self.timeout = getattr(settings, "API_AI_TIMEOUT", 10)
+        self.session = requests.Session()
+        self.session.mount("https://", HTTPAdapter(pool_connections=1, pool_maxsize=1))
+        self.session.mount("http://", HTTPAdapter(pool_connections=1, pool_maxsize=1))
+        self.session.headers.update({"Authorization": "Bearer " + self.client_token, "Accept": "application/json"})
 
     def parse(self, query, session_id):
-        request = self.ai.text_request()
-        request.session_id = session_id
-        request.query = query
-        response = json.loads(request.getresponse().read().decode())
+        response = self.session.post(self.url, json={"query": query, "lang": "en", "sessionId": session_id},
+                                     timeout=self.timeout)
+        response.raise_for_status()
+        return self.parse_response(response.json())
+
+    @staticmethod
+    def parse_response(response):
+        """
+        :param response: dict, the JSON response of the api.ai query endpoint
+        :return: ParserResponse
+        """
         contexts = {}
         for context in response["result"]["contexts"]:
             contexts[context["name"]] = context["parameters"]
@@ -60,3 +100,269 @@ class APIAIParser(ParserBase):
         parser_response.contexts = contexts
         parser_response.slot_filling_complete = not response["result"]["actionIncomplete"]
         return parser_response
+
+
+class ParserPool(object):
+    """
+    Keeps the parsers of a worker process for reuse, up to `maxsize` idle instances per parser class, so that the
+    clients and connections they set up are shared by the following messages. A parser is used by one thread at a time.
+    The instances are not shared with a forked child process.
+    """
+
+    def __init__(self, maxsize=8):
+        self.maxsize = maxsize
+        self._idle = {}
+        self._lock = threading.Lock()
+        self._pid = os.getpid()
+
+    @contextmanager
+    def parser(self, parser_class):
+        """
+        Lends an idle instance of `parser_class`, creating one if there is none
+        """
+        with self._lock:
+            if self._pid != os.getpid():
+                self._idle = {}
+                self._pid = os.getpid()
+            idle = self._idle.setdefault(parser_class, [])
+            parser = idle.pop() if idle else None
+        if parser is None:
+            parser = parser_class()
+        yield parser
+        with self._lock:
+            idle = self._idle.setdefault(parser_class, [])
+            if len(idle) < self.maxsize:
+                idle.append(parser)
+
+    def clear(self):
+        with self._lock:
+            self._idle = {}
+
+
+parser_pool = ParserPool(maxsize=get_setting("TEXT_PARSER_POOL_SIZE", 8))
+
+
+class ParserUnavailable(RuntimeError):
+    pass
+
+
+class CircuitBreaker(object):
+    """
+    Opens after `failure_threshold` consecutive failures, and then rejects the calls for `reset_timeout` seconds. After
+    that, a single trial call is let through: the breaker closes if it succeeds, and opens again if it fails.
+    """
+
+    def __init__(self, failure_threshold=5, reset_timeout=30, timer=time.time):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.timer = timer
+        self.failures = 0
+        self.opened_at = None
+        self._trial = False
+        self._lock = threading.Lock()
+
+    @property
+    def is_open(self):
+        return self.opened_at is not None
+
+    def allow(self):
+        with self._lock:
+            if self.opened_at is None:
+                return True
+            if not self._trial and self.timer() - self.opened_at >= self.reset_timeout:
+                self._trial = True
+                return True
+            return False
+
+    def release(self):
+        """
+        Gives back the trial call let through by `allow` when it could not be made, so that a later call is tried
+        """
+        with self._lock:
+            self._trial = False
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self._trial = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self._trial or self.failures >= self.failure_threshold:
+                self.opened_at = self.timer()
+                self._trial = False
+
+
+class LatencyTracker(object):
+    """
+    Keeps the latencies of the last `size` calls
+    """
+
+    def __init__(self, size=100):
+        self.latencies = deque(maxlen=size)
+        self._lock = threading.Lock()
+
+    def add(self, latency):
+        with self._lock:
+            self.latencies.append(latency)
+
+    def percentile(self, percent, min_samples=20):
+        """
+        :return: the latency under which `percent` of the calls completed, or None with less than `min_samples` calls
+        """
+        with self._lock:
+            latencies = sorted(self.latencies)
+        if not latencies or len(latencies) < min_samples:
+            return None
+        return latencies[max(int(math.ceil(percent / 100.0 * len(latencies))) - 1, 0)]
+
+
+class ChainedParser(object):
+    """
+    Calls a parser in a background thread, and gives up on it after `timeout` seconds. When `hedge_percentile` is set
+    and a call takes longer than that percentile of the recent calls, a second request is sent, and the first answer
+    is used. Calls are rejected without being made while the circuit breaker of the parser is open.
+    The threads given up on keep running until the parser returns, so at most `max_threads` calls are in flight at
+    once: calls over the limit are rejected, and requests are not hedged.
+    """
+
+    def __init__(self, parser_class, timeout=2.0, hedge_percentile=None, failure_threshold=5, reset_timeout=30,
+                 max_threads=8, timer=time.time):
+        """
+        :raises RuntimeError: if `hedge_percentile` is set for a parser which is not idempotent, as a hedged request
+            would be a second query in the session of the conversation
+        """
+        if hedge_percentile is not None and not getattr(parser_class, "idempotent", False):
+            raise RuntimeError("Unable to hedge the requests to {}, which is not idempotent".format(
+                parser_class.__name__))
+        self.parser_class = parser_class
+        self.timeout = timeout
+        self.hedge_percentile = hedge_percentile
+        self.max_threads = max_threads
+        self.breaker = CircuitBreaker(failure_threshold, reset_timeout, timer)
+        self.latencies = LatencyTracker()
+        self.timer = timer
+        self.in_flight = 0
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_setting(cls, setting):
+        """
+        :param setting: the dotted path of a parser class, or a dict with the path as 'parser' and the keyword
+        arguments of ChainedParser
+        """
+        if not isinstance(setting, dict):
+            setting = {"parser": setting}
+        kwargs = dict(setting)
+        parser_class = locate(kwargs.pop("parser"))
+        if parser_class is None:
+            raise RuntimeError("Unable to find the parser {}".format(setting["parser"]))
+        return cls(parser_class, **kwargs)
+
+    def hedge_delay(self):
+        if self.hedge_percentile is None:
+            return None
+        return self.latencies.percentile(self.hedge_percentile)
+
+    def _start(self, query, session_id, results):
+        """
+        :return: whether the call was started, False when `max_threads` calls are already in flight
+        """
+        with self._lock:
+            if self.in_flight >= self.max_threads:
+                return False
+            self.in_flight += 1
+
+        def run():
+            start = self.timer()
+            try:
+                with parser_pool.parser(self.parser_class) as parser:
+                    response = parser.parse(query, session_id)
+                results.put((True, response, self.timer() - start))
+            except Exception as e:
+                results.put((False, e, self.timer() - start))
+            finally:
+                connections.close_all()
+                with self._lock:
+                    self.in_flight -= 1
+
+        thread = threading.Thread(target=run)
+        thread.daemon = True
+        thread.start()
+        return True
+
+    def parse(self, query, session_id):
+        """
+        :raises ParserUnavailable: if the circuit breaker is open, or the parser failed or timed out
+        """
+        name = self.parser_class.__name__
+        if not self.breaker.allow():
+            raise ParserUnavailable("The circuit breaker of {} is open".format(name))
+        results = queue.Queue()
+        start = self.timer()
+        deadline = start + self.timeout
+        delay = self.hedge_delay()
+        hedge_at = start + delay if delay is not None and delay < self.timeout else None
+        if not self._start(query, session_id, results):
+            self.breaker.release()
+            raise ParserUnavailable("{} has {} calls in flight".format(name, self.max_threads))
+        pending = 1
+        error = "timed out after {} seconds".format(self.timeout)
+        while pending:
+            now = self.timer()
+            if now >= deadline:
+                break
+            try:
+                succeeded, value, latency = results.get(timeout=min(deadline, hedge_at or deadline) - now)
+            except queue.Empty:
+                if hedge_at is not None and self.timer() >= hedge_at:
+                    logger.debug("Sending a hedged request to {}".format(name))
+                    hedge_at = None
+                    pending += self._start(query, session_id, results)
+                continue
+            pending -= 1
+            if succeeded:
+                self.latencies.add(latency)
+                self.breaker.record_success()
+                return value
+            error = repr(value)
+            if not pending and hedge_at is not None:
+                # the first request failed before it was due for a hedge, so the hedge is sent now
+                hedge_at = None
+                pending += self._start(query, session_id, results)
+        self.breaker.record_failure()
+        raise ParserUnavailable("{} {}".format(name, error))
+
+
+class FallbackParser(ParserBase):
+    """
+    Tries the parsers of `PARSER_CHAIN` in order, each within its own timeout, and answers with
+    `PARSER_CHAIN_FALLBACK_TEXT` if none of them could parse the text, so the time spent parsing is bounded by the sum
+    of the timeouts. The circuit breakers and latencies are shared by the parsers of a process.
+    """
+    _chain = None
+
+    def __init__(self, chain=None, fallback_text=None):
+        """
+        :param chain: list of ChainedParser, defaults to the one configured in settings
+        """
+        self.chain = chain if chain is not None else self.default_chain()
+        self.fallback_text = fallback_text or getattr(settings, "PARSER_CHAIN_FALLBACK_TEXT", FALLBACK_TEXT)
+
+    @classmethod
+    def default_chain(cls):
+        if cls._chain is None:
+            cls._chain = [ChainedParser.from_setting(setting) for setting in settings.PARSER_CHAIN]
+        return cls._chain
+
+    def parse(self, query, session_id):
+        for chained_parser in self.chain:
+            try:
+                return chained_parser.parse(query, session_id)
+            except ParserUnavailable as e:
+                logger.warning("Falling back to the next parser: {}".format(e))
+        response = ParserResponse()
+        response.text = self.fallback_text
+        return response
@@ -0,0 +1,110 @@
+import hashlib
+import logging
+import time
+
+from django.core.cache import caches
+from django.core.cache.backends.locmem import LocMemCache
+from django.core.exceptions import ImproperlyConfigured
+
+logger = logging.getLogger(__name__)
+
+# calls per minute of the tiers documented at https://api.slack.com/docs/rate-limits
+TIER_1 = (1, 60)
+TIER_2 = (20, 60)
+TIER_3 = (50, 60)
+TIER_4 = (100, 60)
+
+SLACK_RATE_LIMITS = {
+    "channels.list": TIER_2,
+    "users.list": TIER_2,
+    "im.list": TIER_2,
+    "im.history": TIER_3,
+    "users.info": TIER_4,
+    # about one message per second and channel, with short bursts
+    "chat.postMessage": (5, 5),
+}
+
+# methods whose limit applies to each channel rather than to the whole team
+PER_CHANNEL_METHODS = ("chat.postMessage",)
+
+
+class SlackRateLimiter(object):
+    """
+    Token buckets per Slack team (identified by its token) and API method, sized by the tier of the method. The buckets
+    live in a Django cache, so that they are shared between the celery workers when the cache is (eg. memcached or
+    redis). Every bucket holds the calls allowed by the tier and is refilled at the end of each period; a call finding
+    its bucket empty waits for the refill instead of failing. When Slack answers with 429, the Retry-After delay is
+    recorded for the method, and all the workers hold their calls until it has passed.
+    """
+
+    def __init__(self, limits=None, cache_alias="default", max_retries=5, timer=time.time, sleep=time.sleep):
+        self.limits = dict(SLACK_RATE_LIMITS, **(limits or {}))
+        self.cache_alias = cache_alias
+        self.max_retries = max_retries
+        self.timer = timer
+        self.sleep = sleep
+        self._local_cache = None
+
+    def cache(self):
+        try:
+            return caches[self.cache_alias]
+        except ImproperlyConfigured:
+            # used outside of a Django project, the buckets are only shared within the process
+            if self._local_cache is None:
+                self._local_cache = LocMemCache("converse-ratelimits", {})
+            return self._local_cache
+
+    def key(self, token, method, params):
+        key = "converse:ratelimit:{}:{}".format(hashlib.sha1(token.encode("utf-8")).hexdigest()[:16], method)
+        if method in PER_CHANNEL_METHODS and params.get("channel"):
+            key += ":" + params["channel"]
+        return key
+
+    def acquire(self, token, method, params):
+        """
+        Blocks until a call to `method` is allowed for the team of `token`
+        :return: the number of seconds waited
+        """
+        waited = 0
+        while True:
+            delay = self.reserve(token, method, params)
+            if not delay:
+                return waited
+            logger.debug("Waiting {:.2f} seconds for the rate limit of {}".format(delay, method))
+            self.sleep(delay)
+            waited += delay
+
+    def reserve(self, token, method, params):
+        """
+        Takes a token from the bucket of `method` if one is available, without blocking
+        :return: 0 if the call can be made now, otherwise the number of seconds to wait before trying again
+        """
+        cache = self.cache()
+        key = self.key(token, method, params)
+        limit = self.limits.get(method)
+        while True:
+            now = self.timer()
+            retry_at = cache.get(key + ":retry")
+            if retry_at is not None and retry_at > now:
+                return retry_at - now
+            if limit is None:
+                return 0
+            calls, period = limit
+            window = int(now // period)
+            bucket = "{}:{}".format(key, window)
+            cache.add(bucket, 0, period * 2)
+            try:
+                used = cache.incr(bucket)
+            except ValueError:
+                # the bucket expired between add and incr
+                continue
+            if used <= calls:
+                return 0
+            return (window + 1) * period - now
+
+    def retry_after(self, token, method, params, seconds):
+        """
+        Records that Slack asked to hold the calls to `method` for `seconds`
+        """
+        logger.warning("Slack rate limited {}, retrying after {} seconds".format(method, seconds))
+        self.cache().set(self.key(token, method, params) + ":retry", self.timer() + seconds, seconds + 1)
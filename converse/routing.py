@@ -0,0 +1,89 @@
+import bisect
+import hashlib
+
+from django.conf import settings
+
+SESSION_QUEUE_PREFIX = "converse.session"
+
+
+def _hash(key):
+    return int(hashlib.md5(key.encode("utf-8")).hexdigest()[:16], 16)
+
+
+class HashRing(object):
+    """
+    Consistent hashing of keys onto nodes, each node being placed on the ring `replicas` times. When a node is added or
+    removed, only the keys of that node move.
+    """
+
+    def __init__(self, nodes, replicas=100):
+        self.nodes = list(nodes)
+        self._ring = sorted((_hash("{}#{}".format(node, i)), node) for node in self.nodes for i in range(replicas))
+        self._hashes = [point for point, _ in self._ring]
+
+    def get(self, key):
+        if not self._ring:
+            return None
+        index = bisect.bisect(self._hashes, _hash(key)) % len(self._ring)
+        return self._ring[index][1]
+
+
+def session_queues(count=None, prefix=None):
+    """
+    :return: the names of the session queues, which the workers should consume with a concurrency of 1
+    """
+    count = getattr(settings, "SESSION_QUEUES", 0) if count is None else count
+    prefix = prefix or getattr(settings, "SESSION_QUEUE_PREFIX", SESSION_QUEUE_PREFIX)
+    return ["{}.{}".format(prefix, i) for i in range(count)]
+
+
+def session_of_task(name, args, kwargs):
+    """
+    :return: (team_id, slack user id) of the event handled by the task, or None if the task does not handle an event
+    """
+    kwargs = kwargs or {}
+    if name == "converse.tasks.slack_message_event":
+        team_id = args[0] if args else kwargs["team_id"]
+        event = args[1] if len(args) > 1 else kwargs["event"]
+        return team_id, event["user"]
+    if name == "converse.tasks.slack_action_event":
+        action_event = args[0] if args else kwargs["action_event"]
+        return action_event["team"]["id"], action_event["user"]["id"]
+    return None
+
+
+class SessionRouter(object):
+    """
+    A celery router sending the events of a session (team id and Slack user) to the same one of `SESSION_QUEUES`
+    queues. When each queue is consumed by a single worker process, the messages of a user are handled one at a time,
+    in the order they were received, while different users are spread over all the queues.
+
+    settings.py:
+        SESSION_QUEUES = 8
+        CELERY_TASK_ROUTES = ('converse.routing.session_router',)
+    """
+
+    def __init__(self, queues=None):
+        self._queues = queues
+        self._ring = None
+
+    @property
+    def ring(self):
+        if self._ring is None:
+            self._ring = HashRing(self._queues if self._queues is not None else session_queues())
+        return self._ring
+
+    def queue_for(self, team_id, user_id):
+        return self.ring.get("{}-{}".format(team_id, user_id))
+
+    def __call__(self, name, args, kwargs, options, task=None, **kw):
+        session = session_of_task(name, args or (), kwargs)
+        if session is None:
+            return None
+        queue = self.queue_for(*session)
+        if queue is None:
+            return None
+        return {"queue": queue}
+
+
+session_router = SessionRouter()
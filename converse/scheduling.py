@@ -0,0 +1,163 @@
+import logging
+
+from django.conf import settings
+from django.core.cache import caches
+
+from converse.caches import get_slack_auth
+from converse.models import SlackAuth
+from converse.routing import session_router
+
+logger = logging.getLogger(__name__)
+
+
+def increment(cache, key, ttl):
+    """
+    :return: the value of the counter `key` after incrementing it, the counter is created with a timeout of `ttl`
+    """
+    cache.add(key, 0, ttl)
+    try:
+        return cache.incr(key)
+    except ValueError:
+        cache.set(key, 1, ttl)
+        return 1
+
+
+def decrement(cache, key, ttl):
+    try:
+        if cache.decr(key) < 0:
+            cache.set(key, 0, ttl)
+    except ValueError:
+        # the counter expired meanwhile
+        pass
+
+
+class TenantScheduler(object):
+    """
+    Caps the events of each team that are queued or running at once, so that one busy team cannot fill the queue in
+    front of the others. A team may have `concurrency` times the `weight` of its SlackAuth events in flight; the events
+    beyond that are sent to `overflow_queue`, which the workers consume besides the default queue, so they wait behind
+    each other rather than in front of the events of the other teams.
+    The depth of each team, the number of its events in flight, is counted in the Django cache `cache_alias`, shared by
+    the web processes and the workers. A counter expires `ttl` seconds after it was created, which recovers the slots of
+    the events lost by a crashed worker.
+    The events routed to a session queue by `router` are never overflowed: an event of the session sent to the overflow
+    queue could be handled before the events still waiting on the session queue.
+    """
+
+    def __init__(self, concurrency=None, overflow_queue="converse.overflow", cache_alias="default", ttl=300,
+                 router=None):
+        """
+        :param concurrency: events in flight per team of weight 1, or None to queue all the events directly
+        :param router: the celery router of the session queues, see `converse.routing.SessionRouter`
+        """
+        self.concurrency = concurrency
+        self.overflow_queue = overflow_queue
+        self.cache_alias = cache_alias
+        self.ttl = ttl
+        self.router = router
+
+    @property
+    def enabled(self):
+        return self.concurrency is not None
+
+    @staticmethod
+    def key(team_id):
+        return "converse:tenant:{}:depth".format(team_id)
+
+    def limit(self, team_id):
+        try:
+            weight = get_slack_auth(team_id).weight
+        except SlackAuth.DoesNotExist:
+            weight = 1
+        return self.concurrency * max(weight, 1)
+
+    def submit(self, team_id, task, *args):
+        """
+        Queues the task handling an event of the team. The task is called with `scheduled=True`, and should call
+        `release` once it is done.
+        :return: bool, false if the task was sent to the overflow queue
+        """
+        if not self.enabled:
+            task.delay(*args)
+            return True
+        depth = increment(caches[self.cache_alias], self.key(team_id), self.ttl)
+        options = {}
+        limit = self.limit(team_id)
+        if depth > limit:
+            if self.session_routed(task, args):
+                logger.info("Team {} has {} events in flight, over its limit of {}, keeping the event on its session "
+                            "queue".format(team_id, depth, limit))
+            else:
+                logger.info("Team {} has {} events in flight, over its limit of {}".format(team_id, depth, limit))
+                options["queue"] = self.overflow_queue
+        try:
+            task.apply_async(args=args, kwargs={"scheduled": True}, **options)
+        except Exception:
+            self.release(team_id)
+            raise
+        return "queue" not in options
+
+    def session_routed(self, task, args):
+        return self.router is not None and self.router(task.name, args, {"scheduled": True}, {}) is not None
+
+    def release(self, team_id):
+        """
+        Frees the slot of an event of the team once its task is done
+        """
+        decrement(caches[self.cache_alias], self.key(team_id), self.ttl)
+
+    def depth(self, team_id):
+        return caches[self.cache_alias].get(self.key(team_id)) or 0
+
+    def depths(self, team_ids=None):
+        """
+        :param team_ids: the teams to report, defaults to all the authenticated teams
+        :return: dict of team id to the number of its events in flight
+        """
+        if team_ids is None:
+            team_ids = SlackAuth.objects.values_list("team_id", flat=True)
+        team_ids = list(team_ids)
+        depths = caches[self.cache_alias].get_many([self.key(team_id) for team_id in team_ids])
+        return dict((team_id, max(depths.get(self.key(team_id)) or 0, 0)) for team_id in team_ids)
+
+
+tenant_scheduler = TenantScheduler(concurrency=getattr(settings, "TENANT_CONCURRENCY", None),
+                                   overflow_queue=getattr(settings, "TENANT_OVERFLOW_QUEUE", "converse.overflow"),
+                                   cache_alias=getattr(settings, "TENANT_SCHEDULER_CACHE", "default"),
+                                   ttl=getattr(settings, "TENANT_SCHEDULER_TTL", 300),
+                                   router=session_router)
+
+
+class ActionLimiter(object):
+    """
+    Caps the queued runs of each action at once, across the workers, see the `concurrency` option of `Executor`. The
+    runs are counted in the Django cache `cache_alias`, and a counter expires `ttl` seconds after it was created.
+    """
+
+    def __init__(self, cache_alias="default", ttl=300):
+        self.cache_alias = cache_alias
+        self.ttl = ttl
+
+    @staticmethod
+    def key(action):
+        return "converse:action:{}:running".format(action)
+
+    def acquire(self, action, limit):
+        """
+        :return: bool, true if the action may run, in which case `release` should be called once it is done
+        """
+        cache = caches[self.cache_alias]
+        if increment(cache, self.key(action), self.ttl) > limit:
+            decrement(cache, self.key(action), self.ttl)
+            return False
+        return True
+
+    def release(self, action):
+        decrement(caches[self.cache_alias], self.key(action), self.ttl)
+
+    def running(self, action):
+        return caches[self.cache_alias].get(self.key(action)) or 0
+
+
+action_limiter = ActionLimiter(cache_alias=getattr(settings, "ACTION_LIMITER_CACHE", "default"),
+                               ttl=getattr(settings, "ACTION_LIMITER_TTL", 300))
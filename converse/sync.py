@@ -0,0 +1,246 @@
+import logging
+
+from django.db import connections, router, transaction
+from django.db.models import Case, When, Value
+
+from converse.caches import identity_resolver
+from converse.compat import insert_rows
+from converse.models import SlackChannel, SlackUser, AbstractUser
+
+logger = logging.getLogger(__name__)
+
+SYNC_BATCH_SIZE = 500
+SLACK_PAGE_SIZE = 200
+
+
+class SyncResult(object):
+    def __init__(self):
+        self.created = 0
+        self.updated = 0
+        self.unchanged = 0
+
+    def add(self, other):
+        self.created += other.created
+        self.updated += other.updated
+        self.unchanged += other.unchanged
+
+    def as_dict(self):
+        return {"created": self.created, "updated": self.updated, "unchanged": self.unchanged}
+
+    def __unicode__(self):
+        return "Created: {}, Updated: {}, Unchanged: {}".format(self.created, self.updated, self.unchanged)
+
+
+class SlackDirectorySync(object):
+    """
+    Mirrors the channels and members of a Slack team into SlackChannel and SlackUser rows. The payload is consumed in
+    chunks of `batch_size`: the rows that already exist for a chunk are loaded with a single query and diffed in memory,
+    and only the difference is written back, using bulk inserts and updates. Memory use is bounded by the chunk size, so
+    the payload can be a generator streaming the pages of the Slack API (see `iter_slack_collection`).
+    Unlike SlackUser.objects.create, no post_save signal is sent, so the app user companion rows are bulk created here.
+    """
+
+    def __init__(self, slack_auth, batch_size=SYNC_BATCH_SIZE):
+        self.slack_auth = slack_auth
+        self.batch_size = batch_size
+
+    def sync_channels(self, channels):
+        """
+        :param channels: iterable of channel dicts, as returned by 'channels.list'
+        :return: SyncResult
+        """
+        result = SyncResult()
+        for chunk in chunked(channels, self.batch_size):
+            result.add(self._sync_channel_chunk(chunk))
+        return result
+
+    def sync_users(self, members, user_channel):
+        """
+        :param members: iterable of user dicts, as returned by 'users.list'
+        :param user_channel: dict (str: str) of slack user id to the id of the DM channel with the bot
+        :return: SyncResult
+        """
+        result = SyncResult()
+        members = (user for user in members
+                   if not user["is_bot"] and user["id"] != "USLACKBOT" and user["id"] in user_channel)
+        for chunk in chunked(members, self.batch_size):
+            result.add(self._sync_user_chunk(chunk, user_channel))
+        return result
+
+    def _sync_channel_chunk(self, channels):
+        queryset = SlackChannel.objects.filter(slack_auth=self.slack_auth,
+                                               slack_id__in=[channel["id"] for channel in channels])
+        existing = {}
+        for row in queryset.values("pk", "slack_id", "name", "is_main"):
+            existing[row["slack_id"]] = row
+        result = SyncResult()
+        to_create = []
+        to_update = []
+        for channel in channels:
+            values = {"name": channel["name"], "is_main": channel["is_general"]}
+            row = existing.get(channel["id"])
+            if row is None:
+                to_create.append(SlackChannel(slack_auth=self.slack_auth, slack_id=channel["id"], **values))
+                existing[channel["id"]] = dict(values, pk=None, slack_id=channel["id"])
+            elif row["pk"] is not None and _changed(row, values):
+                to_update.append((row["pk"], values))
+                row.update(values)
+            else:
+                result.unchanged += 1
+        with transaction.atomic(using=router.db_for_write(SlackChannel)):
+            _bulk_insert(SlackChannel, to_create, self.batch_size)
+            _bulk_update(SlackChannel, to_update, ["name", "is_main"], self.batch_size)
+        result.created = len(to_create)
+        result.updated = len(to_update)
+        return result
+
+    def _sync_user_chunk(self, members, user_channel):
+        queryset = SlackUser.objects.filter(slack_auth=self.slack_auth, slack_id__in=[user["id"] for user in members])
+        existing = {}
+        for row in queryset.values("pk", "slack_id", "name", "email", "slack_channel"):
+            existing[row["slack_id"]] = row
+        result = SyncResult()
+        to_create = []
+        to_update = []
+        for user in members:
+            values = {"email": user["profile"]["email"], "name": user["profile"]["real_name"],
+                      "slack_channel": user_channel[user["id"]]}
+            row = existing.get(user["id"])
+            if row is None:
+                to_create.append(SlackUser(slack_auth=self.slack_auth, slack_id=user["id"], **values))
+                existing[user["id"]] = dict(values, pk=None, slack_id=user["id"])
+            elif row["pk"] is not None and _changed(row, values):
+                to_update.append((row["pk"], values))
+                row.update(values)
+            else:
+                result.unchanged += 1
+        with transaction.atomic(using=router.db_for_write(SlackUser)):
+            _bulk_insert(SlackUser, to_create, self.batch_size)
+            _bulk_update(SlackUser, to_update, ["email", "name", "slack_channel"], self.batch_size)
+            self.create_app_users(to_create)
+        if to_update:
+            updated_pks = set(pk for pk, _ in to_update)
+            identity_resolver.invalidate(self.slack_auth.team_id,
+                                         [row["slack_id"] for row in existing.values() if row["pk"] in updated_pks])
+        result.created = len(to_create)
+        result.updated = len(to_update)
+        return result
+
+    def create_app_users(self, slack_users):
+        """
+        Bulk version of the `create_app_models` signal receiver, for users inserted without sending post_save
+        """
+        if not slack_users:
+            return
+        AppUser = AbstractUser.implementation()
+        AppUser.objects.bulk_create([AppUser(_converse_user=slack_user) for slack_user in slack_users],
+                                    batch_size=self.batch_size)
+
+
+def iter_slack_collection(sc, method, key, limit=SLACK_PAGE_SIZE, **kwargs):
+    """
+    Walks the cursor based pagination of a Slack Web API list method, yielding the items of one page at a time, so that
+    only a single page is held in memory.
+    :param sc: SlackClient
+    :param method: the list method, eg. 'users.list'
+    :param key: the key of the items in the response, eg. 'members'
+    :param limit: the number of items requested per page
+    :raises RuntimeError: when Slack returns an error for any of the pages
+    """
+    cursor = None
+    while True:
+        params = dict(kwargs, limit=limit)
+        if cursor:
+            params["cursor"] = cursor
+        response = sc.api_call(method, **params)
+        if not response["ok"]:
+            raise RuntimeError("Unable to call {}: {}".format(method, response.get("error")))
+        for item in response[key]:
+            yield item
+        cursor = response.get("response_metadata", {}).get("next_cursor")
+        if not cursor:
+            return
+
+
+def chunked(iterable, size):
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def _changed(row, values):
+    for key, value in values.items():
+        if row[key] != value:
+            return True
+    return False
+
+
+def _bulk_insert(model, objs, batch_size):
+    """
+    QuerySet.bulk_create does not support multi-table inheritance, so the rows are inserted one table at a time,
+    starting from the root of the inheritance chain. The primary keys of the root rows are read back in bulk where the
+    database supports it (PostgreSQL), and with one insert per row otherwise; the child tables are always bulk inserted.
+    """
+    if not objs:
+        return
+    using = router.db_for_write(model)
+    connection = connections[using]
+    chain = list(reversed(model._meta.get_parent_list())) + [model]
+    root = chain[0]
+    root_fields = [field for field in root._meta.local_concrete_fields if not field.primary_key]
+    if getattr(connection.features, "can_return_ids_from_bulk_insert", False):
+        for batch in chunked(objs, _batch_size(connection, root_fields, objs, batch_size)):
+            ids = insert_rows(root, batch, root_fields, using, return_id=True)
+            if not isinstance(ids, list):
+                ids = [ids]
+            for obj, pk in zip(batch, ids):
+                _set_pk(obj, chain, pk)
+    else:
+        for obj in objs:
+            _set_pk(obj, chain, insert_rows(root, [obj], root_fields, using, return_id=True))
+    for child in chain[1:]:
+        fields = child._meta.local_concrete_fields
+        for batch in chunked(objs, _batch_size(connection, fields, objs, batch_size)):
+            insert_rows(child, batch, fields, using)
+    for obj in objs:
+        obj._state.adding = False
+        obj._state.db = using
+
+
+def _set_pk(obj, chain, pk):
+    for klass in chain:
+        setattr(obj, klass._meta.pk.attname, pk)
+
+
+def _batch_size(connection, fields, objs, batch_size):
+    return max(min(batch_size, connection.ops.bulk_batch_size(fields, objs)), 1)
+
+
+def _bulk_update(model, rows, field_names, batch_size):
+    """
+    Updates many rows with a single UPDATE ... CASE WHEN statement per table and batch. Fields inherited from a parent
+    model are updated through the parent's table, which shares its primary key with the child.
+    :param rows: list of (pk, dict of field name to value)
+    """
+    if not rows:
+        return
+    using = router.db_for_write(model)
+    fields_by_model = {}
+    for name in field_names:
+        field = model._meta.get_field(name)
+        fields_by_model.setdefault(field.model._meta.concrete_model, []).append(field)
+    # every row binds its pk once for the IN clause, and a pk and a value for each CASE
+    params = [None] * (2 * len(field_names) + 1)
+    for batch in chunked(rows, _batch_size(connections[using], params, rows, batch_size)):
+        pks = [pk for pk, _ in batch]
+        for concrete_model, fields in fields_by_model.items():
+            updates = {}
+            for field in fields:
+                whens = [When(pk=pk, then=Value(values[field.name])) for pk, values in batch]
+                updates[field.attname] = Case(*whens, output_field=field)
+            concrete_model._base_manager.using(using).filter(pk__in=pks).update(**updates)
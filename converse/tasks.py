@@ -2,45 +2,94 @@ import logging
 from pydoc import locate
 
 from celery.app import shared_task
+from celery.exceptions import SoftTimeLimitExceeded
 from django.conf import settings
-from slackclient import SlackClient
 
+from converse.broadcasts import BroadcastSender
+from converse.caches import get_slack_auth, get_slack_auths, identity_resolver, ConverseIdentity
+from converse.clients import slack_client
 from converse.executors import Executor
-from converse.models import TalkUser, SlackAuth, SlackUser, SlackChannel, AbstractUser
-from converse.parsers import ParserResponse
+from converse.messengers import coalesce_messages, QuickReply
+from converse.models import TalkUser, SlackAuth, SlackUser, AbstractUser, Broadcast
+from converse.parsers import ParserResponse, parser_pool
+from converse.scheduling import tenant_scheduler, action_limiter
+from converse.sync import SlackDirectorySync, iter_slack_collection
+from converse.tracing import trace, span, observe_queue_lag
 
 logger = logging.getLogger(__name__)
 parser_class = locate(settings.TEXT_PARSER)
 
 
 @shared_task
-def slack_message_event(team_id, event):
-    slack_auth = SlackAuth.objects.get(team_id=team_id)
-    slack_user_id = event["user"]
+def slack_message_event(team_id, event, scheduled=False):
+    """
+    :param scheduled: whether the task was queued by the tenant scheduler, whose slot is released when it is done
+    """
     try:
-        slack_user = SlackUser.objects.get(slack_auth=slack_auth, slack_id=slack_user_id)
-    except SlackUser.DoesNotExist:
-        sc = SlackClient(slack_auth.bot_access_token)
-        result = sc.api_call("users.info", user=slack_user_id)
-        slack_user = SlackUser.objects.create(name=result["user"]["profile"]["real_name"],
-                                              email=result["user"]["profile"]["email"],
-                                              slack_auth=slack_auth, slack_id=slack_user_id)
-    message_event(slack_user, event["text"])
+        _slack_message_event(team_id, event)
+    finally:
+        if scheduled:
+            tenant_scheduler.release(team_id)
+
+
+def _slack_message_event(team_id, event, slack_auth=None, identity=None):
+    """
+    :param slack_auth: the SlackAuth of the team, if already known
+    :param identity: the ConverseIdentity of the user, if already known
+    """
+    with trace(team_id=team_id):
+        observe_queue_lag("worker", event.get("event_time") or event.get("ts"))
+        with span("identity"):
+            slack_auth = slack_auth or get_slack_auth(team_id)
+            slack_user_id = event["user"]
+            identity = identity or identity_resolver.resolve(slack_auth, slack_user_id)
+            if identity is None:
+                sc = slack_client(slack_auth.bot_access_token)
+                result = sc.api_call("users.info", user=slack_user_id)
+                slack_user = SlackUser.objects.create(name=result["user"]["profile"]["real_name"],
+                                                      email=result["user"]["profile"]["email"],
+                                                      slack_auth=slack_auth, slack_id=slack_user_id)
+                identity = identity_resolver.add(slack_user, slack_auth)
+        message_event(identity, event["text"])
 
 
 @shared_task
-def slack_action_event(action_event):
-    slack_auth = SlackAuth.objects.get(team_id=action_event["team"]["id"])
-    slack_user_id = action_event["user"]["id"]
+def slack_action_event(action_event, scheduled=False):
     try:
-        slack_user = SlackUser.objects.get(slack_auth=slack_auth, slack_id=slack_user_id)
-    except SlackUser.DoesNotExist:
-        sc = SlackClient(slack_auth.bot_access_token)
+        _slack_action_event(action_event)
+    finally:
+        if scheduled:
+            tenant_scheduler.release(action_event["team"]["id"])
+
+
+def _slack_action_event(action_event, slack_auth=None, identity=None):
+    with trace(team_id=action_event["team"]["id"]):
+        observe_queue_lag("worker", action_event.get("action_ts"))
+        with span("identity"):
+            identity = _resolve_action_user(action_event, slack_auth, identity)
+        if identity is None:
+            return
+        quick_reply = QuickReply.from_button(action_event["actions"][0])
+        if quick_reply.action:
+            quick_reply_event(identity, quick_reply)
+        else:
+            message_event(identity, quick_reply.value)
+
+
+def _resolve_action_user(action_event, slack_auth=None, identity=None):
+    """
+    :return: the ConverseIdentity of the user who clicked, or None if Slack cannot tell who they are
+    """
+    slack_auth = slack_auth or get_slack_auth(action_event["team"]["id"])
+    slack_user_id = action_event["user"]["id"]
+    identity = identity or identity_resolver.resolve(slack_auth, slack_user_id)
+    if identity is None:
+        sc = slack_client(slack_auth.bot_access_token)
         result = sc.api_call("users.info", user=slack_user_id)
         if not result["ok"]:
             logger.error("Unable to call 'users.info' for user id: {} with slack auth: {}".format(slack_user_id,
                                                                                                   slack_auth))
-            return
+            return None
         user_channel = get_user_channel_map(sc, slack_auth)
         user = result["user"]
         if user_channel is not None and user["id"] in user_channel:
@@ -50,20 +99,101 @@ def slack_action_event(action_event):
             slack_channel = None
         slack_user = SlackUser.objects.create(email=user["profile"]["email"], name=user["profile"]["real_name"],
                                               slack_id=user["id"], slack_channel=slack_channel, slack_auth=slack_auth)
-    message_event(slack_user, action_event["actions"][0]["value"])
+        identity = identity_resolver.add(slack_user, slack_auth)
+    return identity
+
+
+@shared_task
+def slack_event_batch(events):
+    """
+    Handles a batch of events buffered by `converse.batching.EventBatcher`. The SlackAuths and the identities of the
+    users are resolved for the whole batch with a few bulk queries, and the events are then handled in order.
+    :param events: list of (task name, args) of `slack_message_event` and `slack_action_event`
+    """
+    sessions = []
+    for name, args in events:
+        if name == slack_message_event.name:
+            sessions.append((args[0], args[1]["user"]))
+        else:
+            sessions.append((args[0]["team"]["id"], args[0]["user"]["id"]))
+    slack_auths = get_slack_auths(set(team_id for team_id, _ in sessions))
+    identities = identity_resolver.resolve_many([(slack_auths[team_id], slack_id) for team_id, slack_id in sessions
+                                                 if team_id in slack_auths])
+    for (name, args), (team_id, slack_id) in zip(events, sessions):
+        if team_id not in slack_auths:
+            logger.error("Dropping event of unknown team {}".format(team_id))
+            continue
+        identity = identities.get((team_id, slack_id))
+        try:
+            if name == slack_message_event.name:
+                _slack_message_event(args[0], args[1], slack_auth=slack_auths[team_id], identity=identity)
+            else:
+                _slack_action_event(args[0], slack_auth=slack_auths[team_id], identity=identity)
+        except Exception:
+            logger.error("Unable to handle event of {} in {}".format(slack_id, team_id), exc_info=True)
+
+
+def quick_reply_event(converse_user, quick_reply):
+    """
+    Executes the action of a quick reply that was sent with one, without parsing its value
+    :param converse_user: TalkUser, or the ConverseIdentity of a Slack user
+    :param quick_reply: QuickReply
+    """
+    assert isinstance(converse_user, (TalkUser, ConverseIdentity))
+    with coalesce_messages(enabled=getattr(settings, "COALESCE_MESSAGES", False)):
+        Executor.execute(action=quick_reply.action, user=get_app_user(converse_user), params=quick_reply.params,
+                         contexts={})
 
 
 def message_event(converse_user, message):
-    assert isinstance(converse_user, TalkUser)
-    parser = parser_class()
-    response = parser.parse(message, converse_user.session_id)
-    assert isinstance(response, ParserResponse)
-    logger.debug(response)
-    if response.text:
-        converse_user.messenger.send(response.text)
-    if response.slot_filling_complete and response.action:
-        app_user = AbstractUser.implementation().objects.get(converse_user=converse_user)
-        Executor.execute(action=response.action, user=app_user, params=response.params, contexts=response.contexts)
+    """
+    Parses the message and executes the resulting action
+    :param converse_user: TalkUser, or the ConverseIdentity of a Slack user
+    :param message: the text sent by the user
+    """
+    assert isinstance(converse_user, (TalkUser, ConverseIdentity))
+    with coalesce_messages(enabled=getattr(settings, "COALESCE_MESSAGES", False)):
+        with span("parse"), parser_pool.parser(parser_class) as parser:
+            response = parser.parse(message, converse_user.session_id)
+        assert isinstance(response, ParserResponse)
+        logger.debug(response)
+        if response.text:
+            converse_user.messenger.send(response.text)
+        if response.slot_filling_complete and response.action:
+            Executor.execute(action=response.action, user=get_app_user(converse_user), params=response.params,
+                             contexts=response.contexts)
+
+
+@shared_task(bind=True, max_retries=None)
+def execute_action(self, action, user_id, params, contexts):
+    """
+    Runs an action queued by `Executor.execute`. While the action already runs `concurrency` times, the task is retried
+    every `ACTION_RETRY_DELAY` seconds.
+    :param user_id: the primary key of the application user
+    :raises SoftTimeLimitExceeded: when the action runs longer than its `timeout`, so the task is recorded as failed
+    """
+    executor = Executor.action_map.get(action)
+    if executor is None:
+        logger.error("No executor for action {}".format(action))
+        return
+    if executor.concurrency is not None and not action_limiter.acquire(action, executor.concurrency):
+        raise self.retry(countdown=getattr(settings, "ACTION_RETRY_DELAY", 1))
+    try:
+        with trace(action=action), span("queued_action"):
+            executor(AbstractUser.implementation().objects.select_converse().get(pk=user_id), params, contexts)
+    except SoftTimeLimitExceeded:
+        logger.error("Action {} did not finish within {} seconds".format(action, executor.timeout))
+        # raised for celery to record the task as failed
+        raise
+    finally:
+        if executor.concurrency is not None:
+            action_limiter.release(action)
+
+
+def get_app_user(converse_user):
+    if isinstance(converse_user, ConverseIdentity):
+        return converse_user.get_app_user()
+    return AbstractUser.implementation().objects.select_converse().get(converse_user=converse_user)
 
 
 @shared_task
@@ -75,40 +205,38 @@ def update_user_list():
 @shared_task
 def retrieve_channel_users(slack_auth_id):
     slack_auth = SlackAuth.objects.get(pk=slack_auth_id)
-    sc = SlackClient(slack_auth.bot_access_token)
-    channels = sc.api_call("channels.list")
-    if not channels["ok"]:
-        return
-    for channel in channels["channels"]:
-        if not SlackChannel.objects.filter(slack_id=channel['id'], slack_auth=slack_auth).exists():
-            SlackChannel.objects.create(slack_auth=slack_auth, slack_id=channel['id'],
-                                        is_main=channel["is_general"], name=channel['name'])
-    users = sc.api_call("users.list")
-    if not users["ok"]:
-        return
-    user_channel = get_user_channel_map(sc, slack_auth)
-    if user_channel is None:
+    sc = slack_client(slack_auth.bot_access_token)
+    sync = SlackDirectorySync(slack_auth)
+    try:
+        result = {"channels": sync.sync_channels(iter_slack_collection(sc, "channels.list", "channels")).as_dict()}
+        user_channel = get_user_channel_map(sc, slack_auth)
+        if user_channel is None:
+            return
+        members = iter_slack_collection(sc, "users.list", "members")
+        result["users"] = sync.sync_users(members, user_channel).as_dict()
+    except RuntimeError:
+        logger.error("Unable to sync users and channels for {}".format(slack_auth), exc_info=True)
         return
-    for user in users["members"]:
-        if user["is_bot"] or user["id"] == "USLACKBOT" or user["id"] not in user_channel:
-            continue
-        if SlackUser.objects.filter(slack_id=user["id"], slack_auth=slack_auth).exists():
-            SlackUser.objects.filter(slack_id=user["id"],
-                                     slack_auth=slack_auth).update(email=user["profile"]["email"],
-                                                                   name=user["profile"]["real_name"],
-                                                                   slack_channel=user_channel[user["id"]])
-        else:
-            SlackUser.objects.create(email=user["profile"]["email"], name=user["profile"]["real_name"],
-                                     slack_id=user["id"], slack_channel=user_channel[user["id"]],
-                                     slack_auth=slack_auth)
+    logger.info("Synced users and channels for {}: {}".format(slack_auth, result))
+    return result
+
+
+@shared_task
+def send_broadcast(broadcast_id):
+    """
+    Sends a broadcast, or resumes it if it was interrupted
+    """
+    broadcast = BroadcastSender(Broadcast.objects.get(pk=broadcast_id)).run()
+    logger.info("Broadcast {} finished: {}".format(broadcast_id, broadcast))
+    return {"sent": broadcast.sent, "failed": broadcast.failed}
 
 
 def get_user_channel_map(sc, slack_auth):
-    dms = sc.api_call("im.list")
-    if not dms["ok"]:
+    user_channel = {}
+    try:
+        for dm in iter_slack_collection(sc, "im.list", "ims"):
+            user_channel[dm["user"]] = dm["id"]
+    except RuntimeError:
         logger.error("Unable to call im.list for {}".format(slack_auth))
         return None
-    user_channel = {}
-    for dm in dms["ims"]:
-        user_channel[dm["user"]] = dm["id"]
     return user_channel
@@ -0,0 +1,242 @@
+"""
+Local stand-ins for the Slack Web API and the api.ai query endpoint, to test and benchmark a bot offline. Both run an
+HTTP server in a background thread, and can delay their responses to simulate the network:
+
+    with FakeSlackServer(latency=0.05) as slack, FakeAPIAIServer(action="account.balance") as apiai:
+        with override_settings(SLACK_API_URL=slack.url, API_AI_URL=apiai.url):
+            ...
+"""
+import json
+import threading
+import time
+
+from six.moves.BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from six.moves.socketserver import ThreadingMixIn
+from six.moves.urllib.parse import parse_qsl, urlparse
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class FakeServer(object):
+    """
+    Answers every request with `handle`, which subclasses override. The connections accepted are counted in
+    `connections`, to check that the clients keep them alive.
+    :param latency: seconds to wait before each response, or a dict of the seconds per path (eg. the Slack method)
+    """
+
+    def __init__(self, latency=0.0, host="127.0.0.1", port=0):
+        self.latency = latency
+        self.requests = []
+        self.connections = 0
+        self._lock = threading.Lock()
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            # the headers and the body are written separately, which would wait for the delayed ACK of the client
+            disable_nagle_algorithm = True
+
+            def setup(self):
+                BaseHTTPRequestHandler.setup(self)
+                with server._lock:
+                    server.connections += 1
+
+            def do_POST(self):
+                length = int(self.headers.get("Content-Length") or 0)
+                self.respond(self.rfile.read(length).decode("utf-8"))
+
+            def do_GET(self):
+                self.respond("")
+
+            def respond(self, body):
+                url = urlparse(self.path)
+                name = url.path.rstrip("/").rsplit("/", 1)[-1]
+                server.wait(name)
+                response = server.handle(name, url.query, body, self.headers)
+                status, data = response[:2]
+                content = json.dumps(data).encode("utf-8")
+                self.send_response(status)
+                for header in (response[2] if len(response) > 2 else {}).items():
+                    self.send_header(*header)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(content)))
+                self.end_headers()
+                self.wfile.write(content)
+
+            def log_message(self, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer((host, port), Handler)
+        self._thread = None
+
+    @property
+    def port(self):
+        return self.httpd.server_port
+
+    def wait(self, name):
+        latency = self.latency.get(name, 0.0) if isinstance(self.latency, dict) else self.latency
+        if latency:
+            time.sleep(latency)
+
+    def handle(self, name, query, body, headers):
+        """
+        :param name: the last segment of the path, eg. the Slack method
+        :return: (HTTP status, JSON data), or (HTTP status, JSON data, dict of headers)
+        """
+        return 404, {"ok": False, "error": "not_found"}
+
+    def start(self):
+        self._thread = threading.Thread(target=self.httpd.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+
+class FakeSlackServer(FakeServer):
+    """
+    Implements chat.postMessage, users.info, users.list, im.list, channels.list and im.history over in memory users and
+    channels. Every user has a direct message channel 'D<user id>', and the messages posted are kept in `messages`.
+    The lists are paginated with cursors, with pages of up to `page_size` items.
+    """
+
+    def __init__(self, users=None, channels=None, page_size=100, channel_errors=None, **kwargs):
+        """
+        :param users: list of Slack user objects, eg. {"id": "U1", "profile": {"real_name": "Ann", "email": "a@x.com"}}
+        :param channels: list of Slack channel objects, eg. {"id": "C1", "name": "general"}
+        :param channel_errors: dict of the channels to the error chat.postMessage answers with for them, eg.
+        {"D3": "channel_not_found"}
+        """
+        super(FakeSlackServer, self).__init__(**kwargs)
+        self.users = list(users or [])
+        self.channels = list(channels or [])
+        self.page_size = page_size
+        self.channel_errors = dict(channel_errors or {})
+        self.messages = []
+
+    @property
+    def url(self):
+        """
+        The value of `SLACK_API_URL`
+        """
+        return "http://127.0.0.1:{}/api/".format(self.port)
+
+    @staticmethod
+    def user(slack_id, name=None, email=None, is_bot=False):
+        name = name or slack_id
+        return {"id": slack_id, "name": name.lower(), "is_bot": is_bot,
+                "profile": {"real_name": name, "email": email or "{}@example.com".format(slack_id.lower())}}
+
+    def add_user(self, slack_id, name=None, email=None):
+        user = self.user(slack_id, name, email)
+        with self._lock:
+            self.users.append(user)
+        return user
+
+    def page(self, items, key, params):
+        start = int(params.get("cursor") or 0)
+        # like Slack, the page size is capped whatever the limit requested
+        limit = min(int(params.get("limit") or self.page_size), self.page_size)
+        end = start + limit
+        cursor = str(end) if end < len(items) else ""
+        return {"ok": True, key: items[start:end], "response_metadata": {"next_cursor": cursor}}
+
+    def handle(self, name, query, body, headers):
+        params = dict(parse_qsl(query))
+        params.update(parse_qsl(body))
+        with self._lock:
+            self.requests.append((name, params))
+        method = getattr(self, "api_" + name.replace(".", "_"), None)
+        if method is None:
+            return 200, {"ok": False, "error": "unknown_method"}
+        return 200, method(params)
+
+    def api_chat_postMessage(self, params):
+        if params.get("channel") in self.channel_errors:
+            return {"ok": False, "error": self.channel_errors[params["channel"]]}
+        message = {"type": "message", "channel": params.get("channel"), "text": params.get("text", ""),
+                   "ts": "{:.6f}".format(time.time())}
+        if params.get("attachments"):
+            message["attachments"] = json.loads(params["attachments"])
+        with self._lock:
+            self.messages.append(message)
+        return {"ok": True, "channel": message["channel"], "ts": message["ts"], "message": message}
+
+    def api_users_info(self, params):
+        for user in self.users:
+            if user["id"] == params.get("user"):
+                return {"ok": True, "user": user}
+        return {"ok": False, "error": "user_not_found"}
+
+    def api_users_list(self, params):
+        return self.page(self.users, "members", params)
+
+    def api_im_list(self, params):
+        ims = [{"id": "D" + user["id"], "user": user["id"], "is_im": True} for user in self.users]
+        return self.page(ims, "ims", params)
+
+    def api_channels_list(self, params):
+        return self.page(self.channels, "channels", params)
+
+    def api_im_history(self, params):
+        with self._lock:
+            messages = [message for message in self.messages if message["channel"] == params.get("channel")]
+        count = int(params.get("count") or 100)
+        return {"ok": True, "messages": list(reversed(messages))[:count], "has_more": len(messages) > count}
+
+
+class FakeAPIAIServer(FakeServer):
+    """
+    Answers every query with the same intent, or with the result returned by `handler(query, session_id)`
+    """
+
+    def __init__(self, action=None, speech="", parameters=None, contexts=None, handler=None, client_token=None,
+                 **kwargs):
+        """
+        :param action: the action of the intent, None for a query that matched no intent
+        :param contexts: dict of the name of each output context to its parameters
+        :param client_token: if set, the queries without the header 'Authorization: Bearer <client_token>' are refused
+        """
+        super(FakeAPIAIServer, self).__init__(**kwargs)
+        self.action = action
+        self.speech = speech
+        self.parameters = parameters or {}
+        self.contexts = contexts or {}
+        self.handler = handler
+        self.client_token = client_token
+
+    @property
+    def url(self):
+        """
+        The value of `API_AI_URL`
+        """
+        return "http://127.0.0.1:{}/v1/query".format(self.port)
+
+    def result(self, query, session_id):
+        if self.handler is not None:
+            return self.handler(query, session_id)
+        return {"action": self.action or "input.unknown", "actionIncomplete": False,
+                "parameters": dict(self.parameters), "fulfillment": {"speech": self.speech},
+                "contexts": [{"name": name, "parameters": parameters} for name, parameters in self.contexts.items()]}
+
+    def handle(self, name, query, body, headers):
+        data = json.loads(body or "{}")
+        with self._lock:
+            self.requests.append(data)
+        if self.client_token is not None and headers.get("Authorization") != "Bearer {}".format(self.client_token):
+            return 401, {"status": {"code": 401, "errorType": "unauthorized"}}
+        if not data.get("query"):
+            return 400, {"status": {"code": 400, "errorType": "bad_request"}}
+        return 200, {"result": self.result(data["query"], data.get("sessionId")), "status": {"code": 200}}
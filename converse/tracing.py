@@ -0,0 +1,274 @@
+"""
+Instrumentation of the handling of the events: each stage, from the webhook to the messages sent, is timed as a span
+tagged with the team and the action, and aggregated into histograms which `MetricsView` exports in the Prometheus text
+format. The histograms of each process are merged every `TRACING_FLUSH_INTERVAL` seconds into counters of the Django
+cache `TRACING_CACHE`, so the view also reports the stages timed by the workers when the cache is shared.
+The series are only labelled with the team with `TRACING_TEAM_LABEL`, as each team adds a series per stage, and each
+series up to 15 keys of the cache.
+"""
+import hashlib
+import json
+import logging
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from timeit import default_timer
+
+from django.core.cache import caches
+from django.core.cache.backends.locmem import LocMemCache
+
+from converse.clients import get_setting
+
+logger = logging.getLogger(__name__)
+
+STAGE_SECONDS = "converse_stage_seconds"
+QUEUE_LAG_SECONDS = "converse_queue_lag_seconds"
+METRICS = {
+    STAGE_SECONDS: "Duration of the stages of the handling of the Slack events",
+    QUEUE_LAG_SECONDS: "Delay between the time of a Slack event and the start of a stage handling it",
+}
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+_local = threading.local()
+
+
+class Histogram(object):
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        # the observations of each bucket, not cumulative, the last one being +Inf
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+
+    @property
+    def count(self):
+        return sum(self.counts)
+
+    def observe(self, value):
+        for index, bound in enumerate(self.buckets):
+            if value <= bound:
+                break
+        else:
+            index = len(self.buckets)
+        self.counts[index] += 1
+        self.sum += value
+
+    def percentile(self, percent):
+        """
+        :return: the upper bound of the bucket of the percentile, None if it is beyond the last bucket or there are no
+        observations
+        """
+        rank = percent / 100.0 * self.count
+        for bound, count in self.cumulative():
+            if count and count >= rank:
+                return bound if bound != "+Inf" else None
+        return None
+
+    def cumulative(self):
+        """
+        :return: list of (upper bound, observations up to it), ending with ('+Inf', count)
+        """
+        total = 0
+        result = []
+        for bound, count in zip(list(self.buckets) + ["+Inf"], self.counts):
+            total += count
+            result.append((bound, total))
+        return result
+
+
+def escape(value):
+    return u"{}".format(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+class MetricsRegistry(object):
+    """
+    Histograms per metric and labels. The observations are kept in the process, and added to the counters of the cache
+    `cache_alias` at most every `flush_interval` seconds. The sums are counted in microseconds, as the caches only
+    increment integers. The counters must not be evicted, or they go backwards: use a cache without culling, eg. redis
+    without a maxmemory policy, rather than the local memory cache, which culls at 300 entries.
+    The team_id labels are dropped unless `team_label` is set.
+    """
+
+    def __init__(self, enabled=True, cache_alias="default", flush_interval=10, buckets=BUCKETS, team_label=False,
+                 timer=time.time):
+        self.enabled = enabled
+        self.team_label = team_label
+        self.cache_alias = cache_alias
+        self.flush_interval = flush_interval
+        self.buckets = buckets
+        self.timer = timer
+        self._pending = {}
+        self._series = {}
+        self._flushed = timer()
+        self._warned = False
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def series_id(metric, labels):
+        key = json.dumps([metric, sorted(labels.items())])
+        return hashlib.md5(key.encode("utf-8")).hexdigest()
+
+    @staticmethod
+    def key(series_id, field):
+        return "converse:metrics:{}:{}".format(series_id, field)
+
+    index_key = "converse:metrics:index"
+
+    def observe(self, metric, value, **labels):
+        if not self.enabled:
+            return
+        if not self.team_label:
+            labels.pop("team_id", None)
+        labels = dict((name, "" if label is None else u"{}".format(label)) for name, label in labels.items())
+        series_id = self.series_id(metric, labels)
+        with self._lock:
+            if series_id not in self._pending:
+                self._pending[series_id] = Histogram(self.buckets)
+                self._series[series_id] = (metric, labels)
+            self._pending[series_id].observe(value)
+            due = self.timer() - self._flushed >= self.flush_interval
+        if due:
+            self.flush()
+
+    def flush(self):
+        """
+        Adds the observations of the process to the counters of the cache
+        """
+        with self._lock:
+            pending, self._pending = self._pending, {}
+            series = dict(self._series)
+            self._flushed = self.timer()
+        if not pending:
+            return
+        try:
+            cache = caches[self.cache_alias]
+            if isinstance(cache, LocMemCache) and not self._warned:
+                self._warned = True
+                logger.warning("The metrics are kept in the local memory cache {}, which is not shared with the other "
+                               "processes, and culls their counters".format(self.cache_alias))
+            index = cache.get(self.index_key) or {}
+            missing = dict((series_id, series[series_id]) for series_id in pending if series_id not in index)
+            if missing:
+                index.update(missing)
+                cache.set(self.index_key, index, None)
+            for series_id, histogram in pending.items():
+                fields = [(str(i), count) for i, count in enumerate(histogram.counts) if count]
+                fields.append(("sum", int(round(histogram.sum * 1000000))))
+                for field, delta in fields:
+                    key = self.key(series_id, field)
+                    if not cache.add(key, delta, None):
+                        try:
+                            cache.incr(key, delta)
+                        except ValueError:
+                            cache.set(key, delta, None)
+        except Exception:
+            logger.warning("Unable to flush the metrics", exc_info=True)
+
+    def pending(self):
+        """
+        :return: list of (metric, labels, Histogram) of the observations of the process not flushed yet
+        """
+        with self._lock:
+            return [(self._series[series_id][0], self._series[series_id][1], histogram)
+                    for series_id, histogram in self._pending.items()]
+
+    def collect(self):
+        """
+        :return: list of (metric, labels, Histogram) of all the processes, as of their last flush
+        """
+        cache = caches[self.cache_alias]
+        index = cache.get(self.index_key) or {}
+        fields = [str(i) for i in range(len(self.buckets) + 1)] + ["sum"]
+        values = cache.get_many([self.key(series_id, field) for series_id in index for field in fields])
+        result = []
+        for series_id, (metric, labels) in sorted(index.items(), key=lambda item: json.dumps(item[1], sort_keys=True)):
+            histogram = Histogram(self.buckets)
+            histogram.counts = [values.get(self.key(series_id, field), 0) for field in fields[:-1]]
+            histogram.sum = values.get(self.key(series_id, "sum"), 0) / 1000000.0
+            result.append((metric, labels, histogram))
+        return result
+
+    def render(self):
+        """
+        :return: the histograms in the Prometheus text exposition format
+        """
+        lines = []
+        described = set()
+        for metric, labels, histogram in self.collect():
+            if metric not in described:
+                described.add(metric)
+                lines.append("# HELP {} {}".format(metric, METRICS.get(metric, metric)))
+                lines.append("# TYPE {} histogram".format(metric))
+            label_text = ",".join(u'{}="{}"'.format(name, escape(value)) for name, value in sorted(labels.items()))
+            separator = "," if label_text else ""
+            for bound, count in histogram.cumulative():
+                lines.append(u'{}_bucket{{{}{}le="{}"}} {}'.format(metric, label_text, separator, bound, count))
+            lines.append(u"{}_sum{{{}}} {}".format(metric, label_text, repr(histogram.sum)))
+            lines.append(u"{}_count{{{}}} {}".format(metric, label_text, histogram.count))
+        return u"\n".join(lines) + u"\n"
+
+    def clear(self):
+        with self._lock:
+            self._pending = {}
+            self._series = {}
+        cache = caches[self.cache_alias]
+        index = cache.get(self.index_key) or {}
+        cache.delete_many([self.key(series_id, field) for series_id in index
+                           for field in [str(i) for i in range(len(self.buckets) + 1)] + ["sum"]])
+        cache.delete(self.index_key)
+
+
+metrics = MetricsRegistry(enabled=get_setting("TRACING_ENABLED", True),
+                          cache_alias=get_setting("TRACING_CACHE", "default"),
+                          flush_interval=get_setting("TRACING_FLUSH_INTERVAL", 10),
+                          team_label=get_setting("TRACING_TEAM_LABEL", False))
+
+
+def current_tags():
+    return getattr(_local, "tags", {})
+
+
+@contextmanager
+def trace(**tags):
+    """
+    Tags the spans of the block, eg. with the team_id of the event being handled. A trace id is generated for the
+    outermost block, and logged with its spans.
+    """
+    previous = current_tags()
+    _local.tags = dict(previous, **tags)
+    _local.tags.setdefault("trace_id", uuid.uuid4().hex[:16])
+    try:
+        yield _local.tags
+    finally:
+        _local.tags = previous
+
+
+@contextmanager
+def span(stage, **tags):
+    """
+    Times the block as a stage of the current trace
+    :param tags: team_id and action, which default to the tags of the current trace
+    """
+    tags = dict(current_tags(), **tags)
+    start = default_timer()
+    try:
+        yield
+    finally:
+        duration = default_timer() - start
+        metrics.observe(STAGE_SECONDS, duration, stage=stage, team_id=tags.get("team_id"), action=tags.get("action"))
+        logger.debug("span stage={} duration={:.6f} team_id={} action={} trace_id={}".format(
+            stage, duration, tags.get("team_id"), tags.get("action"), tags.get("trace_id")))
+
+
+def observe_queue_lag(stage, event_time, team_id=None):
+    """
+    Records the delay since Slack's time of the event
+    :param event_time: seconds since the epoch, the event_time of an event callback, or the ts of a message or action
+    """
+    if not event_time:
+        return
+    try:
+        lag = max(time.time() - float(event_time), 0.0)
+    except (TypeError, ValueError):
+        return
+    metrics.observe(QUEUE_LAG_SECONDS, lag, stage=stage, team_id=team_id or current_tags().get("team_id"))
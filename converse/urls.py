@@ -1,6 +1,6 @@
 from django.conf.urls import url, include
 
-from converse.views import SlackRequestURL, SlackOAuthView, SlackActionURL
+from converse.views import SlackRequestURL, SlackOAuthView, SlackActionURL, MetricsView
 
 slackpatterns = [
     url(r'^oauth', SlackOAuthView.as_view(), name='oauth'),
@@ -9,5 +9,6 @@ slackpatterns = [
 ]
 
 urlpatterns = [
-    url(r'^slack/', include(slackpatterns, namespace='slack'))
+    url(r'^slack/', include(slackpatterns, namespace='slack')),
+    url(r'^metrics$', MetricsView.as_view(), name='metrics')
 ]
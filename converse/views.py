@@ -5,16 +5,48 @@ import traceback
 from django.conf import settings
 from django.http.response import HttpResponseRedirect, HttpResponse
 from django.urls import reverse
+from django.utils.crypto import constant_time_compare
 from django.views.generic.base import View
-from slackclient import SlackClient
 
+from converse.batching import event_batcher
+from converse.caches import invalidate_slack_auth, event_deduplicator
+from converse.clients import slack_client
 from converse.models import SlackAuth
+from converse.scheduling import tenant_scheduler
 from converse.tasks import retrieve_channel_users
 from converse.tasks import slack_message_event, slack_action_event
+from converse.tracing import metrics, span, observe_queue_lag
 
 logger = logging.getLogger(__name__)
 
 
+def queue_once(event_id, team_id, task, args, retry=None):
+    """
+    Queues the task, unless the event was already received. The event is added to the current batch when batching is
+    enabled (EVENT_BATCH_SIZE), and otherwise queued through the tenant scheduler.
+    :param event_id: identifies the event, or None if it cannot be deduplicated
+    :param args: tuple of the arguments of the task
+    :param retry: the X-Slack-Retry-Num header of the request, if Slack is retrying the event
+    :return: bool, true if the task was queued
+    """
+    if event_id is not None:
+        if event_deduplicator.is_duplicate(event_id):
+            logger.info("Dropping duplicate event {} (retry {})".format(event_id, retry))
+            return False
+        if retry:
+            logger.info("Handling retry {} of event {}, not received before".format(retry, event_id))
+    if event_batcher.enabled:
+        event_batcher.add(event_id, task, *args)
+        return True
+    try:
+        tenant_scheduler.submit(team_id, task, *args)
+    except Exception:
+        if event_id is not None:
+            event_deduplicator.forget(event_id)
+        raise
+    return True
+
+
 def get_slack_oauth_uri(request):
     scope = "bot"
     return "https://slack.com/oauth/authorize?scope=" + scope + "&client_id=" + settings.SLACK_CLIENT_ID + \
@@ -25,7 +57,7 @@ class SlackOAuthView(View):
     def dispatch(self, request, *args, **kwargs):
         try:
             code = request.GET.get('code', '')
-            sc = SlackClient("")
+            sc = slack_client("")
             result = sc.api_call("oauth.access", client_id=settings.SLACK_CLIENT_ID,
                                  client_secret=settings.SLACK_CLIENT_SECRET, code=code,
                                  redirect_uri=request.build_absolute_uri(reverse('converse:slack:oauth')))
@@ -41,6 +73,7 @@ class SlackOAuthView(View):
                                                       team_name=result["team_name"],
                                                       bot_id=result["bot"]["bot_user_id"],
                                                       bot_access_token=result["bot"]["bot_access_token"])
+            invalidate_slack_auth(slack_auth.team_id)
             retrieve_channel_users.delay(slack_auth.pk)
             return HttpResponseRedirect(reverse(settings.SLACK_OAUTH_SUCCESS_VIEW))
         except Exception:
@@ -68,7 +101,13 @@ class SlackActionURL(View):
             return HttpResponse(status=400)
         if settings.SLACK_VERIFICATION_TOKEN != query["token"]:
             return HttpResponse(status=400)
-        slack_action_event.delay(query)
+        event_id = None
+        if query.get("action_ts"):
+            event_id = "action:{}:{}:{}".format(query["team"]["id"], query["user"]["id"], query["action_ts"])
+        observe_queue_lag("webhook", query.get("action_ts"), team_id=query["team"]["id"])
+        with span("webhook", team_id=query["team"]["id"]):
+            queue_once(event_id, query["team"]["id"], slack_action_event, (query,),
+                       retry=request.META.get("HTTP_X_SLACK_RETRY_NUM"))
         return HttpResponse(status=200)
 
 
@@ -87,5 +126,28 @@ class SlackRequestURL(View):
         if query["type"] == "event_callback":
             event = query["event"]
             if event["type"] == "message" and "bot_id" not in event:
-                slack_message_event.delay(query["team_id"], event)
+                event_id = query.get("event_id") or "message:{}:{}:{}".format(query["team_id"], event.get("channel"),
+                                                                              event.get("ts"))
+                if query.get("event_time"):
+                    # carried to the task, to measure the queue lag
+                    event = dict(event, event_time=query["event_time"])
+                observe_queue_lag("webhook", event.get("event_time"), team_id=query["team_id"])
+                with span("webhook", team_id=query["team_id"]):
+                    queue_once(event_id, query["team_id"], slack_message_event, (query["team_id"], event),
+                               retry=request.META.get("HTTP_X_SLACK_RETRY_NUM"))
         return HttpResponse(status=200)
+
+
+class MetricsView(View):
+    """
+    The histograms of `converse.tracing`, in the Prometheus text format. The requests must have the header
+    'Authorization: Bearer <METRICS_TOKEN>', and are all denied while `METRICS_TOKEN` is not set.
+    """
+
+    def get(self, request):
+        token = getattr(settings, "METRICS_TOKEN", None)
+        if not token or not constant_time_compare(request.META.get("HTTP_AUTHORIZATION", ""),
+                                                  "Bearer {}".format(token)):
+            return HttpResponse(status=403)
+        metrics.flush()
+        return HttpResponse(metrics.render(), content_type="text/plain; version=0.0.4; charset=utf-8")
@@ -141,6 +141,9 @@ API_AI_CLIENT_TOKEN = os.environ["API_AI_CLIENT_TOKEN"]
 
 ACTION_MODULES = ['grocery.actions']
 
+# GroceryUser and Organization refer to their TalkUser and Auth with a OneToOneField
+APP_MODEL_LINKAGE = 'direct'
+
 try:
     from local_settings import *
 except ImportError:
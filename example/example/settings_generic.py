@@ -0,0 +1,7 @@
+# the example project with the default, generic linkage of the app models, see APP_MODEL_LINKAGE
+from example.settings import *  # noqa
+
+APP_MODEL_LINKAGE = 'generic'
+
+# the migrations of the grocery app are written for the direct linkage, its tables are created from the models instead
+MIGRATION_MODULES = {'grocery': None}
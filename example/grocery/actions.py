@@ -1,9 +1,23 @@
-from converse.executors import Executor, ActionBase
-from models import Order
+from collections import OrderedDict
+
+from converse.executors import Executor, BatchActionBase
+from grocery.models import Order
 
 
 @Executor(action="grocery.add")
-class GroceryAddAction(ActionBase):
-    def execute(self):
-        Order.objects.create(item=self.params['item'], quantity=self.params['quantity'], org=self.user.org)
-        self.user.messenger.send("{} was successfully added".format(self.params['item']))
+class GroceryAddAction(BatchActionBase):
+    @classmethod
+    def execute_batch(cls, invocations):
+        items = OrderedDict()
+        orgs = {}
+        orders = []
+        for action in invocations:
+            if action.user not in orgs:
+                orgs[action.user] = action.user.org
+            orders.append(Order(item=action.params['item'], quantity=action.params['quantity'],
+                                org=orgs[action.user]))
+            items.setdefault(action.user, []).append(action.params['item'])
+        Order.objects.bulk_create(orders)
+        for user, user_items in items.items():
+            user.messenger.send("{} {} successfully added".format(", ".join(user_items),
+                                                                  "were" if len(user_items) > 1 else "was"))
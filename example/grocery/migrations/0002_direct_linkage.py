@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+from django.db.models import F
+import django.db.models.deletion
+
+
+def link_directly(apps, schema_editor):
+    # the primary key of a SlackUser or a SlackAuth is the one of its TalkUser or Auth
+    apps.get_model('grocery', 'GroceryUser').objects.update(converse_user_id=F('object_id'))
+    apps.get_model('grocery', 'Organization').objects.update(converse_org_id=F('object_id'))
+
+
+def link_generically(apps, schema_editor):
+    ContentType = apps.get_model('contenttypes', 'ContentType')
+    slack_user, _ = ContentType.objects.get_or_create(app_label='converse', model='slackuser')
+    slack_auth, _ = ContentType.objects.get_or_create(app_label='converse', model='slackauth')
+    apps.get_model('grocery', 'GroceryUser').objects.update(content_type=slack_user, object_id=F('converse_user_id'))
+    apps.get_model('grocery', 'Organization').objects.update(content_type=slack_auth, object_id=F('converse_org_id'))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('contenttypes', '0002_remove_content_type_name'),
+        ('converse', '0005_slackauth_weight'),
+        ('grocery', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='groceryuser',
+            name='converse_user',
+            field=models.OneToOneField(null=True, on_delete=django.db.models.deletion.CASCADE, related_name='app_user', to='converse.TalkUser'),
+        ),
+        migrations.AddField(
+            model_name='organization',
+            name='converse_org',
+            field=models.OneToOneField(null=True, on_delete=django.db.models.deletion.CASCADE, related_name='app_org', to='converse.Auth'),
+        ),
+        migrations.AlterField(
+            model_name='groceryuser',
+            name='content_type',
+            field=models.ForeignKey(null=True, on_delete=django.db.models.deletion.CASCADE, to='contenttypes.ContentType'),
+        ),
+        migrations.AlterField(
+            model_name='groceryuser',
+            name='object_id',
+            field=models.PositiveIntegerField(null=True),
+        ),
+        migrations.AlterField(
+            model_name='organization',
+            name='content_type',
+            field=models.ForeignKey(null=True, on_delete=django.db.models.deletion.CASCADE, to='contenttypes.ContentType'),
+        ),
+        migrations.AlterField(
+            model_name='organization',
+            name='object_id',
+            field=models.PositiveIntegerField(null=True),
+        ),
+        migrations.RunPython(link_directly, link_generically),
+        migrations.RemoveField(
+            model_name='groceryuser',
+            name='content_type',
+        ),
+        migrations.RemoveField(
+            model_name='groceryuser',
+            name='object_id',
+        ),
+        migrations.RemoveField(
+            model_name='organization',
+            name='content_type',
+        ),
+        migrations.RemoveField(
+            model_name='organization',
+            name='object_id',
+        ),
+        migrations.AlterField(
+            model_name='groceryuser',
+            name='converse_user',
+            field=models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='app_user', to='converse.TalkUser'),
+        ),
+        migrations.AlterField(
+            model_name='organization',
+            name='converse_org',
+            field=models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='app_org', to='converse.Auth'),
+        ),
+    ]
@@ -1,6 +1,1323 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals
 
-from django.test import TestCase
+import io
+import json
+import logging
+import os
+import shutil
+import tempfile
+import time
+from unittest import skipIf
 
-# Create your tests here.
+from celery import Celery
+from celery.exceptions import Retry, SoftTimeLimitExceeded
+from celery.signals import task_postrun
+from django.contrib.contenttypes.models import ContentType
+from django.core.cache import caches
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.db import connection
+from django.urls import reverse
+from six import StringIO
+
+from converse import tasks, views
+from converse.clients import slack_client, slack_clients, SlackClientRegistry
+from converse.ratelimits import SlackRateLimiter
+from converse.batching import EventBatcher
+from converse.benchmarks import BENCHMARK_ACTION, MessageBenchmark, ReplayRecord, TraceReplay
+from converse.broadcasts import BroadcastSender
+from converse.caches import TTLCache, get_slack_auth, slack_auth_cache, identity_resolver, EventDeduplicator
+from converse.models import Auth, SlackAuth, SlackUser, SlackChannel, Broadcast, APP_MODEL_LINKAGE
+from converse.executors import Executor, BatchActionBase
+from converse.messengers import QuickReply, SlackMessenger
+from converse.nlu import LocalIntentParser, load_apiai_agent, tokenize
+from converse.parsers import ParserBase, ParserResponse, APIAIParser, ParserPool, ChainedParser, FallbackParser, \
+    CircuitBreaker, ParserUnavailable
+from converse.scheduling import TenantScheduler, action_limiter
+from converse.routing import SessionRouter, HashRing, session_queues
+from converse.sync import SlackDirectorySync
+from converse.testing import FakeSlackServer, FakeAPIAIServer
+from converse.tracing import Histogram, MetricsRegistry, STAGE_SECONDS, metrics, span
+from converse.tasks import retrieve_channel_users
+from grocery.models import GroceryUser, Organization, Order
+
+
+def slack_member(slack_id, name, email=None, is_bot=False):
+    return {"id": slack_id, "is_bot": is_bot, "profile": {"real_name": name, "email": email or slack_id + "@x.com"}}
+
+
+class SlackDirectorySyncTest(TestCase):
+    def setUp(self):
+        self.slack_auth = SlackAuth.objects.create(access_token="a", team_id="T1", team_name="Team", bot_id="B1",
+                                                   bot_access_token="b")
+
+    def test_sync_users(self):
+        members = [slack_member("U{}".format(i), "User {}".format(i)) for i in range(20)]
+        members.append(slack_member("B1", "Bot", is_bot=True))
+        user_channel = dict(("U{}".format(i), "D{}".format(i)) for i in range(20))
+        result = SlackDirectorySync(self.slack_auth, batch_size=8).sync_users(members, user_channel)
+        self.assertEqual({"created": 20, "updated": 0, "unchanged": 0}, result.as_dict())
+        self.assertEqual(20, SlackUser.objects.filter(slack_auth=self.slack_auth).count())
+        self.assertEqual(20, GroceryUser.objects.count())
+        slack_user = SlackUser.objects.get(slack_id="U3")
+        self.assertEqual("D3", slack_user.slack_channel)
+        self.assertEqual(slack_user, GroceryUser.objects.get(converse_user=slack_user)._converse_user)
+
+        members[0] = slack_member("U0", "Renamed")
+        user_channel["U1"] = "D100"
+        with self.assertNumQueries(5):
+            result = SlackDirectorySync(self.slack_auth).sync_users(members, user_channel)
+        self.assertEqual({"created": 0, "updated": 2, "unchanged": 18}, result.as_dict())
+        self.assertEqual("Renamed", SlackUser.objects.get(slack_id="U0").name)
+        self.assertEqual("D100", SlackUser.objects.get(slack_id="U1").slack_channel)
+        self.assertEqual("User 1", SlackUser.objects.get(slack_id="U1").name)
+        self.assertEqual(20, GroceryUser.objects.count())
+
+    def test_sync_channels(self):
+        channels = [{"id": "C1", "name": "general", "is_general": True},
+                    {"id": "C2", "name": "random", "is_general": False}]
+        result = SlackDirectorySync(self.slack_auth).sync_channels(channels)
+        self.assertEqual({"created": 2, "updated": 0, "unchanged": 0}, result.as_dict())
+        self.assertEqual("C1", self.slack_auth.slack_channels.get(is_main=True).slack_id)
+
+        channels[1]["name"] = "off-topic"
+        result = SlackDirectorySync(self.slack_auth).sync_channels(channels)
+        self.assertEqual({"created": 0, "updated": 1, "unchanged": 1}, result.as_dict())
+        self.assertEqual("off-topic", SlackChannel.objects.get(slack_id="C2").name)
+        self.assertEqual(1, Organization.objects.count())
+
+
+class RetrieveChannelUsersTest(TestCase):
+    def setUp(self):
+        self.slack_auth = SlackAuth.objects.create(access_token="a", team_id="T1", team_name="Team", bot_id="B1",
+                                                   bot_access_token="b")
+        users = [slack_member("U{}".format(i), "U{}".format(i)) for i in range(450)]
+        channels = [{"id": "C1", "name": "general", "is_general": True}]
+        self.slack = FakeSlackServer(users=users, channels=channels, page_size=200).start()
+
+    def tearDown(self):
+        self.slack.stop()
+
+    def test_paginated_sync(self):
+        before = slack_clients.stats()
+        with override_settings(SLACK_API_URL=self.slack.url):
+            result = retrieve_channel_users(self.slack_auth.pk)
+        after = slack_clients.stats()
+        self.assertEqual(7, after["requests"] - before["requests"])
+        self.assertEqual(1, after["connections"] - before["connections"])
+        self.assertIs(slack_client("b"), slack_client("b"))
+        self.assertEqual({"created": 450, "updated": 0, "unchanged": 0}, result["users"])
+        self.assertEqual({"created": 1, "updated": 0, "unchanged": 0}, result["channels"])
+        self.assertEqual(450, SlackUser.objects.filter(slack_auth=self.slack_auth).count())
+        self.assertEqual("DU449", SlackUser.objects.get(slack_id="U449").slack_channel)
+        self.assertEqual([("200", ""), ("200", "200"), ("200", "400")],
+                         [(params["limit"], params.get("cursor", "")) for name, params in self.slack.requests
+                          if name == "users.list"])
+
+
+class TTLCacheTest(TestCase):
+    def test_expiry_and_eviction(self):
+        now = [0]
+        cache = TTLCache(maxsize=2, ttl=10, timer=lambda: now[0])
+        cache.set("a", 1)
+        cache.set("b", 2)
+        self.assertEqual(1, cache.get("a"))
+        cache.set("c", 3)
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(3, cache.get("c"))
+        now[0] = 10
+        self.assertIsNone(cache.get("a"))
+        self.assertEqual({"hits": 2, "misses": 2, "size": 1, "maxsize": 2}, cache.stats())
+
+    def test_slack_auth_lookup(self):
+        slack_auth_cache.clear()
+        slack_auth = SlackAuth.objects.create(team_id="T1", team_name="Team", bot_access_token="b")
+        self.assertEqual(slack_auth, get_slack_auth("T1"))
+        with self.assertNumQueries(0):
+            self.assertEqual(slack_auth, get_slack_auth("T1"))
+        slack_auth.team_name = "Renamed"
+        slack_auth.save()
+        self.assertEqual("Renamed", get_slack_auth("T1").team_name)
+        self.assertEqual(1, slack_auth_cache.stats()["hits"])
+
+
+class RecordingParser(ParserBase):
+    queries = []
+
+    def parse(self, query, session_id):
+        self.queries.append((query, session_id))
+        return ParserResponse()
+
+
+class IdentityResolverTest(TestCase):
+    def setUp(self):
+        self.parser_class = tasks.parser_class
+        tasks.parser_class = RecordingParser
+        RecordingParser.queries = []
+        slack_auth_cache.clear()
+        identity_resolver.invalidate("T1", ["U1"])
+        self.slack_auth = SlackAuth.objects.create(team_id="T1", team_name="Team", bot_access_token="b")
+        self.slack_user = SlackUser.objects.create(slack_auth=self.slack_auth, slack_id="U1", slack_channel="D1")
+
+    def tearDown(self):
+        tasks.parser_class = self.parser_class
+
+    def test_known_user_reaches_parser_without_queries(self):
+        tasks.slack_message_event("T1", {"user": "U1", "text": "hi"})
+        with self.assertNumQueries(0):
+            tasks.slack_message_event("T1", {"user": "U1", "text": "again"})
+        self.assertEqual([("hi", "T1-U1"), ("again", "T1-U1")], RecordingParser.queries)
+        identity = identity_resolver.resolve(self.slack_auth, "U1")
+        self.assertEqual("D1", identity.channel)
+        self.assertEqual(GroceryUser.objects.get(converse_user=self.slack_user), identity.get_app_user())
+
+    def test_invalidated_on_save(self):
+        self.assertEqual("D1", identity_resolver.resolve(self.slack_auth, "U1").channel)
+        self.slack_user.slack_channel = "D2"
+        self.slack_user.save()
+        self.assertEqual("D2", identity_resolver.resolve(self.slack_auth, "U1").channel)
+
+    def test_users_without_app_user_are_not_cached(self):
+        GroceryUser.objects.filter(converse_user=self.slack_user).delete()
+        identity_resolver.invalidate("T1", ["U1"])
+        self.assertIsNone(identity_resolver.resolve(self.slack_auth, "U1").app_user_id)
+        self.assertEqual({}, identity_resolver.backend.get_many([identity_resolver.key("T1", "U1")]))
+        self.assertIsNone(identity_resolver.resolve_many([(self.slack_auth, "U1")])[("T1", "U1")].app_user_id)
+        self.assertEqual({}, identity_resolver.backend.get_many([identity_resolver.key("T1", "U1")]))
+        app_user = GroceryUser.objects.create(_converse_user=self.slack_user)
+        self.assertEqual(app_user.pk, identity_resolver.resolve(self.slack_auth, "U1").app_user_id)
+
+
+executed = []
+
+
+@Executor(action="test.quick_reply")
+def quick_reply_action(user, params, contexts):
+    executed.append((user, params))
+
+
+class QuickReplyRoutingTest(TestCase):
+    def setUp(self):
+        self.parser_class = tasks.parser_class
+        tasks.parser_class = RecordingParser
+        RecordingParser.queries = []
+        del executed[:]
+        self.slack_auth = SlackAuth.objects.create(team_id="T1", team_name="Team", bot_access_token="b")
+        self.slack_user = SlackUser.objects.create(slack_auth=self.slack_auth, slack_id="U1", slack_channel="D1")
+
+    def tearDown(self):
+        tasks.parser_class = self.parser_class
+
+    def action_event(self, quick_reply):
+        button = SlackMessenger.format_quick_replies([quick_reply])[0]
+        return {"team": {"id": "T1"}, "user": {"id": "U1"}, "actions": [{"name": button["name"],
+                                                                        "value": button["value"]}]}
+
+    def test_action_skips_parser(self):
+        quick_reply = QuickReply("Add milk", action="test.quick_reply", params={"item": "milk"})
+        tasks.slack_action_event(self.action_event(quick_reply))
+        self.assertEqual([], RecordingParser.queries)
+        self.assertEqual([(GroceryUser.objects.get(converse_user=self.slack_user), {"item": "milk"})], executed)
+
+    def test_value_is_parsed(self):
+        tasks.slack_action_event(self.action_event(QuickReply("Add milk")))
+        self.assertEqual([("Add milk", "T1-U1")], RecordingParser.queries)
+        self.assertEqual([], executed)
+
+
+class RateLimitedSlackServer(FakeSlackServer):
+    """Answers with the (status, data, headers) of `responses` in turn"""
+
+    def __init__(self, responses):
+        super(RateLimitedSlackServer, self).__init__()
+        self.responses = list(responses)
+
+    def handle(self, name, query, body, headers):
+        return self.responses.pop(0)
+
+
+class SlackRateLimiterTest(TestCase):
+    def setUp(self):
+        self.clock = [6000.0]
+        self.sleeps = []
+        self.rate_limiter = SlackRateLimiter(limits={"users.info": (2, 60)}, timer=lambda: self.clock[0],
+                                             sleep=self.sleep)
+        self.rate_limiter.cache().clear()
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.clock[0] += seconds
+
+    def test_bucket_waits_for_refill(self):
+        for _ in range(2):
+            self.assertEqual(0, self.rate_limiter.acquire("xoxb", "users.info", {}))
+        self.clock[0] += 15
+        self.assertEqual(45, self.rate_limiter.acquire("xoxb", "users.info", {}))
+        self.assertEqual(0, self.rate_limiter.acquire("another team", "users.info", {}))
+        self.assertEqual(0, self.rate_limiter.acquire("xoxb", "users.list", {}))
+
+    def test_retry_after(self):
+        responses = [(429, {"ok": False, "error": "ratelimited"}, {"Retry-After": "3"}), (200, {"ok": True, "ts": "1"})]
+        with RateLimitedSlackServer(responses) as slack:
+            registry = SlackClientRegistry(rate_limiter=self.rate_limiter)
+            with override_settings(SLACK_API_URL=slack.url):
+                response = registry.get("xoxb").api_call("chat.postMessage", channel="D1", text="hi")
+        self.assertTrue(response["ok"])
+        self.assertEqual([3], self.sleeps)
+        self.assertEqual([], slack.responses)
+
+
+class BroadcastTest(TestCase):
+    def setUp(self):
+        self.slack_auth = SlackAuth.objects.create(team_id="T1", team_name="Team", bot_access_token="b")
+        for i in range(25):
+            SlackUser.objects.create(slack_auth=self.slack_auth, slack_id="U{}".format(i),
+                                     slack_channel="D{}".format(i))
+        self.slack = FakeSlackServer(channel_errors={"D3": "channel_not_found"}).start()
+
+    def tearDown(self):
+        self.slack.stop()
+
+    def send(self, broadcast):
+        with override_settings(SLACK_API_URL=self.slack.url):
+            return BroadcastSender(broadcast, batch_size=10, concurrency=4).run()
+
+    def channels(self):
+        return [params["channel"] for name, params in self.slack.requests if name == "chat.postMessage"]
+
+    def test_broadcast(self):
+        broadcast = Broadcast.objects.create(auth=self.slack_auth, text="hello", total=25)
+        # a select and a save per chunk of 10, plus the failures of the first chunk, and the status updates
+        with self.assertNumQueries(16):
+            self.send(broadcast)
+        broadcast.refresh_from_db()
+        self.assertEqual((Broadcast.COMPLETED, 24, 1, 1.0),
+                         (broadcast.status, broadcast.sent, broadcast.failed, broadcast.progress))
+        self.assertEqual(set("D{}".format(i) for i in range(25)), set(self.channels()))
+        self.assertEqual(25, len(self.channels()))
+        failure = broadcast.failures.get()
+        self.assertEqual("U3", failure.converse_user.slackuser.slack_id)
+
+    def test_resume(self):
+        slack_users = list(SlackUser.objects.filter(slack_auth=self.slack_auth).order_by("pk"))
+        broadcast = Broadcast.objects.create(auth=self.slack_auth, text="hello", total=25,
+                                             status=Broadcast.INTERRUPTED, cursor=slack_users[19].pk, sent=20)
+        self.send(broadcast)
+        self.assertEqual(set("D{}".format(i) for i in range(20, 25)), set(self.channels()))
+        self.assertEqual((Broadcast.COMPLETED, 25, 0), (broadcast.status, broadcast.sent, broadcast.failed))
+
+    def test_running_broadcasts_are_sent_once(self):
+        broadcast = Broadcast.objects.create(auth=self.slack_auth, text="hello", total=25, status=Broadcast.RUNNING)
+        # eg. a task delivered twice, while the first sender runs
+        self.send(Broadcast.objects.get(pk=broadcast.pk))
+        self.assertEqual([], self.channels())
+        self.assertEqual(Broadcast.RUNNING, Broadcast.objects.get(pk=broadcast.pk).status)
+        task, tasks.send_broadcast = tasks.send_broadcast, RecordingTask()
+        try:
+            with self.assertRaises(RuntimeError):
+                broadcast.resume()
+            # the sender died without marking the broadcast as interrupted
+            broadcast.resume(force=True)
+            for _, callback in connection.run_on_commit:
+                callback()
+            self.assertEqual([(broadcast.pk,)], tasks.send_broadcast.calls)
+        finally:
+            tasks.send_broadcast = task
+        self.send(Broadcast.objects.get(pk=broadcast.pk))
+        self.assertEqual(25, len(self.channels()))
+
+    def test_failed_broadcasts_are_interrupted(self):
+        broadcast = Broadcast.objects.create(auth=self.slack_auth, text="hello", total=25)
+        sender = BroadcastSender(broadcast, batch_size=10)
+        sender.recipients = lambda: iter([None])
+        with self.assertRaises(TypeError):
+            sender.run()
+        self.assertEqual(Broadcast.INTERRUPTED, Broadcast.objects.get(pk=broadcast.pk).status)
+
+    def test_broadcasts_are_queued_on_commit(self):
+        task, tasks.send_broadcast = tasks.send_broadcast, RecordingTask()
+        try:
+            broadcast = self.slack_auth.broadcast("hello")
+            broadcast.resume()
+            # the test case runs in a transaction which is never committed
+            self.assertEqual([], tasks.send_broadcast.calls)
+            for _, callback in connection.run_on_commit:
+                callback()
+            self.assertEqual([(broadcast.pk,), (broadcast.pk,)], tasks.send_broadcast.calls)
+        finally:
+            tasks.send_broadcast = task
+
+
+class ParserPoolTest(TestCase):
+    def setUp(self):
+        self.apiai = FakeAPIAIServer(action="list.add", speech="Added", parameters={"item": "milk"},
+                                     contexts={"list": {"id": "1"}}, client_token="token").start()
+
+    def tearDown(self):
+        self.apiai.stop()
+
+    def test_reused_parser_keeps_connection(self):
+        pool = ParserPool(maxsize=1)
+        with override_settings(API_AI_URL=self.apiai.url, API_AI_CLIENT_TOKEN="token"):
+            with pool.parser(APIAIParser) as parser:
+                response = parser.parse("milk", "T1-U1")
+            with pool.parser(APIAIParser) as other:
+                other.parse("eggs", "T1-U1")
+        self.assertIs(parser, other)
+        self.assertEqual(("Added", "list.add", {"item": "milk"}, {"list": {"id": "1"}}, True),
+                         (response.text, response.action, response.params, response.contexts,
+                          response.slot_filling_complete))
+        self.assertEqual(1, self.apiai.connections)
+        self.assertEqual({"query": "milk", "lang": "en", "sessionId": "T1-U1"}, self.apiai.requests[0])
+        self.assertEqual(2, len(self.apiai.requests))
+
+
+class LocalIntentParserTest(TestCase):
+    training = os.path.join(os.path.dirname(__file__), "intents.json")
+
+    def setUp(self):
+        LocalIntentParser.sessions.clear()
+        self.parser = LocalIntentParser(training=self.training)
+
+    def test_complete_intent(self):
+        response = self.parser.parse("please add 4 apples", "T1-U1")
+        self.assertEqual(("grocery.add", {"item": "apple", "quantity": 4}, True),
+                         (response.action, response.params, response.slot_filling_complete))
+        self.assertEqual("Adding 4 apple to your list", response.text)
+        self.assertEqual({"grocery": {"item": "apple", "quantity": 4}}, response.contexts)
+
+    def test_decimal_numbers(self):
+        self.assertEqual(["add", "2.5", "kg", "of", "apples", "for", "$3.50"],
+                         tokenize("Add 2.5 kg of apples for $3.50"))
+        response = self.parser.parse("please add 2.5 apples", "T1-U1")
+        self.assertEqual({"item": "apple", "quantity": 2.5}, response.params)
+
+    def test_slot_filling(self):
+        response = self.parser.parse("i need bananas", "T1-U1")
+        self.assertEqual(("grocery.add", False, "How many?"),
+                         (response.action, response.slot_filling_complete, response.text))
+        self.assertEqual("What would you like to add?", self.parser.parse("add some", "T1-U2").text)
+        response = LocalIntentParser(training=self.training).parse("5", "T1-U1")
+        self.assertEqual(("grocery.add", {"item": "banana", "quantity": 5}, True),
+                         (response.action, response.params, response.slot_filling_complete))
+        self.assertEqual("How many?", self.parser.parse("eggs", "T1-U2").text)
+
+    def test_other_intents(self):
+        response = self.parser.parse("hello there", "T1-U1")
+        self.assertEqual((None, True), (response.action, response.slot_filling_complete))
+        self.assertTrue(response.text.startswith("Hello!"))
+        response = self.parser.parse("xyzzy", "T1-U1")
+        self.assertEqual((None, False, "Sorry, I did not understand that."),
+                         (response.action, response.slot_filling_complete, response.text))
+
+    def test_apiai_agent(self):
+        path = tempfile.mkdtemp()
+        try:
+            os.makedirs(os.path.join(path, "intents"))
+            os.makedirs(os.path.join(path, "entities"))
+            with open(os.path.join(path, "entities", "item.json"), "w") as f:
+                json.dump({"name": "item", "entries": [{"value": "apple", "synonyms": ["apple", "apples"]}]}, f)
+            with open(os.path.join(path, "intents", "add.json"), "w") as f:
+                json.dump({"name": "add", "userSays": [{"data": [{"text": "add "}, {"text": "apples", "alias": "item",
+                                                                                    "meta": "@item"}]}],
+                           "responses": [{"action": "grocery.add", "affectedContexts": [{"name": "grocery"}],
+                                          "parameters": [{"name": "item", "dataType": "@item", "required": True,
+                                                          "prompts": ["Which item?"]}],
+                                          "messages": [{"type": 0, "speech": "Added $item"}]}]}, f)
+            intents, entities = load_apiai_agent(path)
+        finally:
+            shutil.rmtree(path)
+        self.assertEqual({"item": {"apple": ["apple", "apples"]}}, entities)
+        intent = intents[0]
+        self.assertEqual(("add", "grocery.add", ["add apples"], "Added $item", ["grocery"]),
+                         (intent.name, intent.action, intent.examples, intent.response, intent.contexts))
+        self.assertEqual([("item", "item", True, "Which item?")],
+                         [(slot.name, slot.entity, slot.required, slot.prompt) for slot in intent.slots])
+
+
+class ScriptedParser(ParserBase):
+    """Sleeps for the delays of `script` in turn, and raises for the None ones"""
+    script = []
+    calls = []
+
+    def parse(self, query, session_id):
+        self.calls.append(query)
+        delay = self.script.pop(0)
+        if delay is None:
+            raise RuntimeError("parser error")
+        time.sleep(delay)
+        response = ParserResponse()
+        response.text = "{} after {}".format(query, delay)
+        return response
+
+
+class IdempotentScriptedParser(ScriptedParser):
+    idempotent = True
+
+
+class EchoParser(ParserBase):
+    def parse(self, query, session_id):
+        response = ParserResponse()
+        response.text = "echo " + query
+        return response
+
+
+class FallbackParserTest(TestCase):
+    def setUp(self):
+        ScriptedParser.script = []
+        ScriptedParser.calls = []
+
+    def test_timeout_falls_back(self):
+        ScriptedParser.script = [0.5]
+        parser = FallbackParser([ChainedParser(ScriptedParser, timeout=0.1), ChainedParser(EchoParser, timeout=0.1)])
+        start = time.time()
+        self.assertEqual("echo hi", parser.parse("hi", "T1-U1").text)
+        self.assertLess(time.time() - start, 0.4)
+
+    def test_circuit_breaker(self):
+        ScriptedParser.script = [None, None, None]
+        chained_parser = ChainedParser(ScriptedParser, timeout=1, failure_threshold=2, reset_timeout=60)
+        parser = FallbackParser([chained_parser], fallback_text="Try again later")
+        for _ in range(3):
+            self.assertEqual("Try again later", parser.parse("hi", "T1-U1").text)
+        self.assertEqual(2, len(ScriptedParser.calls))
+        self.assertTrue(chained_parser.breaker.is_open)
+
+    def test_hedged_request(self):
+        ScriptedParser.script = [1.0, 0]
+        chained_parser = ChainedParser(IdempotentScriptedParser, timeout=2, hedge_percentile=95)
+        for _ in range(20):
+            chained_parser.latencies.add(0.05)
+        start = time.time()
+        self.assertEqual("hi after 0", chained_parser.parse("hi", "T1-U1").text)
+        self.assertLess(time.time() - start, 0.5)
+        self.assertEqual(["hi", "hi"], ScriptedParser.calls)
+
+    def test_stateful_parsers_are_not_hedged(self):
+        with self.assertRaises(RuntimeError):
+            ChainedParser(ScriptedParser, hedge_percentile=95)
+
+    def test_calls_in_flight_are_bounded(self):
+        ScriptedParser.script = [0.5, 0.5, 0]
+        chained_parser = ChainedParser(ScriptedParser, timeout=0.05, max_threads=2)
+        for _ in range(2):
+            with self.assertRaises(ParserUnavailable):
+                chained_parser.parse("hi", "T1-U1")
+        self.assertEqual(2, chained_parser.in_flight)
+        with self.assertRaises(ParserUnavailable) as cm:
+            chained_parser.parse("hi", "T1-U1")
+        self.assertIn("in flight", str(cm.exception))
+        self.assertEqual(["hi", "hi"], ScriptedParser.calls)
+        time.sleep(0.6)
+        self.assertEqual(0, chained_parser.in_flight)
+        self.assertEqual("hi after 0", chained_parser.parse("hi", "T1-U1").text)
+
+    def test_breaker_trial(self):
+        now = [0]
+        breaker = CircuitBreaker(failure_threshold=1, reset_timeout=10, timer=lambda: now[0])
+        breaker.record_failure()
+        self.assertFalse(breaker.allow())
+        now[0] = 10
+        self.assertTrue(breaker.allow())
+        self.assertFalse(breaker.allow())
+        breaker.record_failure()
+        now[0] = 15
+        self.assertFalse(breaker.allow())
+        now[0] = 20
+        self.assertTrue(breaker.allow())
+        breaker.record_success()
+        self.assertTrue(breaker.allow())
+
+    def test_breaker_trial_refused_in_flight(self):
+        # the trial call is refused while the timed out call still runs, and is given back for a later call
+        ScriptedParser.script = [0.5, 0]
+        chained_parser = ChainedParser(ScriptedParser, timeout=0.05, failure_threshold=1, reset_timeout=0,
+                                       max_threads=1)
+        with self.assertRaises(ParserUnavailable):
+            chained_parser.parse("hi", "T1-U1")
+        self.assertTrue(chained_parser.breaker.is_open)
+        with self.assertRaises(ParserUnavailable) as cm:
+            chained_parser.parse("hi", "T1-U1")
+        self.assertIn("in flight", str(cm.exception))
+        time.sleep(0.6)
+        self.assertEqual(0, chained_parser.in_flight)
+        self.assertEqual("hi after 0", chained_parser.parse("hi", "T1-U1").text)
+        self.assertFalse(chained_parser.breaker.is_open)
+
+
+class RecordingTask(object):
+    def __init__(self, name=None):
+        self.name = name
+        self.calls = []
+        self.options = []
+
+    def delay(self, *args):
+        self.calls.append(args)
+
+    def apply_async(self, args, kwargs=None, queue=None, **options):
+        self.calls.append((args, kwargs, queue))
+        self.options.append(options)
+
+
+class RecordingHandler(logging.Handler):
+    def __init__(self):
+        logging.Handler.__init__(self, level=logging.DEBUG)
+        self.messages = []
+
+    def emit(self, record):
+        self.messages.append(record.getMessage())
+
+
+@override_settings(SLACK_VERIFICATION_TOKEN="vt")
+class EventDeduplicationTest(TestCase):
+    def setUp(self):
+        self.tasks = views.slack_message_event, views.slack_action_event, views.event_deduplicator
+        views.slack_message_event = RecordingTask()
+        views.slack_action_event = RecordingTask()
+        views.event_deduplicator = EventDeduplicator()
+        caches["default"].clear()
+
+    def tearDown(self):
+        views.slack_message_event, views.slack_action_event, views.event_deduplicator = self.tasks
+
+    def post_event(self, event_id, text, retry=None):
+        body = {"token": "vt", "type": "event_callback", "team_id": "T1", "event_id": event_id,
+                "event": {"type": "message", "user": "U1", "text": text, "ts": "1.0", "channel": "D1"}}
+        headers = {"HTTP_X_SLACK_RETRY_NUM": str(retry)} if retry else {}
+        return self.client.post(reverse("converse:slack:webhook"), json.dumps(body), content_type="application/json",
+                                **headers)
+
+    def test_retried_event_is_queued_once(self):
+        self.assertEqual(200, self.post_event("Ev1", "add milk").status_code)
+        self.assertEqual(200, self.post_event("Ev1", "add milk", retry=1).status_code)
+        self.post_event("Ev2", "add eggs")
+        self.assertEqual([("T1", "add milk"), ("T1", "add eggs")],
+                         [(team_id, event["text"]) for team_id, event in views.slack_message_event.calls])
+
+    def test_shared_cache_backstop(self):
+        self.post_event("Ev1", "add milk")
+        # another web process, with its own local cache
+        views.event_deduplicator = EventDeduplicator()
+        self.post_event("Ev1", "add milk", retry=1)
+        self.assertEqual(1, len(views.slack_message_event.calls))
+
+    def test_action_ts(self):
+        payload = {"token": "vt", "team": {"id": "T1"}, "user": {"id": "U1"}, "action_ts": "1.5",
+                   "actions": [{"name": "yes", "value": "yes"}]}
+        for _ in range(2):
+            self.client.post(reverse("converse:slack:action"), {"payload": json.dumps(payload)})
+        payload["action_ts"] = "2.5"
+        self.client.post(reverse("converse:slack:action"), {"payload": json.dumps(payload)})
+        self.assertEqual(["1.5", "2.5"], [call[0]["action_ts"] for call in views.slack_action_event.calls])
+
+    def test_action_retry(self):
+        payload = {"token": "vt", "team": {"id": "T1"}, "user": {"id": "U1"}, "action_ts": "1.5",
+                   "actions": [{"name": "yes", "value": "yes"}]}
+        handler = RecordingHandler()
+        logger = logging.getLogger("converse.views")
+        level = logger.level
+        logger.addHandler(handler)
+        logger.setLevel(logging.INFO)
+        try:
+            for retry in [None, "1"]:
+                headers = {"HTTP_X_SLACK_RETRY_NUM": retry} if retry else {}
+                self.client.post(reverse("converse:slack:action"), {"payload": json.dumps(payload)}, **headers)
+        finally:
+            logger.removeHandler(handler)
+            logger.setLevel(level)
+        self.assertEqual(1, len(views.slack_action_event.calls))
+        self.assertIn("Dropping duplicate event action:T1:U1:1.5 (retry 1)", handler.messages)
+
+
+class SessionRouterTest(TestCase):
+    def test_sessions_stay_on_their_queue(self):
+        router = SessionRouter(queues=session_queues(count=4))
+        message = router("converse.tasks.slack_message_event", ("T1", {"user": "U1", "text": "hi"}), {}, {})
+        action = router("converse.tasks.slack_action_event", ({"team": {"id": "T1"}, "user": {"id": "U1"}},), {}, {})
+        self.assertEqual(message, action)
+        self.assertIn(message["queue"], ["converse.session.{}".format(i) for i in range(4)])
+        self.assertIsNone(router("converse.tasks.update_user_list", (), {}, {}))
+        used = set(router.queue_for("T1", "U{}".format(i)) for i in range(100))
+        self.assertEqual(4, len(used))
+
+    def test_disabled_without_queues(self):
+        self.assertIsNone(SessionRouter(queues=[])("converse.tasks.slack_message_event", ("T1", {"user": "U1"}), {},
+                                                   {}))
+
+    def test_consistent_hashing(self):
+        keys = ["T1-U{}".format(i) for i in range(1000)]
+        before = HashRing(session_queues(count=8))
+        after = HashRing(session_queues(count=9))
+        moved = [key for key in keys if before.get(key) != after.get(key)]
+        self.assertTrue(all(after.get(key) == "converse.session.8" for key in moved))
+        self.assertLess(len(moved), 200)
+
+    def test_celery_routing(self):
+        app = Celery(set_as_current=False)
+        router = SessionRouter(queues=session_queues(count=4))
+        app.conf.task_routes = (router,)
+        options = app.amqp.router.route({}, "converse.tasks.slack_message_event", args=("T1", {"user": "U1"}))
+        self.assertEqual(router.queue_for("T1", "U1"), options["queue"].name)
+
+
+class TenantSchedulerTest(TestCase):
+    def setUp(self):
+        caches["default"].clear()
+        slack_auth_cache.clear()
+        SlackAuth.objects.create(team_id="T1", team_name="Noisy", bot_access_token="b")
+        SlackAuth.objects.create(team_id="T2", team_name="Premium", bot_access_token="b", weight=2)
+        self.scheduler = TenantScheduler(concurrency=2)
+        self.task = RecordingTask()
+
+    def test_teams_over_their_limit_overflow(self):
+        for _ in range(3):
+            self.scheduler.submit("T1", self.task, "T1", {"text": "spam"})
+        for _ in range(4):
+            self.assertTrue(self.scheduler.submit("T2", self.task, "T2", {"text": "hi"}))
+        self.assertEqual([None, None, "converse.overflow"], [queue for args, _, queue in self.task.calls[:3]])
+        self.assertEqual({"scheduled": True}, self.task.calls[0][1])
+        self.assertEqual({"T1": 3, "T2": 4}, self.scheduler.depths())
+
+        self.scheduler.release("T1")
+        self.scheduler.release("T1")
+        self.assertTrue(self.scheduler.submit("T1", self.task, "T1", {"text": "again"}))
+        self.assertEqual(2, self.scheduler.depth("T1"))
+
+    def test_session_routed_events_do_not_overflow(self):
+        # the events of a session stay on its queue, in order, whatever the depth of the team
+        scheduler = TenantScheduler(concurrency=1, router=SessionRouter(queues=session_queues(count=4)))
+        task = RecordingTask(name="converse.tasks.slack_message_event")
+        for text in ["a", "b", "c"]:
+            self.assertTrue(scheduler.submit("T1", task, "T1", {"user": "U1", "text": text}))
+        self.assertEqual([None, None, None], [queue for args, _, queue in task.calls])
+        self.assertEqual(3, scheduler.depth("T1"))
+        # without session queues, the router routes nothing, and the events overflow
+        scheduler = TenantScheduler(concurrency=1, router=SessionRouter(queues=[]))
+        scheduler.submit("T3", task, "T3", {"user": "U1", "text": "a"})
+        self.assertFalse(scheduler.submit("T3", task, "T3", {"user": "U1", "text": "b"}))
+
+    def test_task_releases_its_slot(self):
+        tasks.tenant_scheduler, scheduler = self.scheduler, tasks.tenant_scheduler
+        try:
+            self.scheduler.submit("T9", self.task, "T9", {"user": "U1", "text": "hi"})
+            with self.assertRaises(SlackAuth.DoesNotExist):
+                # the team is unknown, but the slot is released anyway
+                tasks.slack_message_event("T9", {"user": "U1", "text": "hi"}, scheduled=True)
+        finally:
+            tasks.tenant_scheduler = scheduler
+        self.assertEqual(0, self.scheduler.depth("T9"))
+
+    def test_disabled(self):
+        self.assertTrue(TenantScheduler().submit("T1", self.task, "T1", {"text": "hi"}))
+        self.assertEqual([("T1", {"text": "hi"})], self.task.calls)
+
+
+class EventBatchTest(TestCase):
+    def setUp(self):
+        self.parser_class = tasks.parser_class
+        tasks.parser_class = RecordingParser
+        RecordingParser.queries = []
+        slack_auth_cache.clear()
+        self.slack_auths = [SlackAuth.objects.create(team_id="T{}".format(i), team_name="Team", bot_access_token="b")
+                            for i in range(2)]
+        for slack_auth in self.slack_auths:
+            for i in range(2):
+                SlackUser.objects.create(slack_auth=slack_auth, slack_id="U{}".format(i), slack_channel="D{}".format(i))
+                identity_resolver.invalidate(slack_auth.team_id, ["U{}".format(i)])
+        slack_auth_cache.clear()
+
+    def tearDown(self):
+        tasks.parser_class = self.parser_class
+
+    def test_batch_resolves_in_bulk(self):
+        ContentType.objects.get_for_model(SlackUser)
+        events = [(tasks.slack_message_event.name, ("T0", {"user": "U0", "text": "one"})),
+                  (tasks.slack_message_event.name, ("T1", {"user": "U1", "text": "two"})),
+                  (tasks.slack_action_event.name, ({"team": {"id": "T0"}, "user": {"id": "U1"},
+                                                    "actions": [{"name": "three", "value": "three"}]},)),
+                  (tasks.slack_message_event.name, ("T9", {"user": "U0", "text": "unknown team"}))]
+        with self.assertNumQueries(3):
+            tasks.slack_event_batch(events)
+        self.assertEqual([("one", "T0-U0"), ("two", "T1-U1"), ("three", "T0-U1")], RecordingParser.queries)
+
+    def test_batcher_flushes_on_size_and_time(self):
+        batch_task, tasks.slack_event_batch = tasks.slack_event_batch, RecordingTask()
+        try:
+            batcher = EventBatcher(max_size=2, max_wait=0.05)
+            batcher.add("Ev1", tasks.slack_message_event, "T0", {"user": "U0", "text": "one"})
+            batcher.add("Ev2", tasks.slack_message_event, "T0", {"user": "U0", "text": "two"})
+            self.assertEqual(1, len(tasks.slack_event_batch.calls))
+            batcher.add("Ev3", tasks.slack_message_event, "T0", {"user": "U0", "text": "three"})
+            time.sleep(0.2)
+            calls = tasks.slack_event_batch.calls
+        finally:
+            tasks.slack_event_batch = batch_task
+        self.assertEqual([["one", "two"], ["three"]], [[args[1]["text"] for _, args in events] for events, in calls])
+
+    def test_batches_per_session_queue(self):
+        router = SessionRouter(queues=session_queues(count=4))
+        sessions = [("T0", "U0"), ("T0", "U1"), ("T1", "U0"), ("T0", "U0")]
+        batch_task, tasks.slack_event_batch = tasks.slack_event_batch, RecordingTask()
+        try:
+            batcher = EventBatcher(max_size=4, max_wait=10, router=router)
+            for i, (team_id, slack_id) in enumerate(sessions):
+                batcher.add("Ev{}".format(i), tasks.slack_message_event, team_id,
+                            {"user": slack_id, "text": str(i)})
+            calls = tasks.slack_event_batch.calls
+        finally:
+            tasks.slack_event_batch = batch_task
+        # each batch goes to the queue of its sessions, in the order the events were received
+        for (events,), _, queue in calls:
+            self.assertEqual(set([queue]), set(router.queue_for(args[0], args[1]["user"]) for _, args in events))
+        texts = [args[1]["text"] for (events,), _, _ in calls for _, args in events]
+        self.assertEqual(["0", "3"], [text for text in texts if text in ("0", "3")])
+        self.assertEqual(4, len(texts))
+
+
+@Executor(action="test.queued", queue="converse.actions", timeout=10, concurrency=1, priority=7)
+def queued_action(user, params, contexts):
+    executed.append((user, params))
+
+
+@Executor(action="test.slow", queue="converse.actions", timeout=1, concurrency=1)
+def slow_action(user, params, contexts):
+    raise SoftTimeLimitExceeded()
+
+
+@Executor(action="test.pooled", timeout=0.05, concurrency=1)
+def pooled_action(user, params, contexts):
+    time.sleep(params["sleep"])
+    executed.append((user, params))
+
+
+class ActionOptionsTest(TestCase):
+    def setUp(self):
+        del executed[:]
+        caches["default"].clear()
+        self.slack_auth = SlackAuth.objects.create(team_id="T1", team_name="Team", bot_access_token="b")
+        slack_user = SlackUser.objects.create(slack_auth=self.slack_auth, slack_id="U1", slack_channel="D1")
+        self.user = GroceryUser.objects.get(converse_user=slack_user)
+
+    def test_queued_action(self):
+        execute_action, tasks.execute_action = tasks.execute_action, RecordingTask()
+        try:
+            Executor.execute(action="test.queued", user=self.user, params={"item": "milk"}, contexts={})
+            calls, options = tasks.execute_action.calls, tasks.execute_action.options
+        finally:
+            tasks.execute_action = execute_action
+        self.assertEqual([(("test.queued", self.user.pk, {"item": "milk"}, {}), None, "converse.actions")], calls)
+        self.assertEqual([{"priority": 7, "soft_time_limit": 10, "time_limit": 15}], options)
+        self.assertEqual([], executed)
+
+        tasks.execute_action("test.queued", self.user.pk, {"item": "milk"}, {})
+        self.assertEqual([(self.user, {"item": "milk"})], executed)
+        self.assertEqual(0, action_limiter.running("test.queued"))
+
+    def test_queued_action_concurrency(self):
+        self.assertTrue(action_limiter.acquire("test.queued", 1))
+        with self.assertRaises(Retry):
+            tasks.execute_action("test.queued", self.user.pk, {"item": "milk"}, {})
+        self.assertEqual([], executed)
+        action_limiter.release("test.queued")
+        tasks.execute_action("test.queued", self.user.pk, {"item": "milk"}, {})
+        self.assertEqual(1, len(executed))
+
+    def test_queued_action_time_limit(self):
+        with self.assertRaises(SoftTimeLimitExceeded):
+            tasks.execute_action("test.slow", self.user.pk, {}, {})
+        self.assertEqual(0, action_limiter.running("test.slow"))
+
+    def test_pooled_action_timeout(self):
+        start = time.time()
+        self.assertIsNone(Executor.execute(action="test.pooled", user=self.user, params={"sleep": 0.5}, contexts={}))
+        self.assertLess(time.time() - start, 0.4)
+        self.assertEqual([], executed)
+        Executor.execute(action="test.pooled", user=self.user, params={"sleep": 0}, contexts={})
+        time.sleep(0.6)
+        # the pool has a single thread, so the second run waits for the first one
+        self.assertEqual([0.5, 0], [params["sleep"] for _, params in executed])
+
+
+@Executor(action="test.batched")
+class BatchedAction(BatchActionBase):
+    batch_size = 3
+    batch_wait = 0.05
+    batches = []
+
+    @classmethod
+    def execute_batch(cls, invocations):
+        cls.batches.append([invocation.params["item"] for invocation in invocations])
+
+
+@Executor(action="test.failing_batch")
+class FailingBatchedAction(BatchActionBase):
+    batch_wait = 10
+
+    @classmethod
+    def execute_batch(cls, invocations):
+        raise ValueError("database is down")
+
+
+class RecordingMessenger(object):
+    def __init__(self):
+        self.sent = []
+
+    def send(self, text):
+        self.sent.append(text)
+        return True
+
+
+class BatchActionTest(TestCase):
+    def setUp(self):
+        # the decorator returns the ExecutorInner of the action
+        self.action_class = BatchedAction.obj
+        self.action_class.batches = []
+        self.slack_auth = SlackAuth.objects.create(team_id="T1", team_name="Team", bot_access_token="b")
+        self.users = []
+        for i in range(2):
+            slack_user = SlackUser.objects.create(slack_auth=self.slack_auth, slack_id="U{}".format(i))
+            user = GroceryUser.objects.get(converse_user=slack_user)
+            user._converse_user.messenger = RecordingMessenger()
+            self.users.append(user)
+
+    def add(self, action, user, item):
+        Executor.execute(action=action, user=user, params={"item": item, "quantity": 1}, contexts={})
+
+    def test_batches_by_size_and_time(self):
+        for item in ["milk", "eggs", "bread", "jam"]:
+            self.add("test.batched", self.users[0], item)
+        self.assertEqual([["milk", "eggs", "bread"]], self.action_class.batches)
+        time.sleep(0.2)
+        self.assertEqual([["milk", "eggs", "bread"], ["jam"]], self.action_class.batches)
+
+    def test_batches_span_tasks(self):
+        # each message is handled by a task of its own, and their invocations are executed as one batch
+        slack_auth_cache.clear()
+        identity_resolver.invalidate("T1", ["U0", "U1"])
+        parser_class = tasks.parser_class
+        tasks.parser_class = BudgetParser
+        BudgetParser.response = ParserResponse()
+        BudgetParser.response.action = "test.batched"
+        BudgetParser.response.slot_filling_complete = True
+        try:
+            for i, item in enumerate(["milk", "eggs"]):
+                BudgetParser.response.params = {"item": item}
+                tasks.slack_message_event("T1", {"user": "U{}".format(i), "text": item})
+                task_postrun.send(sender=None, task_id="t{}".format(i), task=None, args=(), kwargs={}, retval=None,
+                                  state="SUCCESS")
+        finally:
+            tasks.parser_class = parser_class
+        self.assertEqual([], self.action_class.batches)
+        time.sleep(0.2)
+        self.assertEqual([["milk", "eggs"]], self.action_class.batches)
+
+    def test_failed_batches_are_raised(self):
+        self.add("test.failing_batch", self.users[0], "milk")
+        self.add("test.batched", self.users[0], "eggs")
+        with self.assertRaises(RuntimeError) as context:
+            Executor.flush()
+        self.assertIn("FailingBatchedAction", str(context.exception))
+        # the other batches are executed all the same
+        self.assertEqual([["eggs"]], self.action_class.batches)
+        self.assertEqual(0, Executor.flush())
+
+    def test_grocery_orders_are_bulk_created(self):
+        for user, item in [(self.users[0], "milk"), (self.users[1], "eggs"), (self.users[0], "bread")]:
+            self.add("grocery.add", user, item)
+        # the organization of each user, and a single insert
+        with self.assertNumQueries(5):
+            self.assertEqual(3, Executor.flush())
+        self.assertEqual(["milk", "eggs", "bread"], list(Order.objects.order_by("pk").values_list("item", flat=True)))
+        self.assertEqual(["milk, bread were successfully added"], self.users[0].messenger.sent)
+        self.assertEqual(["eggs was successfully added"], self.users[1].messenger.sent)
+
+
+@override_settings(SLACK_VERIFICATION_TOKEN="vt", METRICS_TOKEN="secret")
+class TracingTest(TestCase):
+    def setUp(self):
+        caches["default"].clear()
+        metrics.clear()
+        metrics.team_label = True
+        self.parser_class = tasks.parser_class
+        tasks.parser_class = RecordingParser
+        self.task = views.slack_message_event
+        views.slack_message_event = RecordingTask()
+        slack_auth = SlackAuth.objects.create(team_id="T1", team_name="Team", bot_access_token="b")
+        SlackUser.objects.create(slack_auth=slack_auth, slack_id="U1", slack_channel="D1")
+
+    def tearDown(self):
+        tasks.parser_class = self.parser_class
+        views.slack_message_event = self.task
+        metrics.team_label = False
+
+    def get_metrics(self):
+        return self.client.get(reverse("converse:metrics"), HTTP_AUTHORIZATION="Bearer secret")
+
+    def test_histogram(self):
+        histogram = Histogram(buckets=(0.1, 1.0))
+        for value in [0.05, 0.5, 0.7, 3]:
+            histogram.observe(value)
+        self.assertEqual([(0.1, 1), (1.0, 3), ("+Inf", 4)], histogram.cumulative())
+        self.assertAlmostEqual(4.25, histogram.sum)
+
+    def test_pipeline_stages(self):
+        body = {"token": "vt", "type": "event_callback", "team_id": "T1", "event_id": "Ev1",
+                "event_time": int(time.time()) - 2,
+                "event": {"type": "message", "user": "U1", "text": "hi", "ts": "1.0", "channel": "D1"}}
+        self.client.post(reverse("converse:slack:webhook"), json.dumps(body), content_type="application/json")
+        (team_id, event), = views.slack_message_event.calls
+        self.assertEqual(body["event_time"], event["event_time"])
+        tasks.slack_message_event(team_id, event)
+        with span("custom", team_id="T2", action='a "quoted" action'):
+            pass
+
+        response = self.get_metrics()
+        self.assertEqual(200, response.status_code)
+        text = response.content.decode("utf-8")
+        self.assertIn("# TYPE converse_stage_seconds histogram", text)
+        for stage in ["webhook", "identity", "parse"]:
+            self.assertIn('converse_stage_seconds_count{{action="",stage="{}",team_id="T1"}} 1'.format(stage), text)
+        self.assertIn('converse_stage_seconds_count{action="a \\"quoted\\" action",stage="custom",team_id="T2"} 1',
+                      text)
+        self.assertIn('converse_queue_lag_seconds_bucket{stage="worker",team_id="T1",le="1.0"} 0', text)
+        self.assertIn('converse_queue_lag_seconds_bucket{stage="worker",team_id="T1",le="5.0"} 1', text)
+
+    def test_processes_are_merged(self):
+        with span("parse", team_id="T1"):
+            pass
+        metrics.flush()
+        # another process, sharing the cache
+        other = MetricsRegistry(team_label=True)
+        other.observe(STAGE_SECONDS, 0.2, stage="parse", team_id="T1", action=None)
+        other.flush()
+        (metric, labels, histogram), = [series for series in metrics.collect() if series[0] == STAGE_SECONDS]
+        self.assertEqual({"stage": "parse", "team_id": "T1", "action": ""}, labels)
+        self.assertEqual(2, histogram.count)
+
+    def test_token(self):
+        self.assertEqual(403, self.client.get(reverse("converse:metrics")).status_code)
+        self.assertEqual(403, self.client.get(reverse("converse:metrics"), HTTP_AUTHORIZATION="Bearer other")
+                         .status_code)
+        self.assertEqual(200, self.get_metrics().status_code)
+        with override_settings(METRICS_TOKEN=None):
+            self.assertEqual(403, self.client.get(reverse("converse:metrics")).status_code)
+            self.assertEqual(403, self.client.get(reverse("converse:metrics"), HTTP_AUTHORIZATION="Bearer ")
+                             .status_code)
+
+    def test_team_label_is_opt_in(self):
+        metrics.team_label = False
+        for team_id in ["T1", "T2"]:
+            with span("parse", team_id=team_id):
+                pass
+        text = self.get_metrics().content.decode("utf-8")
+        self.assertIn('converse_stage_seconds_count{action="",stage="parse"} 2', text)
+        self.assertNotIn("team_id", text)
+
+    def test_batched_actions_are_timed_when_executed(self):
+        slack_user = SlackUser.objects.get(slack_id="U1")
+        user = GroceryUser.objects.get(converse_user=slack_user)
+        Executor.execute(action="test.batched", user=user, params={"item": "milk", "quantity": 1}, contexts={})
+        Executor.flush()
+        stages = dict((labels["stage"], histogram.count) for metric, labels, histogram in metrics.pending()
+                      if metric == STAGE_SECONDS)
+        self.assertEqual({"action_batch": 1}, stages)
+
+
+class FakeServersTest(TestCase):
+    def test_directory_sync(self):
+        slack_auth = SlackAuth.objects.create(team_id="T1", team_name="Team", bot_access_token="b")
+        users = [FakeSlackServer.user("U{}".format(i)) for i in range(5)]
+        channels = [{"id": "C1", "name": "general", "is_general": True, "members": ["U0", "U1"]}]
+        with FakeSlackServer(users=users, channels=channels, page_size=2) as slack:
+            with override_settings(SLACK_API_URL=slack.url):
+                retrieve_channel_users(slack_auth.pk)
+                messenger = SlackMessenger("b", "DU3")
+                messenger.send("hello")
+                self.assertEqual(("hello", None, None), messenger.get_latest())
+        self.assertEqual(dict(("U{}".format(i), "DU{}".format(i)) for i in range(5)),
+                         dict(SlackUser.objects.values_list("slack_id", "slack_channel")))
+        self.assertEqual(3, len([name for name, _ in slack.requests if name == "users.list"]))
+
+    def test_apiai(self):
+        with FakeAPIAIServer(action="grocery.add", speech="Adding milk", parameters={"item": "milk"},
+                             latency=0.05) as apiai:
+            with override_settings(API_AI_URL=apiai.url):
+                start = time.time()
+                response = APIAIParser().parse("add milk", "T1-U1")
+        self.assertGreaterEqual(time.time() - start, 0.05)
+        self.assertEqual(("grocery.add", {"item": "milk"}, "Adding milk", True),
+                         (response.action, response.params, response.text, response.slot_filling_complete))
+        self.assertEqual([{"query": "add milk", "lang": "en", "sessionId": "T1-U1"}], apiai.requests)
+
+
+class BenchmarkTest(TestCase):
+    def test_command(self):
+        directory = tempfile.mkdtemp()
+        try:
+            output = os.path.join(directory, "results.json")
+            call_command("converse_benchmark", messages=20, users=3, warmup=2, output=output, stdout=StringIO())
+            with io.open(output, encoding="utf-8") as f:
+                results = json.load(f)
+        finally:
+            shutil.rmtree(directory)
+        self.assertEqual((20, 0, 40), (results["messages"], results["errors"], results["replies"]))
+        self.assertGreater(results["messages_per_second"], 0)
+        self.assertLessEqual(results["latency_ms"]["p50"], results["latency_ms"]["p99"])
+        self.assertEqual(20, results["stages"]["parse"]["count"])
+        self.assertEqual(40, results["stages"]["send"]["count"])
+        self.assertFalse(SlackAuth.objects.exists())
+        self.assertNotIn(BENCHMARK_ACTION, Executor.action_map)
+
+
+class ConcurrentBenchmarkTest(TransactionTestCase):
+    # the threads open connections of their own, which only see the in memory test database of sqlite on python 3
+    @skipIf(connection.vendor == "sqlite" and not connection.features.can_share_in_memory_db,
+            "the test database is not shared with the threads")
+    def test_concurrent_posts(self):
+        results = MessageBenchmark(messages=20, users=3, warmup=2, concurrency=4).run()
+        self.assertEqual((20, 0, 40, 4), (results["messages"], results["errors"], results["replies"],
+                                          results["config"]["concurrency"]))
+        self.assertEqual(20, results["stages"]["parse"]["count"])
+        self.assertFalse(SlackAuth.objects.exists())
+        self.assertFalse(SlackUser.objects.exists())
+        self.assertFalse(GroceryUser.objects.exists())
+        self.assertFalse(Organization.objects.exists())
+
+
+@override_settings(SLACK_VERIFICATION_TOKEN="vt")
+class TraceReplayTest(TestCase):
+    def setUp(self):
+        caches["default"].clear()
+        slack_auth_cache.clear()
+        self.directory = tempfile.mkdtemp()
+        self.trace = os.path.join(self.directory, "trace.jsonl")
+        lines = []
+        for i in range(6):
+            lines.append({"token": "recorded", "type": "event_callback", "team_id": "T{}".format(i % 2),
+                          "event_id": "Ev{}".format(i), "event_time": 1000 + i,
+                          "event": {"type": "message", "user": "U1", "text": "hi", "ts": "{}.0".format(1000 + i),
+                                    "channel": "DU1"}})
+        lines.append({"received_at": 1006.5, "payload": json.dumps({
+            "token": "recorded", "team": {"id": "T0"}, "user": {"id": "U1"}, "action_ts": "1006.5",
+            "actions": [{"name": "yes", "value": "yes"}]})})
+        with io.open(self.trace, "w", encoding="utf-8") as f:
+            f.write(u"\n".join(json.dumps(line) for line in reversed(lines)) + u"\n")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_pacing(self):
+        records = [ReplayRecord({"event_time": 100}, timestamp=100), ReplayRecord({"event_time": 104}, timestamp=104)]
+        self.assertEqual([0, 2], TraceReplay(records, speedup=2).offsets())
+        self.assertEqual([0, 0.1], TraceReplay(records, rate=10).offsets())
+        record = ReplayRecord.from_line(json.dumps({"event_id": "Ev1", "event_time": 100, "event": {"ts": "100.0"}}))
+        bodies = [record.rewrite(run_id, "vt", 200) for run_id in ["a", "b"]]
+        self.assertEqual(["Ev1-a", "Ev1-b"], [body["event_id"] for body in bodies])
+        self.assertEqual(("vt", 200, "200.000000"), (bodies[0]["token"], bodies[0]["event_time"],
+                                                     bodies[0]["event"]["ts"]))
+
+    def test_command(self):
+        output = os.path.join(self.directory, "results.json")
+        # the threads of a higher concurrency would not see the test database
+        call_command("converse_replay", self.trace, rate=100, concurrency=0, output=output, stdout=StringIO())
+        with io.open(output, encoding="utf-8") as f:
+            results = json.load(f)
+        self.assertEqual((7, 6, 1, 0), (results["requests"], results["events"], results["actions"], results["errors"]))
+        self.assertEqual(["T0", "T1"], results["teams_created"])
+        self.assertEqual({"T0": 4, "T1": 3}, dict((team_id, team["requests"])
+                                                  for team_id, team in results["teams"].items()))
+        self.assertEqual(7, results["stages"]["parse"]["count"])
+        self.assertEqual(7, results["replies"])
+        self.assertEqual(1, SlackUser.objects.filter(slack_auth__team_id="T0").count())
+
+    def test_queue_requires_the_urls_of_the_workers(self):
+        with self.assertRaises(CommandError):
+            call_command("converse_replay", self.trace, queue=True, slack_url="http://127.0.0.1:9000/api/",
+                         stdout=StringIO())
+        with self.assertRaises(RuntimeError):
+            TraceReplay([], eager=False, apiai_url="http://127.0.0.1:9001/")
+        self.assertFalse(SlackAuth.objects.exists())
+
+
+# the number of queries each hot path may issue with each linkage of the app models, with the ContentTypes and the
+# SlackAuths cached; lower a budget when a change saves queries, never raise it to let a change through
+QUERY_BUDGETS = {
+    "direct": {
+        "message_event": 0,
+        "message_event_with_action": 1,
+        "slack_message_event_new_session": 2,
+        "slack_action_event": 1,
+        "slack_action_event_new_session": 3,
+        "retrieve_channel_users": 6,
+        "auth_users": 2,
+        "user_attributes": 3,
+        "user_attributes_joined": 1,
+        "users_with_converse": 1,
+        "organization_attributes": 3,
+    },
+    "generic": {
+        "message_event": 0,
+        "message_event_with_action": 4,
+        "slack_message_event_new_session": 2,
+        "slack_action_event": 4,
+        "slack_action_event_new_session": 6,
+        "retrieve_channel_users": 6,
+        "auth_users": 5,
+        "user_attributes": 3,
+        "user_attributes_joined": 4,
+        "users_with_converse": 4,
+        "organization_attributes": 3,
+    },
+}[APP_MODEL_LINKAGE]
+
+
+class BudgetParser(ParserBase):
+    response = None
+
+    def parse(self, query, session_id):
+        return self.response
+
+
+@Executor(action="test.budget")
+def budget_action(user, params, contexts):
+    # the attributes a typical action reads
+    user.messenger.send("Ordering for {}".format(user.org.name))
+
+
+class QueryBudgetTest(TestCase):
+    def setUp(self):
+        ContentType.objects.get_for_model(SlackUser)
+        ContentType.objects.get_for_model(SlackAuth)
+        caches["default"].clear()
+        slack_auth_cache.clear()
+        self.parser_class = tasks.parser_class
+        tasks.parser_class = BudgetParser
+        BudgetParser.response = ParserResponse()
+        BudgetParser.response.text = "ok"
+        self.slack_auth = SlackAuth.objects.create(team_id="T1", team_name="Team", bot_access_token="b")
+        SlackChannel.objects.create(slack_auth=self.slack_auth, slack_id="C1", name="general", is_main=True)
+        self.slack_users = [SlackUser.objects.create(slack_auth=self.slack_auth, slack_id="U{}".format(i),
+                                                     slack_channel="DU{}".format(i), name="User {}".format(i))
+                            for i in range(5)]
+        identity_resolver.invalidate("T1", [slack_user.slack_id for slack_user in self.slack_users])
+        self.slack = FakeSlackServer(users=[FakeSlackServer.user(slack_user.slack_id)
+                                            for slack_user in self.slack_users]).start()
+        self.settings = override_settings(SLACK_API_URL=self.slack.url)
+        self.settings.enable()
+        get_slack_auth("T1")
+
+    def tearDown(self):
+        self.settings.disable()
+        self.slack.stop()
+        tasks.parser_class = self.parser_class
+
+    def assertWithinBudget(self, path, func, *args, **kwargs):
+        """
+        :param allowance: queries allowed besides the budget, eg. per row where the database cannot bulk insert
+        """
+        with CaptureQueriesContext(connection) as context:
+            func(*args)
+        budget = QUERY_BUDGETS[path] + kwargs.get("allowance", 0)
+        if len(context.captured_queries) > budget:
+            self.fail("{} issued {} queries, over its budget of {}:\n{}".format(
+                path, len(context.captured_queries), budget,
+                "\n".join(query["sql"] for query in context.captured_queries)))
+
+    def identity(self, slack_user):
+        return identity_resolver.resolve(self.slack_auth, slack_user.slack_id)
+
+    def action_event(self, slack_id, quick_reply):
+        button = SlackMessenger.format_quick_replies([quick_reply])[0]
+        return {"team": {"id": "T1"}, "user": {"id": slack_id}, "actions": [{"name": button["name"],
+                                                                            "value": button["value"]}]}
+
+    def test_message_event(self):
+        identity = self.identity(self.slack_users[0])
+        self.assertWithinBudget("message_event", tasks.message_event, identity, "hi")
+        BudgetParser.response.action = "test.budget"
+        BudgetParser.response.slot_filling_complete = True
+        self.assertWithinBudget("message_event_with_action", tasks.message_event, identity, "order")
+
+    def test_slack_message_event(self):
+        self.assertWithinBudget("slack_message_event_new_session", tasks.slack_message_event, "T1",
+                                {"user": "U1", "text": "hi"})
+        # a user unknown to the database is created
+        self.slack.add_user("U9")
+        tasks.slack_message_event("T1", {"user": "U9", "text": "hi"})
+        self.assertEqual(1, SlackUser.objects.filter(slack_id="U9").count())
+
+    def test_slack_action_event(self):
+        quick_reply = QuickReply("Order", action="test.budget", params={})
+        self.assertWithinBudget("slack_action_event_new_session", tasks.slack_action_event,
+                                self.action_event("U2", quick_reply))
+        self.assertWithinBudget("slack_action_event", tasks.slack_action_event, self.action_event("U2", quick_reply))
+
+    def test_retrieve_channel_users(self):
+        self.assertWithinBudget("retrieve_channel_users", retrieve_channel_users, self.slack_auth.pk)
+        # the budget does not depend on the size of the team, except for the users inserted one at a time by the
+        # databases which do not return the ids of a bulk insert
+        for i in range(20):
+            self.slack.add_user("W{}".format(i))
+        allowance = 0 if connection.features.can_return_ids_from_bulk_insert else 20
+        self.assertWithinBudget("retrieve_channel_users", retrieve_channel_users, self.slack_auth.pk,
+                                allowance=allowance)
+        self.assertEqual(25, SlackUser.objects.filter(slack_auth=self.slack_auth).count())
+
+    def test_auth_users(self):
+        auth = Auth.objects.get(pk=self.slack_auth.pk)
+        self.assertWithinBudget("auth_users", lambda: list(auth.users))
+
+    def test_user_attributes(self):
+        user = GroceryUser.objects.get(converse_user=self.slack_users[0])
+        self.assertWithinBudget("user_attributes", lambda: (user.name, user.session_id, user.messenger, user.org))
+
+    def test_user_attributes_joined(self):
+        # the user, the org and the messenger load in one joined query with the direct linkage
+        self.assertWithinBudget("user_attributes_joined", lambda: [
+            (user.name, user.session_id, user.messenger, user.org.name)
+            for user in GroceryUser.objects.select_converse().filter(converse_user=self.slack_users[0])])
+
+    def test_users_with_converse(self):
+        def read_attributes():
+            return [(user.name, user.session_id, user.messenger, user.org.name)
+                    for user in GroceryUser.objects.filter(converse_user__in=slack_users).with_converse()]
+
+        slack_users = self.slack_users
+        self.assertWithinBudget("users_with_converse", read_attributes)
+        # the budget does not depend on the number of users
+        slack_users = self.slack_users + [SlackUser.objects.create(slack_auth=self.slack_auth, slack_id="W{}".format(i))
+                                          for i in range(20)]
+        self.assertWithinBudget("users_with_converse", read_attributes)
+        self.assertEqual(25, len(read_attributes()))
+
+    def test_organization_attributes(self):
+        org = Organization.objects.get(converse_org=self.slack_auth)
+        self.assertWithinBudget("organization_attributes", lambda: (org.name, org.team_id, org.messenger))
+
+    def test_organization_is_not_kept_on_cached_auths(self):
+        slack_auth = get_slack_auth("T1")
+        slack_user = SlackUser.objects.get(pk=self.slack_users[0].pk)
+        slack_user.slack_auth = slack_auth
+        self.assertEqual("Team", slack_user.org.name)
+        self.assertEqual(Organization.objects.get(converse_org=self.slack_auth), slack_user.org)
+        self.assertFalse(SlackAuth.app_org.is_cached(slack_auth))
+        # the users loaded along with their organizations do not touch the cached SlackAuth either
+        users = list(GroceryUser.objects.filter(converse_user__in=self.slack_users).with_converse())
+        with self.assertNumQueries(0):
+            self.assertEqual(["Team"] * 5, [user.org.name for user in users])
+        self.assertFalse(SlackAuth.app_org.is_cached(slack_auth))
+        self.assertIs(slack_auth, get_slack_auth("T1"))
+
+    def test_missing_organization(self):
+        Organization.objects.filter(converse_org=self.slack_auth).delete()
+        with self.assertRaises(Organization.DoesNotExist):
+            Organization.for_converse_org(get_slack_auth("T1"))
+        users = GroceryUser.objects.filter(converse_user=self.slack_users[0])
+        # loaded without the organization, then with it, whichever way the linkage loads it
+        for queryset in [users, users.with_converse(), users.select_converse()]:
+            user = queryset.get()
+            with self.assertRaises(Organization.DoesNotExist):
+                user.org
@@ -1,5 +1,5 @@
 from django.conf.urls import url
-from views import SlackOAuthSuccessView, SlackOAuthFailureView
+from grocery.views import SlackOAuthSuccessView, SlackOAuthFailureView
 
 urlpatterns = [
     url(r'^success', SlackOAuthSuccessView.as_view(), name='success'),
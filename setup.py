@@ -14,7 +14,8 @@ setup(
     name='django-bot',
     version='0.2.2',
     packages=find_packages(exclude=['contrib', 'docs', 'tests']),
-    install_requires=["celery>=4.0", "slackclient==1.0.5", "Django>=1.8", "apiai==1.2.3"],
+    install_requires=["celery>=4.0", "slackclient==1.0.5", "Django>=1.8,<2.0", "requests>=2.4.2", "six>=1.10"],
+    extras_require={"async": ["aiohttp>=2.0"], "nlu": ["numpy"]},
     url='https://github.com/shaileshahuja/django-bot',
     license='GNU General Public License v3.0',
     author='shaileshahuja',
@@ -0,0 +1,96 @@
+import json
+import sys
+import threading
+import time
+import unittest
+
+from six.moves.BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from six.moves.socketserver import ThreadingMixIn
+from six.moves.urllib.parse import parse_qs
+
+from converse.messengers import QuickReply
+
+try:
+    import asyncio
+    from unittest import mock
+    from converse import aio
+except (ImportError, SyntaxError):
+    aio = None
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    # the default backlog of 5 resets some of the concurrent connections
+    request_queue_size = 64
+
+
+class SlowHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    delay = 0.2
+    requests = []
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers["Content-Length"])).decode()
+        time.sleep(self.delay)
+        if self.path.startswith("/query"):
+            self.requests.append(json.loads(body))
+            response = {"result": {"contexts": [], "fulfillment": {"speech": "Hello"}, "action": "greet",
+                                   "parameters": {"name": "Ann"}, "actionIncomplete": False}}
+        else:
+            self.requests.append(parse_qs(body))
+            response = {"ok": True}
+        body = json.dumps(response).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@unittest.skipIf(aio is None, "requires python 3.5+ and aiohttp")
+class TestAsync(unittest.TestCase):
+    def setUp(self):
+        SlowHandler.requests = []
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), SlowHandler)
+        threading.Thread(target=self.server.serve_forever).start()
+        url = "http://127.0.0.1:{}/".format(self.server.server_port)
+        self.patches = [mock.patch.object(aio, "slack_api_url", lambda method: url + "api/" + method),
+                        mock.patch.object(aio, "API_AI_URL", url + "query")]
+        for patch in self.patches:
+            patch.start()
+
+    def tearDown(self):
+        for patch in self.patches:
+            patch.stop()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_concurrent_sends(self):
+        messengers = [aio.AsyncSlackMessenger("xoxb-aio", "D{}".format(i)) for i in range(20)]
+        # gather binds to the current event loop of the thread
+        asyncio.set_event_loop(aio.get_event_loop())
+        try:
+            results = aio.run_sync(asyncio.gather(*[messenger.send_async("hi") for messenger in messengers]))
+        finally:
+            asyncio.set_event_loop(None)
+        self.assertEqual([True] * 20, results)
+        self.assertEqual(set("D{}".format(i) for i in range(20)),
+                         set(request["channel"][0] for request in SlowHandler.requests))
+
+    def test_sync_wrappers(self):
+        messenger = aio.AsyncSlackMessenger("xoxb-aio", "D1")
+        self.assertTrue(messenger.send_text("hello", [QuickReply("yes")]))
+        attachments = json.loads(SlowHandler.requests[0]["attachments"][0])
+        self.assertEqual("hello", attachments[0]["text"])
+
+        response = aio.AsyncAPIAIParser(client_token="token").parse("hi there", "T1-U1")
+        self.assertEqual(("Hello", "greet", {"name": "Ann"}, True),
+                         (response.text, response.action, response.params, response.slot_filling_complete))
+        self.assertEqual({"query": "hi there", "lang": "en", "sessionId": "T1-U1"}, SlowHandler.requests[1])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,38 @@
+import inspect
+import unittest
+
+from django.db.models import Manager
+from django.db.models.query import QuerySet
+from slackclient import SlackClient
+
+from converse.clients import SlackAPIRequest, SlackClientRegistry
+from converse.compat import SlackRequest, set_api_requester
+
+getargspec = getattr(inspect, "getfullargspec", None) or inspect.getargspec
+
+
+class TestSlackClientInternals(unittest.TestCase):
+    def test_api_requester(self):
+        client = SlackClient("xoxb")
+        self.assertIsInstance(client.server.api_requester, SlackRequest)
+        # SlackAPIRequest.do overrides the method the server posts its calls with
+        self.assertEqual(["self", "token", "request", "post_data", "domain", "timeout"],
+                         getargspec(SlackRequest.do).args)
+        self.assertTrue(callable(client.server.api_requester.get_user_agent))
+
+    def test_registry_clients_post_through_the_registry(self):
+        registry = SlackClientRegistry()
+        api_requester = registry.get("xoxb").server.api_requester
+        self.assertIsInstance(api_requester, SlackAPIRequest)
+        self.assertIs(registry, api_requester.registry)
+
+    def test_unexpected_client(self):
+        with self.assertRaises(RuntimeError):
+            set_api_requester(object(), SlackAPIRequest(SlackClientRegistry()))
+
+
+class TestDjangoInternals(unittest.TestCase):
+    def test_insert(self):
+        # insert_rows passes these arguments by name to the manager, which proxies the queryset
+        self.assertTrue(set(["objs", "fields", "return_id", "using"]) <= set(getargspec(QuerySet._insert).args))
+        self.assertTrue(callable(getattr(Manager(), "_insert", None)))
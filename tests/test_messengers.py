@@ -1,12 +1,24 @@
+import json
 import unittest
 import os
 
-from converse.messengers import SlackMessenger, MessengerBase, QuickReply
+from converse import clients
+from converse.messengers import SlackMessenger, MessengerBase, QuickReply, coalesce_messages
+from converse.testing import FakeSlackServer
 
 
 class TestMessenger(unittest.TestCase):
     def setUp(self):
-        self.messengers = {"slack": SlackMessenger(os.environ["SLACK_TOKEN"], os.environ["SLACK_CHANNEL"])}
+        if "SLACK_TOKEN" in os.environ:
+            token, channel = os.environ["SLACK_TOKEN"], os.environ["SLACK_CHANNEL"]
+        else:
+            # without credentials, the local stand-in of the Slack Web API is used
+            self.slack = FakeSlackServer().start()
+            self.api_url, clients.SLACK_API_URL = clients.SLACK_API_URL, self.slack.url
+            self.addCleanup(setattr, clients, "SLACK_API_URL", self.api_url)
+            self.addCleanup(self.slack.stop)
+            token, channel = "xoxb-test", "D1"
+        self.messengers = {"slack": SlackMessenger(token, channel)}
         self.actions = [QuickReply("1"), QuickReply(text="2", value="2")]
 
     def test_send(self):
@@ -41,3 +53,74 @@ class TestMessenger(unittest.TestCase):
             self.assertEqual(len(self.actions), len(res_actions))
             for one, two in zip(self.actions, res_actions):
                 self.assertEqual(one, two)
+
+
+class TestQuickReply(unittest.TestCase):
+    def test_action_round_trip(self):
+        quick_replies = [QuickReply("yes"), QuickReply("Add milk", action="cart.add", params={"item": "milk"})]
+        buttons = SlackMessenger.format_quick_replies(quick_replies)
+        self.assertEqual("yes", buttons[0]["name"])
+        self.assertEqual(quick_replies, SlackMessenger.parse_quick_replies({"actions": buttons}))
+        self.assertEqual("Add milk", buttons[1]["value"])
+
+    def test_invalid_action(self):
+        quick_reply = QuickReply.from_button({"name": QuickReply.ACTION_PREFIX + "{", "value": "v"})
+        self.assertIsNone(quick_reply.action)
+        self.assertEqual("v", quick_reply.value)
+
+
+class RecordingSlackClient:
+    def __init__(self):
+        self.token = "xoxb"
+        self.calls = []
+
+    def api_call(self, method, **kwargs):
+        self.calls.append((method, kwargs))
+        return {"ok": True}
+
+
+class TestCoalescing(unittest.TestCase):
+    def setUp(self):
+        self.messenger = SlackMessenger("xoxb", "D1")
+        self.messenger.sc = RecordingSlackClient()
+
+    def test_coalesce(self):
+        with coalesce_messages():
+            self.assertTrue(self.messenger.send("one"))
+            self.assertTrue(self.messenger.send("two"))
+            self.messenger.send_text("three", [QuickReply("yes")])
+            self.messenger.send_image("http://x.com/a.png")
+            self.messenger.send("four")
+            self.assertEqual([], self.messenger.sc.calls)
+        calls = self.messenger.sc.calls
+        self.assertEqual(2, len(calls))
+        self.assertEqual("one\ntwo", calls[0][1]["text"])
+        attachments = json.loads(calls[0][1]["attachments"])
+        self.assertEqual(["three", None], [attachment.get("text") for attachment in attachments])
+        self.assertEqual("four", calls[1][1]["text"])
+        self.assertNotIn("attachments", calls[1][1])
+
+    def test_disabled(self):
+        with coalesce_messages(enabled=False):
+            self.messenger.send("one")
+            self.messenger.send("two")
+        self.assertEqual(["one", "two"], [kwargs["text"] for _, kwargs in self.messenger.sc.calls])
+
+    def test_failed_block_is_not_flushed(self):
+        with self.assertRaises(ValueError):
+            with coalesce_messages():
+                self.messenger.send("one")
+                raise ValueError("handler error")
+        self.assertEqual([], self.messenger.sc.calls)
+        # the buffer of the thread is reset
+        self.messenger.send("two")
+        self.assertEqual(["two"], [kwargs["text"] for _, kwargs in self.messenger.sc.calls])
+
+    def test_flush_errors_are_isolated(self):
+        failing = SlackMessenger("xoxb", "D2")
+        failing.sc = RecordingSlackClient()
+        failing.flush = lambda messages: 1 / 0
+        with coalesce_messages():
+            failing.send("one")
+            self.messenger.send("two")
+        self.assertEqual(["two"], [kwargs["text"] for _, kwargs in self.messenger.sc.calls])